@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS = 252
+
+def _cumsum(values, dtype=np.float64):
+    # prefix sums with a leading zero row, sum over rows [start, end) of the
+    # original array is prefix[end] - prefix[start]
+    prefix = np.zeros((values.shape[0]+1,) + values.shape[1:], dtype=dtype, order='F')
+    np.cumsum(values, axis=0, dtype=dtype, out=prefix[1:])
+    return prefix
+
+def prefix_sums(c2c_ret):
+    # count, sum, sum of squares and sum of log returns, rows with no data
+    # (nan) do not contribute, the sums are accumulated in float64 whatever
+    # the dtype of the returns
+    valid = np.isfinite(c2c_ret)
+    ret = np.where(valid, c2c_ret, 0.0).astype(np.float64, copy=False)
+    return {'n': _cumsum(valid, dtype=np.int32),
+            'sum': _cumsum(ret),
+            'sq': _cumsum(ret * ret),
+            'log': _cumsum(np.log1p(ret))}
+
+def prefix_products(adj_factor):
+    # prefix products of the adjustment factors with a leading one row, rows
+    # with no data (nan) count as 1
+    prefix = np.ones((adj_factor.shape[0]+1,) + adj_factor.shape[1:], order='F')
+    np.cumprod(np.where(np.isfinite(adj_factor), adj_factor, 1.0), axis=0, dtype=np.float64, out=prefix[1:])
+    return prefix
+
+def backward_adjustment(prefix):
+    # prefix rows [start, end) of a window -> the factor backward adjusting
+    # each row to the last one, the product of the adj_factor from the row up
+    # to (excl.) the last row, prefix[end-1] / prefix[row]
+    return prefix[-1] / prefix if len(prefix) else prefix
+
+def split_factors(split_ratio):
+    # the split part of the adjustment factors from the split ratios the
+    # source reports (shares after / before on the ex date, nan or 1 without
+    # a split), aligned as adj_factor: the row before the ex date carries it
+    ratio = np.where(np.isfinite(split_ratio) & (split_ratio > 0), split_ratio, 1.0)
+    factors = np.ones(len(ratio))
+    factors[:-1] = 1.0 / ratio[1:]
+    return factors
+
+# period codes of datetime64[ns] dates, weeks start on monday (1970-01-01
+# was a thursday)
+PERIODS = {'W': lambda dates: (dates.astype('datetime64[D]').astype(np.int64) + 3) // 7,
+           'M': lambda dates: dates.astype('datetime64[M]').astype(np.int64),
+           'Q': lambda dates: dates.astype('datetime64[M]').astype(np.int64) // 3,
+           'Y': lambda dates: dates.astype('datetime64[Y]').astype(np.int64)}
+
+def period_starts(dates, freq):
+    # first row of every period of the sorted dates
+    codes = PERIODS[freq](dates)
+    return np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=np.int64)
+
+def compound(dates, c2c_ret, freq):
+    # daily returns (dates x tickers) -> returns compounded per period, one
+    # reduceat over the period boundaries, each period is labelled with its
+    # last date, nan where a ticker has no data in the period
+    starts = period_starts(dates, freq)
+    if not len(starts):
+        return dates[:0], c2c_ret[:0]
+    valid = np.isfinite(c2c_ret)
+    log = np.add.reduceat(np.log1p(np.where(valid, c2c_ret, 0.0)), starts, axis=0)
+    count = np.add.reduceat(valid, starts, axis=0)
+    ends = np.r_[starts[1:], len(dates)] - 1
+    return dates[ends], np.where(count > 0, np.expm1(log), np.nan)
+
+def covariance(c2c_ret, halflife=None, correlation=False):
+    # (dates x tickers) returns -> (tickers x tickers) covariance or
+    # correlation over the dates both tickers have data on (pairwise
+    # complete), the pairwise sums are a handful of matrix products. with a
+    # halflife (in rows) the rows are weighted exponentially, the last one
+    # with 1, and the estimate is bias corrected like pandas ewm().cov()
+    valid = np.isfinite(c2c_ret).astype(np.float64)
+    x = np.where(valid > 0, c2c_ret, 0.0)
+    w = np.ones(len(x)) if halflife is None else 0.5 ** (np.arange(len(x))[::-1] / halflife)
+    wv, wx = valid * w[:, None], x * w[:, None]
+    n = wv.T @ valid                # sum of weights of the common rows
+    sx = wx.T @ valid               # sum of x_i over the rows shared with j
+    sxy = wx.T @ x
+    n2 = (wv * w[:, None]).T @ valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # bias correction, n - 1 without weights
+        scale = n - n2 / n
+        cov = (sxy - sx * sx.T / n) / scale
+        if correlation:
+            sxx = (wx * x).T @ valid
+            var = (sxx - sx * sx / n) / scale
+            cov = cov / np.sqrt(var * var.T)
+    # at least two common rows (more than one effective observation)
+    return np.where(scale > 0, cov, np.nan)
+
+def window_summary(prefix, dates, tickers):
+    # per ticker aggregates of a window of n rows (dates) in O(1) from the
+    # n + 1 rows of its prefix sums (one column per ticker), only the max
+    # drawdown needs a pass over the window
+    diff = {key: prefix[key][-1] - prefix[key][0] for key in prefix}
+    n = diff['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = diff['sum'] / n
+        sd = np.sqrt((diff['sq'] - n * mean * mean) / (n - 1))
+        sharpe = mean / sd * np.sqrt(TRADING_DAYS)
+    total_return = np.expm1(diff['log'])
+
+    # drawdown from the running peak of the cumulative log return, the
+    # window base (prefix row 0) is the first peak
+    cum_log = prefix['log']
+    drawdown = cum_log - np.maximum.accumulate(cum_log, axis=0)
+    max_drawdown = np.expm1(drawdown.min(axis=0))
+
+    # first/last date with data per ticker in the window
+    count = prefix['n']
+    first = [np.searchsorted(count[:, c], count[0, c], side='right') - 1 for c in range(count.shape[1])]
+    last = [np.searchsorted(count[:, c], count[-1, c], side='left') - 1 for c in range(count.shape[1])]
+    found = n > 0
+    if not len(dates):
+        # an empty window, nothing is found and no date is picked
+        dates = np.array(['NaT'], dtype='datetime64[ns]')
+    return pd.DataFrame(data={'start_date': np.where(found, dates[np.clip(first, 0, len(dates)-1)], np.datetime64('NaT')),
+                              'end_date': np.where(found, dates[np.clip(last, 0, len(dates)-1)], np.datetime64('NaT')),
+                              'days': n.astype(np.int64),
+                              'total_return': total_return,
+                              'ann_vol': sd * np.sqrt(TRADING_DAYS),
+                              'sharpe': sharpe,
+                              'max_drawdown': max_drawdown},
+                        index=pd.Index(list(tickers), name='ticker'))
@@ -144,5 +144,41 @@ def benchmark_get_returns_by_date(state):
     while state:
         _get_returns_by_date(randomize=True)
 
+def _get_returns_by_queries_body(randomize=False, queries=100):
+    # the query_date scenario, batched into a single POST
+    if not randomize:
+        return {'queries': [{'tickers': tickers, 'start_date': '20250811'} for i in range(queries)]}
+    else:
+        return {'queries': [{'tickers': get_tickers(), 'start_date': str(get_date().date())} for i in range(queries)]}
+
+def _get_returns_by_queries(randomize=False):
+    response = requests.post(f'{YSERV_URL}/returns/query', json=_get_returns_by_queries_body(randomize),
+                             params={'format':'columns'})
+
+@benchmark.register(name='[url: /returns/query][batch of 100 query_date] ')
+@benchmark.option.iterations(1)
+@benchmark.option.repetitions(10)
+@benchmark.option.unit(benchmark.kMillisecond)
+def benchmark_get_returns_by_queries(state):
+    while state:
+        _get_returns_by_queries()
+
+@benchmark.register(name='[url: /returns/query][batch of 100 query_date][random args] ')
+@benchmark.option.iterations(1)
+@benchmark.option.repetitions(10)
+@benchmark.option.unit(benchmark.kMillisecond)
+def benchmark_get_returns_by_queries_randomize(state):
+    while state:
+        _get_returns_by_queries(True)
+
+@benchmark.register(name='[url: /returns/query][batch of 100 query_date][random args/load test] ')
+@benchmark.option.iterations(1)
+@benchmark.option.repetitions(10)
+@benchmark.option.unit(benchmark.kMillisecond)
+def benchmark_get_returns_by_queries_load_test_randomize(state):
+    while state:
+        with Pool(processes=8) as pool:
+            pool.map(_get_returns_by_queries,[True for i in range(8)])
+
 if __name__ == '__main__':
     benchmark.main()
@@ -0,0 +1,82 @@
+import gzip
+import asyncio
+import hashlib
+import datetime as dt
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Response
+from utils import ByteLRUCache
+import metrics
+
+# same threshold as the GZipMiddleware, smaller responses are sent as is
+GZIP_MIN_SIZE = 1000
+# a few % larger than level 9 for a fraction of the cpu
+GZIP_LEVEL = 6
+
+class ResponseCache:
+    """
+    cache of encoded responses, the body is kept both as is and gzipped so a
+    repeat query is a lookup plus a write of ready bytes. the key is the
+    normalized query plus the version of the data it read (see yserv), so
+    entries never go stale, they just stop being hit once yfetch writes new
+    data and are evicted lru. every response carries a (weak) etag of the
+    body, last-modified and cache-control for conditional gets and proxies.
+    a miss compresses the body in the executor, not on the event loop.
+    """
+
+    def __init__(self, max_bytes, max_age=60, executor=None, level=GZIP_LEVEL):
+        self.cache = ByteLRUCache(max_bytes)
+        self.max_age = max_age
+        self.executor = executor
+        self.level = level
+
+    def entry(self, content, media_type, last_modified):
+        # last_modified in epoch ns (the catalog mtime)
+        modified = dt.datetime.fromtimestamp(last_modified // 10**9, tz=dt.timezone.utc)
+        compressed = None
+        if len(content) >= GZIP_MIN_SIZE:
+            with metrics.stage('precompress'):
+                compressed = gzip.compress(content, compresslevel=self.level, mtime=0)
+        headers = {'etag': f'W/"{hashlib.blake2b(content, digest_size=16).hexdigest()}"',
+                   'last-modified': format_datetime(modified, usegmt=True),
+                   'cache-control': f'public, max-age={self.max_age}',
+                   'vary': 'Accept, Accept-Encoding'}
+        return {'content': content, 'gzip': compressed, 'media_type': media_type, 'modified': modified,
+                'headers': headers}
+
+    async def respond(self, request, key, build, last_modified):
+        # build() -> (content, media_type), only awaited on a miss
+        entry = self.cache.get(key)
+        metrics.cache('responses', entry is not None)
+        if entry is None:
+            content, media_type = await build()
+            if len(content) >= GZIP_MIN_SIZE:
+                entry = await asyncio.get_running_loop().run_in_executor(self.executor, self.entry, content,
+                                                                         media_type, last_modified)
+            else:
+                entry = self.entry(content, media_type, last_modified)
+            self.cache.put(key, entry, len(content) + len(entry['gzip'] or b''))
+        return self.response(request, entry)
+
+    @staticmethod
+    def not_modified(request, entry):
+        etags = request.headers.get('if-none-match')
+        if etags is not None:
+            # weak comparison, if-modified-since is ignored when there is an etag
+            etag = entry['headers']['etag'].removeprefix('W/')
+            return any(tag.strip().removeprefix('W/') in ('*', etag) for tag in etags.split(','))
+        since = request.headers.get('if-modified-since')
+        if since is not None:
+            try:
+                return entry['modified'] <= parsedate_to_datetime(since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def response(self, request, entry):
+        if self.not_modified(request, entry):
+            return Response(status_code=304, headers=entry['headers'])
+        if entry['gzip'] is not None and 'gzip' in request.headers.get('accept-encoding', '').lower():
+            # already compressed, the GZipMiddleware skips responses with a content-encoding
+            return Response(entry['gzip'], media_type=entry['media_type'],
+                            headers={**entry['headers'], 'content-encoding': 'gzip'})
+        return Response(entry['content'], media_type=entry['media_type'], headers=entry['headers'])
@@ -0,0 +1,209 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from store import ticker_dirs, ticker_years, partition_files, row_group_dates, read_partition
+from events import append_events
+from logger import logger
+
+# persistent ticker catalog kept alongside the parquet files, maintained by
+# yfetch.upsert, every entry holds the start/end date, number of rows and the
+# yearly files of a ticker so the service never has to open parquet files
+# just to list what it has
+CATALOG_FILE = '_catalog.json'
+CATALOG_LOCK = '_catalog.lock'
+# an update appends a line to the catalog log (json lines: the generation and
+# the entries of the tickers written, null for a ticker gone) instead of
+# rewriting the whole catalog, readers apply the log on top of the catalog
+# file. the log is folded into the catalog file once it is the larger of the
+# two (so a fold costs no more than the appends that led to it) and above
+# LOG_FOLD_BYTES, it then starts over with a line of the generation alone
+CATALOG_LOG = '_catalog.log'
+LOG_FOLD_BYTES = 2**20
+
+def catalog_path(db_dir):
+    return os.path.join(db_dir, CATALOG_FILE)
+
+def log_path(db_dir):
+    return os.path.join(db_dir, CATALOG_LOG)
+
+@contextmanager
+def catalog_lock(db_dir):
+    os.makedirs(db_dir, exist_ok=True)
+    with open(os.path.join(db_dir, CATALOG_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def partition_stats(db_dir, ticker, year):
+    # (start date, end date, rows) of a partition from the row group
+    # statistics of the date column of its file and deltas, no data pages are
+    # read unless the date ranges overlap by more than their end date (a
+    # delta rewriting earlier rows) or a footer has no statistics
+    ranges = [row_group_dates(parquet_file.metadata, row_group)
+              for parquet_file, row_group in partition_files(db_dir, ticker, year)]
+    rows, end_date = 0, None
+    if all(first is not None for first, _, _ in ranges):
+        for first, last, n in sorted(ranges):
+            if end_date is None or first > end_date:
+                rows += n
+            elif first == end_date:
+                # the one date both have, counted already
+                rows += n - 1
+            else:
+                break
+            end_date = last if end_date is None else max(end_date, last)
+        else:
+            return min(first for first, _, _ in ranges), end_date, rows
+    # only the date column of the partition and its deltas
+    dates = read_partition(db_dir, ticker, year, columns=[]).index
+    return dates[0], dates[-1], len(dates)
+
+def ticker_entry(db_dir, ticker):
+    # files are the yearly partitions of the ticker, {year}.parquet whatever
+    # the layout
+    years = ticker_years(db_dir, ticker)
+    if not years:
+        return None
+    stats = [partition_stats(db_dir, ticker, year) for year in years]
+    return {'start_date': min(s[0] for s in stats).isoformat(), 'end_date': max(s[1] for s in stats).isoformat(),
+            'rows': sum(s[2] for s in stats), 'files': [f'{year}.parquet' for year in years]}
+
+def build_catalog(db_dir):
+    catalog = {}
+    for ticker in ticker_dirs(db_dir):
+        entry = ticker_entry(db_dir, ticker)
+        if entry:
+            catalog[ticker] = entry
+    return catalog
+
+def save_catalog(db_dir, catalog):
+    # write to a temp file and rename, readers either see the old or the new
+    # catalog, never a partial one
+    path = catalog_path(db_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog, f)
+    os.replace(tmp_path, path)
+
+def reset_log(db_dir, generation):
+    path = log_path(db_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps({'generation': generation, 'entries': {}}) + '\n')
+    os.replace(tmp_path, path)
+
+def read_log(db_dir):
+    # the lines of the log, a line still being appended is left out
+    try:
+        with open(log_path(db_dir), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return [json.loads(line) for line in data.split(b'\n')[:-1]]
+
+def apply_log(catalog, log):
+    for line in log:
+        for ticker, entry in line['entries'].items():
+            if entry is None:
+                catalog.pop(ticker, None)
+            else:
+                catalog[ticker] = entry
+    return catalog
+
+def last_generation(db_dir):
+    # the generation of the last line of the log, read back from its end
+    try:
+        with open(log_path(db_dir), 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            tail = b''
+            while end > 0:
+                start = max(0, end - 2**16)
+                f.seek(start)
+                tail = f.read(end - start) + tail
+                end = start
+                lines = tail.rstrip(b'\n').rsplit(b'\n', 1)
+                if len(lines) == 2 or end == 0:
+                    return json.loads(lines[-1])['generation']
+    except FileNotFoundError:
+        pass
+    # no log yet
+    with open(catalog_path(db_dir)) as f:
+        return max((entry.get('generation', 0) for entry in json.load(f).values()), default=0)
+
+def catalog_mtime(db_dir):
+    # every update changes the log, a catalog without a log (built from the
+    # parquet files) its file
+    for path in [log_path(db_dir), catalog_path(db_dir)]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return None
+
+def load_catalog(db_dir):
+    path = catalog_path(db_dir)
+    if not os.path.exists(path):
+        with catalog_lock(db_dir):
+            if not os.path.exists(path):
+                logger.info(f'Building ticker catalog: {path}')
+                save_catalog(db_dir, build_catalog(db_dir))
+                # whatever an old log holds is in the catalog just built
+                if os.path.exists(log_path(db_dir)):
+                    reset_log(db_dir, last_generation(db_dir))
+    # the log first, a fold in between has put its lines in the catalog file
+    # already (applying them again changes nothing)
+    log = read_log(db_dir)
+    with open(path) as f:
+        return apply_log(json.load(f), log)
+
+def update_catalog(db_dir, tickers, windows=None):
+    # refresh the entries of the given tickers only, appended to the log,
+    # windows {ticker: (start date, end date)} of the rows just written are
+    # appended to the event log, returns the new entries
+    with catalog_lock(db_dir):
+        if not os.path.exists(catalog_path(db_dir)):
+            save_catalog(db_dir, build_catalog(db_dir))
+        # every update is a new generation of the data, the service compares
+        # the generation of each ticker to find out what has changed
+        generation = last_generation(db_dir) + 1
+        entries = {}
+        for ticker in tickers:
+            entry = ticker_entry(db_dir, ticker)
+            if entry:
+                entry['generation'] = generation
+            entries[ticker] = entry
+        with open(log_path(db_dir), 'a+b') as f:
+            # a line cut short by a writer that died is dropped
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b'\n':
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b'\n') + 1)
+            f.write((json.dumps({'generation': generation, 'entries': entries}) + '\n').encode())
+        if os.path.getsize(log_path(db_dir)) > max(os.path.getsize(catalog_path(db_dir)), LOG_FOLD_BYTES):
+            fold_log(db_dir, generation)
+        append_events(db_dir, [{'ticker': ticker, 'start_date': start_date.isoformat(),
+                                'end_date': end_date.isoformat(), 'generation': generation}
+                               for ticker, (start_date, end_date) in (windows or {}).items() if entries.get(ticker)])
+    return entries
+
+def fold_log(db_dir, generation):
+    # the catalog file first, a reader that read the log before sees its
+    # lines in both
+    with open(catalog_path(db_dir)) as f:
+        catalog = apply_log(json.load(f), read_log(db_dir))
+    save_catalog(db_dir, catalog)
+    reset_log(db_dir, generation)
+
+def catalog_frame(catalog):
+    tickers = sorted(catalog)
+    return pd.DataFrame(data={'ticker': tickers,
+                              'start_date': pd.to_datetime([catalog[t]['start_date'] for t in tickers]),
+                              'end_date': pd.to_datetime([catalog[t]['end_date'] for t in tickers])})
@@ -0,0 +1,172 @@
+import click
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils import *
+from logger import logger
+from store import (YEARLY_DIR, CODECS, read_layout, save_layout, compression, ticker_dirs, ticker_files,
+                   delta_files, ticker_years, read_partition, read_all, write_parquet)
+
+app_config = ApplicationConfig(__file__)
+
+#DB_DIR = os.path.join(os.path.dirname(__file__), "parquet")
+DB_DIR = app_config.data.db_dir()
+
+LAYOUTS = ['per_ticker', 'yearly']
+
+def store_files(db_dir):
+    return [os.path.join(root, name) for root, dirs, names in os.walk(db_dir)
+            for name in names if name.endswith('.parquet')]
+
+def benchmark(db_dir, samples=200, seed=0):
+    # a full scan (what yserv does at startup with preload_store) and random
+    # single partition reads (what yserv does for tickers not in the store)
+    files = store_files(db_dir)
+    start = time.perf_counter()
+    data = read_all(db_dir, columns=['close_px', 'adj_factor'])
+    full_scan = time.perf_counter() - start
+
+    partitions = [(ticker, year) for ticker in data for year in ticker_years(db_dir, ticker)]
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(partitions), min(samples, len(partitions)), replace=False) if partitions else []
+    start = time.perf_counter()
+    for i in picks:
+        read_partition(db_dir, *partitions[i], columns=['close_px', 'adj_factor'])
+    partition_read = (time.perf_counter() - start) / max(1, len(picks))
+
+    return {'files': len(files),
+            'mb': sum(os.path.getsize(file_path) for file_path in files) / 2**20,
+            'full_scan_s': full_scan,
+            'partition_read_ms': partition_read * 1e3}
+
+def write_yearly(db_dir, year, tickers, codec, file_path):
+    # one row group per ticker, sorted by (ticker, date), the ticker column
+    # is dictionary encoded, returns ticker -> row group
+    row_groups = {}
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    writer = None
+    try:
+        for ticker in tickers:
+            eod_data = read_partition(db_dir, ticker, year).sort_index()
+            table = pa.Table.from_pandas(eod_data, preserve_index=True)
+            ticker_col = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(table), dtype=np.int32)),
+                                                        pa.array([ticker]))
+            table = table.add_column(0, 'ticker', ticker_col)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(tmp_path, schema, compression=compression(codec))
+            writer.write_table(table.select(schema.names).cast(schema))
+            row_groups[ticker] = len(row_groups)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, file_path)
+    return row_groups
+
+def compact(db_dir, layout='yearly', codec='zstd'):
+    """
+    rewrites the store into the given layout/codec, the new files are written
+    next to the old ones, the layout file is swapped atomically and only then
+    the superseded files are removed, so a running yserv keeps reading a
+    consistent store throughout. yfetch should not run at the same time.
+    """
+    current = read_layout(db_dir)
+    partitions = {ticker: ticker_years(db_dir, ticker) for ticker in ticker_dirs(db_dir)}
+    # per ticker files and deltas seen now (folded into the new files), only
+    # these are removed afterwards
+    overlays = {file_path: file_path.stat().st_mtime_ns for ticker in partitions
+                for file_path in ticker_files(db_dir, ticker)}
+    deltas = {file_path: file_path.stat().st_mtime_ns for ticker in partitions
+              for file_path in delta_files(db_dir, ticker)}
+    new = {'layout': layout, 'codec': codec, 'years': {}}
+
+    if layout == 'yearly':
+        # yearly files get a new name on every compaction, readers holding
+        # the previous layout keep reading the previous files
+        generation = current.get('generation', 0) + 1
+        new['generation'] = generation
+        os.makedirs(os.path.join(db_dir, YEARLY_DIR), exist_ok=True)
+        for year in sorted({year for years in partitions.values() for year in years}):
+            tickers = sorted(ticker for ticker, years in partitions.items() if year in years)
+            name = f'{year}.{generation}.parquet'
+            logger.info(f'Writing {YEARLY_DIR}/{name}: {len(tickers)} tickers')
+            row_groups = write_yearly(db_dir, year, tickers, codec, os.path.join(db_dir, YEARLY_DIR, name))
+            new['years'][str(year)] = {'file': name, 'tickers': row_groups}
+    else:
+        for ticker, years in partitions.items():
+            logger.info(f'Writing {ticker}: {len(years)} years')
+            for year in years:
+                write_parquet(read_partition(db_dir, ticker, year),
+                              os.path.join(db_dir, f'{ticker}', f'{year}.parquet'), codec)
+
+    save_layout(db_dir, new)
+
+    # drop what the new layout superseded
+    superseded = {**deltas, **overlays} if layout == 'yearly' else deltas
+    for file_path, mtime in superseded.items():
+        # unless yfetch rewrote it in the meantime
+        if file_path.stat().st_mtime_ns == mtime:
+            file_path.unlink()
+    if layout == 'yearly':
+        for ticker in partitions:
+            ticker_dir = os.path.join(db_dir, f'{ticker}')
+            if os.path.isdir(ticker_dir) and not os.listdir(ticker_dir):
+                os.rmdir(ticker_dir)
+    keep = {entry['file'] for entry in new['years'].values()}
+    yearly_dir = os.path.join(db_dir, YEARLY_DIR)
+    if os.path.isdir(yearly_dir):
+        for name in os.listdir(yearly_dir):
+            if name not in keep:
+                os.remove(os.path.join(yearly_dir, name))
+        if not keep:
+            os.rmdir(yearly_dir)
+    return new
+
+@click.command()
+@click.option('--layout',
+              type=click.Choice(LAYOUTS),
+              default='yearly',
+              required=False,
+              show_default=True,
+              help='per_ticker: {ticker}/{year}.parquet, yearly: a file per year with a row group per ticker')
+@click.option('--codec',
+              type=click.Choice(CODECS),
+              default='zstd',
+              required=False,
+              show_default=True,
+              help='parquet compression')
+@click.option('--db_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='store location  [default: db_dir in app_config.yaml]')
+@click.option('--benchmark/--no-benchmark',
+              'run_benchmark',
+              default=True,
+              required=False,
+              show_default=True,
+              help='report read times before and after')
+@click.option('--samples',
+              type=click.INT,
+              default=200,
+              required=False,
+              show_default=True,
+              help='random partition reads in the benchmark')
+def main(layout, codec, db_dir, run_benchmark, samples):
+    """parquet store compaction"""
+    db_dir = db_dir or DB_DIR
+    current = read_layout(db_dir)
+    logger.info(f"Compacting {db_dir}: {current['layout']}/{current['codec']} -> {layout}/{codec}")
+    before = benchmark(db_dir, samples=samples) if run_benchmark else None
+    compact(db_dir, layout=layout, codec=codec)
+    if run_benchmark:
+        after = benchmark(db_dir, samples=samples)
+        report = pd.DataFrame({'before': before, 'after': after})
+        report['ratio'] = report['after'] / report['before']
+        logger.info(f'\n{report.round(3)}')
+
+if __name__ == "__main__":
+    main()
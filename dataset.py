@@ -0,0 +1,209 @@
+import click
+import os
+import time
+import asyncio
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+from utils import *
+from logger import logger
+from store import (LAYOUT_FILE, YEARLY_DIR, PRICE_COLUMNS, ADJUST_COLUMNS, PartitionStore, read_layout, ticker_files, delta_files, delta_seq,
+                   ticker_dirs, ticker_years, c2c_ret)
+import metrics
+
+# optional yserv backend (backend: dataset in app_config.yaml), every file of
+# the store is a fragment of one pyarrow dataset and the queries are scans
+# with the ticker/year/date predicates pushed down: files of other tickers
+# and years are pruned on their partition expressions, row groups of the
+# yearly files on their ticker/date statistics, the scan itself is
+# multithreaded. nothing is cached in memory, repeat reads rely on the os
+# page cache.
+#
+# the fragments carry a priority, the same date of a ticker in a fragment of
+# higher priority wins: yearly row groups 0, {ticker}/{year}.parquet 1 and
+# the deltas 2 + seq, which is how read_partition layers them
+
+SCHEMA = pa.schema([('date', pa.timestamp('ns'))]
+                   + [(column, pa.float64()) for column in PRICE_COLUMNS + ADJUST_COLUMNS]
+                   + [('ticker', pa.string()), ('year', pa.int32()), ('priority', pa.int32())])
+
+# calendar days scanned before a window for the row the first c2c_ret needs
+PRIOR_DAYS = 14
+
+def fragments(db_dir):
+    # (path, partition expression) of every file of the store
+    paths, partitions = [], []
+    for year, entry in read_layout(db_dir)['years'].items():
+        paths.append(os.path.join(db_dir, YEARLY_DIR, entry['file']))
+        partitions.append((ds.field('year') == int(year)) & (ds.field('priority') == 0))
+    for ticker in ticker_dirs(db_dir):
+        for file_path in ticker_files(db_dir, ticker):
+            paths.append(str(file_path))
+            partitions.append((ds.field('ticker') == ticker) & (ds.field('year') == int(file_path.stem))
+                              & (ds.field('priority') == 1))
+        for file_path in delta_files(db_dir, ticker):
+            year, seq = delta_seq(file_path)
+            paths.append(str(file_path))
+            partitions.append((ds.field('ticker') == ticker) & (ds.field('year') == year)
+                              & (ds.field('priority') == 2 + seq))
+    return paths, partitions
+
+def store_dataset(db_dir):
+    paths, partitions = fragments(db_dir)
+    return ds.FileSystemDataset.from_paths(paths, schema=SCHEMA, format=ds.ParquetFileFormat(),
+                                           filesystem=pa.fs.LocalFileSystem(), partitions=partitions)
+
+def mtimes(db_dir, names):
+    # {name: mtime} of entries of db_dir (None when missing), a file added to
+    # or removed from a directory changes the directory mtime
+    stamps = {}
+    for name in names:
+        try:
+            stamps[name] = os.stat(os.path.join(db_dir, name)).st_mtime_ns
+        except FileNotFoundError:
+            stamps[name] = None
+    return stamps
+
+def _timestamp(value):
+    return pa.scalar(pd.Timestamp(value).as_unit('ns'), type=pa.timestamp('ns'))
+
+class DatasetStore(PartitionStore):
+    """
+    PartitionStore over a pyarrow dataset of the store, the same coroutines
+    (window, prices, returns) each a single pushed down scan in the executor
+    instead of per (ticker, year) reads. the dataset is rebuilt (the files
+    listed again) after an evict, ie. when yfetch wrote new files, and when
+    _layout.json or the directory of a scanned ticker changed since it was
+    built (compact, merge_deltas), the same way read_layout checks its mtime.
+    """
+
+    def __init__(self, db_dir, max_bytes=0, columns=None, executor=None):
+        super().__init__(db_dir, max_bytes, columns=columns, executor=executor)
+        self.dataset = None
+        self.mtimes = {}
+
+    def evict(self, ticker):
+        self.dataset = None
+
+    def current(self, tickers):
+        # the dataset, rebuilt when the files it lists may have changed
+        names = [LAYOUT_FILE, YEARLY_DIR] + list(tickers)
+        stamps = mtimes(self.db_dir, names)
+        dataset = self.dataset
+        if dataset is None or any(self.mtimes.get(name) != stamps[name] for name in names):
+            # the mtimes before the listing, a change while listing shows up
+            # on the next scan
+            self.mtimes = mtimes(self.db_dir, [LAYOUT_FILE, YEARLY_DIR] + ticker_dirs(self.db_dir))
+            dataset = self.dataset = store_dataset(self.db_dir)
+        return dataset
+
+    def scan(self, tickers, start_date=None, end_date=None):
+        # rows of the tickers between the dates (inclusive, open ended when
+        # None) in long format (ticker, date, columns...) sorted by ticker/date
+        condition = ds.field('ticker').isin(list(tickers))
+        if start_date is not None:
+            condition &= (ds.field('year') >= start_date.year) & (ds.field('date') >= _timestamp(start_date))
+        if end_date is not None:
+            condition &= (ds.field('year') <= end_date.year) & (ds.field('date') <= _timestamp(end_date))
+        columns = ['ticker', 'date', 'priority'] + self.columns
+        with metrics.stage('dataset_scan'):
+            try:
+                table = self.current(tickers).to_table(columns=columns, filter=condition, use_threads=True)
+            except FileNotFoundError:
+                # a file removed between the check and the read, once more
+                # on a new listing
+                self.dataset = None
+                table = self.current(tickers).to_table(columns=columns, filter=condition, use_threads=True)
+        table = table.sort_by([('ticker', 'ascending'), ('date', 'ascending'), ('priority', 'ascending')])
+        # the last (highest priority) row of every (ticker, date)
+        codes = table['ticker'].combine_chunks().dictionary_encode().indices.to_numpy()
+        dates = table['date'].to_numpy()
+        last = np.r_[(codes[1:] != codes[:-1]) | (dates[1:] != dates[:-1]), True][:len(dates)]
+        return table.filter(last).drop_columns(['priority']).to_pandas()
+
+    async def _scan(self, tickers, start_date=None, end_date=None):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.scan, tickers, start_date,
+                                                                end_date)
+
+    @staticmethod
+    def _frame(eod_data, columns):
+        return eod_data.set_index(pd.DatetimeIndex(eod_data['date'], name='date'))[columns]
+
+    async def window(self, ticker, start_date, end_date, years=None):
+        return self._frame(await self._scan([ticker], start_date, end_date), self.columns)
+
+    async def returns(self, ticker, start_date, end_date, years=None):
+        eod_data = await self._scan([ticker], start_date - dt.timedelta(days=PRIOR_DAYS), end_date)
+        prior = (eod_data['date'] < start_date).to_numpy()
+        if prior.all():
+            return pd.DataFrame(columns=['c2c_ret'], dtype=np.float64)
+        if not prior.any():
+            # a gap (or the listing) right before the window, the last row
+            # before it wherever it is
+            earlier = await self._scan([ticker], None, start_date - dt.timedelta(days=PRIOR_DAYS + 1))
+            eod_data = pd.concat([earlier.iloc[-1:], eod_data], sort=False)
+            prior = np.r_[len(earlier) > 0, prior]
+        eod_data = self._frame(eod_data.iloc[max(0, prior.sum() - 1):], self.columns)
+        eod_data = eod_data.assign(c2c_ret=c2c_ret(eod_data['close_px'], eod_data['adj_factor']))
+        return eod_data[['c2c_ret']].iloc[int(prior.any()):]
+
+def benchmark(db_dir, queries=100, seed=0, workers=4):
+    # the same random (ticker, window) returns queries through both
+    # backends, cold (new store, nothing cached in process) then warm (the
+    # same queries again)
+    from concurrent.futures import ThreadPoolExecutor
+    tickers = ticker_dirs(db_dir)
+    years = {ticker: ticker_years(db_dir, ticker) for ticker in tickers}
+    rng = np.random.default_rng(seed)
+    picks = []
+    for ticker in rng.choice(tickers, queries):
+        first, last = dt.datetime(years[ticker][0], 1, 1), dt.datetime(years[ticker][-1], 12, 31)
+        start, end = sorted(rng.integers(first.toordinal(), last.toordinal(), 2))
+        picks.append((ticker, dt.datetime.fromordinal(start), dt.datetime.fromordinal(end)))
+
+    async def run(store):
+        start = time.perf_counter()
+        results = [await store.returns(ticker, start_date, end_date, years=years[ticker])
+                   for ticker, start_date, end_date in picks]
+        return (time.perf_counter() - start) / len(picks) * 1e3, results
+
+    report = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, cls in [('pandas', PartitionStore), ('dataset', DatasetStore)]:
+            store = cls(db_dir, 2**30, executor=executor)
+            cold, results = asyncio.run(run(store))
+            warm, _ = asyncio.run(run(store))
+            report[name] = {'cold_ms': cold, 'warm_ms': warm}
+            report[name]['rows'] = sum(len(result) for result in results)
+    return pd.DataFrame(report)
+
+@click.command()
+@click.option('--db_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='store location  [default: db_dir in app_config.yaml]')
+@click.option('--queries',
+              type=click.INT,
+              default=100,
+              required=False,
+              show_default=True,
+              help='random (ticker, window) returns queries')
+@click.option('--seed',
+              type=click.INT,
+              default=0,
+              required=False,
+              show_default=True,
+              help='seed of the queries')
+def main(db_dir, queries, seed):
+    """pandas vs dataset backend benchmark"""
+    app_config = ApplicationConfig(__file__)
+    db_dir = db_dir or app_config.data.db_dir()
+    logger.info(f'Benchmarking {queries} returns queries on {db_dir}')
+    logger.info(f'\n{benchmark(db_dir, queries=queries, seed=seed).round(3)}')
+
+if __name__ == "__main__":
+    main()
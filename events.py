@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import asyncio
+from logger import logger
+
+# append only log of the ingests, {db_dir}/_events.jsonl, yfetch appends a
+# json line per ticker written (ticker, start/end date of the new rows,
+# catalog generation, time) right after the catalog update and under the
+# catalog lock, so whoever reads an event already sees the catalog (and the
+# files) it refers to. the byte offset just past a line is the id of its
+# event, readers tail the file from the last offset they have seen.
+# once past EVENTS_ROTATE_BYTES the log is moved to _events.jsonl.1 (the one
+# before is dropped) and a new log starts with a {"base": id} line, the id
+# the moved log ended at, offsets in the new log count from it so ids keep
+# growing and a reader still in the moved log finishes it first. the log can
+# also be truncated (or deleted) by hand, readers then start over from the
+# beginning of what is there
+EVENTS_FILE = '_events.jsonl'
+EVENTS_ROTATE_BYTES = 2**24
+
+def events_path(db_dir):
+    return os.path.join(db_dir, EVENTS_FILE)
+
+def rotated_path(db_dir):
+    return events_path(db_dir) + '.1'
+
+def log_base(f):
+    # -> (the id offsets in the open log count from, the length of its base
+    # line), a log never rotated has none
+    line = f.readline()
+    if line.startswith(b'{"base":') and line.endswith(b'\n'):
+        return json.loads(line)['base'], len(line)
+    return 0, 0
+
+def events_end(db_dir):
+    # the id just past the last line of the log
+    try:
+        with open(events_path(db_dir), 'rb') as f:
+            return log_base(f)[0] + os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return 0
+
+def rotate_events(db_dir):
+    # the old log is linked as the rotated one, then the new log (its base
+    # line only) replaces it in one rename so readers always find a log,
+    # under the catalog lock as the appends so nothing is written in between
+    path, rotated, end = events_path(db_dir), rotated_path(db_dir), events_end(db_dir)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write((json.dumps({'base': end}) + '\n').encode())
+    if os.path.exists(f'{rotated}.tmp'):
+        os.unlink(f'{rotated}.tmp')
+    os.link(path, f'{rotated}.tmp')
+    os.replace(f'{rotated}.tmp', rotated)
+    os.replace(f'{path}.tmp', path)
+    logger.info(f'Rotated the event log at id {end}')
+
+def append_events(db_dir, events):
+    # one write of whole lines with O_APPEND, concurrent writers never
+    # interleave within a line
+    if not events:
+        return
+    try:
+        if os.path.getsize(events_path(db_dir)) > EVENTS_ROTATE_BYTES:
+            rotate_events(db_dir)
+    except FileNotFoundError:
+        pass
+    lines = ''.join(json.dumps({**event, 'time': time.time()}) + '\n' for event in events).encode()
+    fd = os.open(events_path(db_dir), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines)
+    finally:
+        os.close(fd)
+
+def read_lines(f, base, start, offset, end):
+    # the complete lines of an open log from id offset up to id end -> ([event
+    # + its id], new offset), a line that does not parse is skipped
+    size = os.fstat(f.fileno()).st_size
+    if offset > base + size:
+        logger.info('Event log truncated, reading it from the start')
+        offset = base + start
+    elif offset > base + start:
+        # an offset in the middle of a line, the log was truncated and has
+        # grown again past it since the last read
+        f.seek(offset - base - 1)
+        if f.read(1) != b'\n':
+            logger.info('Event log truncated, reading it from the start')
+            offset = base + start
+    offset = max(offset, base + start)
+    f.seek(offset - base)
+    data = f.read(max(min(size, end - base) - (offset - base), 0))
+    events = []
+    for line in data[:data.rfind(b'\n') + 1].splitlines(keepends=True):
+        offset += len(line)
+        try:
+            events.append({**json.loads(line), 'id': offset})
+        except ValueError:
+            logger.warning(f'Skipped a bad line of the event log at id {offset}')
+    return events, offset
+
+def read_events(db_dir, offset, end=None):
+    # the complete lines from id offset (up to end) -> ([event + its id], new
+    # offset), a line still being written is left for the next read
+    end = float('inf') if end is None else end
+    try:
+        with open(events_path(db_dir), 'rb') as f:
+            base, start = log_base(f)
+            events = []
+            if offset < base:
+                # the log was rotated since the last read, the rest of the
+                # moved log first
+                try:
+                    with open(rotated_path(db_dir), 'rb') as rotated:
+                        rotated_base, rotated_start = log_base(rotated)
+                        if offset >= rotated_base:
+                            events, _ = read_lines(rotated, rotated_base, rotated_start, offset, min(end, base))
+                        else:
+                            logger.warning(f'Events before id {rotated_base} were rotated out of the log')
+                except FileNotFoundError:
+                    logger.warning(f'Events before id {base} were rotated out of the log')
+                offset = base
+            if offset >= end:
+                return events, offset
+            new_events, offset = read_lines(f, base, start, offset, end)
+            return events + new_events, offset
+    except FileNotFoundError:
+        # deleted, whatever log comes next is read from its start
+        return [], offset
+
+class EventHub:
+    """
+    tails the event log and fans the new events out to the subscribers of a
+    worker, a single poll of the log every poll_secs whatever the number of
+    subscribers, only while there are any. render(events) -> [(event,
+    message)] is awaited once per batch of events, each subscriber gets the
+    messages of its tickers on its queue.
+    """
+
+    def __init__(self, db_dir, render, poll_secs=1.0):
+        self.db_dir = db_dir
+        self.render = render
+        self.poll_secs = poll_secs
+        self.subscribers = {}
+        self.offset = 0
+        self.task = None
+
+    async def subscribe(self, tickers, last_id=None):
+        # -> the queue of the subscriber, with the events after last_id (if
+        # the client resumes) already on it
+        if self.task is None:
+            # only what is appended from now on
+            self.offset = events_end(self.db_dir)
+            self.task = asyncio.create_task(self.run())
+        queue, tickers = asyncio.Queue(), set(tickers)
+        offset = self.offset if last_id is None else last_id
+        while offset < self.offset:
+            # replayed up to where the hub is, which may move on meanwhile,
+            # the queue only joins once it has caught up so nothing is sent
+            # twice or out of order
+            end = self.offset
+            events, _ = await asyncio.to_thread(read_events, self.db_dir, offset, end)
+            events = [event for event in events if event['ticker'] in tickers]
+            self.publish(await self.render(events), {queue: (tickers, offset)})
+            offset = end
+        # (a client resuming ahead of the hub skips what it has seen)
+        self.subscribers[queue] = (tickers, offset)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.pop(queue, None)
+        if not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @staticmethod
+    def publish(messages, subscribers):
+        for queue, (tickers, after) in subscribers.items():
+            for event, message in messages:
+                if event['ticker'] in tickers and event['id'] > after:
+                    queue.put_nowait(message)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.poll_secs)
+            try:
+                offset = self.offset
+                events, self.offset = await asyncio.to_thread(read_events, self.db_dir, offset)
+                if self.offset < offset or (events and events[0]['id'] <= offset):
+                    # the log was truncated (or deleted), ids start over
+                    self.subscribers = {queue: (tickers, 0) for queue, (tickers, _) in self.subscribers.items()}
+                # whoever joins while the events are rendered has replayed them
+                subscribers = dict(self.subscribers)
+                wanted = set().union(*(tickers for tickers, _ in subscribers.values()))
+                events = [event for event in events if event['ticker'] in wanted]
+                if events:
+                    self.publish(await self.render(events), subscribers)
+            except Exception as e:
+                logger.error(f'Failed to read the event log: {e}')
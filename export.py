@@ -0,0 +1,215 @@
+import click
+import os
+import glob
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from utils import *
+from logger import logger
+from catalog import load_catalog
+from store import SharedStore
+
+# the aligned (dates x tickers) matrices of the store as raw .npy files for
+# consumers on the same host, memory mapped instead of going through the rest
+# api: {export_dir}/header.json names the files of the current version
+# ({column}.{version}.npy, dates.{version}.npy) and holds the tickers (the
+# columns of the matrices) and the catalog entries the export was made from.
+# a new export writes new files and then swaps header.json atomically, the
+# files of older versions are removed, readers that still map them keep
+# their pages
+HEADER_FILE = 'header.json'
+COLUMNS = ['close_px', 'adj_factor', 'c2c_ret']
+# the SharedStore itself (every array of SharedStore.state) is saved the same
+# way in a store dir, {store_dir}/store.json + {name}.{version}.npy, the one
+# of an export is {export_dir}/_store. yserv maps it in every worker, so no
+# part of the store (prefix sums and date major copy included) is private to
+# a worker, the writers (yfetch, the yserv worker refreshing it) hold the
+# lock of the dir
+STORE_DIR = '_store'
+STORE_HEADER = 'store.json'
+STORE_LOCK = '.lock'
+
+def header_path(export_dir):
+    return os.path.join(export_dir, HEADER_FILE)
+
+def store_header_path(store_dir):
+    return os.path.join(store_dir, STORE_HEADER)
+
+@contextmanager
+def store_lock(store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, STORE_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def publish(dir_path, header_file, header, files):
+    # swaps the header in atomically and removes the files of older versions
+    tmp_path = os.path.join(dir_path, f'{header_file}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_path, os.path.join(dir_path, header_file))
+    for file_path in glob.glob(os.path.join(dir_path, '*.npy')):
+        if os.path.basename(file_path) not in files:
+            os.remove(file_path)
+    return sum(os.path.getsize(os.path.join(dir_path, file_name)) for file_name in files)
+
+def save_store(store, store_dir, catalog):
+    # a new version of the store in the store dir, the caller holds its lock
+    os.makedirs(store_dir, exist_ok=True)
+    version = str(time.time_ns())
+    files = {}
+    for name, array in store.state().items():
+        files[name] = f'{name}.{version}.npy'
+        np.save(os.path.join(store_dir, files[name]), array)
+    header = {'version': version,
+              'dtype': store.dtype.name,
+              'files': files,
+              'tickers': store.tickers.tolist(),
+              'catalog': catalog}
+    nbytes = publish(store_dir, STORE_HEADER, header, set(files.values()))
+    logger.info(f'Saved store: {len(store.tickers)} tickers to {store_dir}: {nbytes/2**20:.1f}MB')
+    return header
+
+def read_store_header(store_dir):
+    with open(store_header_path(store_dir)) as f:
+        return json.load(f)
+
+def map_store(store_dir, retries=3):
+    # the store saved in the store dir, every array memory mapped (nothing is
+    # read until it is used, the pages are shared with every other process
+    # mapping the same files), version and catalog from its header
+    for attempt in range(retries):
+        try:
+            header = read_store_header(store_dir)
+            state = {name: np.load(os.path.join(store_dir, file_name), mmap_mode='r')
+                     for name, file_name in header['files'].items()}
+            break
+        except FileNotFoundError:
+            # a new version replaced the files in between, read its header
+            if attempt == retries - 1:
+                raise
+    store = SharedStore.from_state(np.array(header['tickers'], dtype=object), state)
+    store.version, store.catalog = header['version'], header['catalog']
+    logger.info(f'Mapped store: {len(store.tickers)} tickers ({header["dtype"]}), version {header["version"]}')
+    return store
+
+def export_store(db_dir, export_dir, dtype=np.float64):
+    # the catalog first, an ingest while the store is read shows up as a
+    # changed entry (see Export.stale) rather than going unnoticed
+    catalog = load_catalog(db_dir)
+    store = SharedStore.load(db_dir, dtype=dtype)
+    os.makedirs(export_dir, exist_ok=True)
+    version = str(time.time_ns())
+    files = {column: f'{column}.{version}.npy' for column in COLUMNS}
+    # the dates any ticker has data on (the holidays of the business day axis
+    # of the store are left out)
+    rows = np.flatnonzero(np.diff(store.date_ptr))
+    # fortran order, every ticker is a contiguous run of its file, written
+    # a ticker at a time straight into the file
+    for column, file_name in files.items():
+        matrix = np.lib.format.open_memmap(os.path.join(export_dir, file_name), mode='w+', dtype=store.dtype,
+                                           shape=(len(rows), len(store.tickers)), fortran_order=True)
+        store.matrix(column, rows, out=matrix)
+        matrix.flush()
+    np.save(os.path.join(export_dir, f'dates.{version}.npy'), store.dates[rows])
+    header = {'version': version,
+              'shape': [len(rows), len(store.tickers)],
+              'dtype': np.dtype(dtype).name,
+              'dates': f'dates.{version}.npy',
+              'files': files,
+              'tickers': store.tickers.tolist(),
+              'catalog': {ticker: catalog[ticker] for ticker in store.tickers if ticker in catalog}}
+    nbytes = publish(export_dir, HEADER_FILE, header, set(files.values()) | {header['dates']})
+    with store_lock(os.path.join(export_dir, STORE_DIR)):
+        save_store(store, os.path.join(export_dir, STORE_DIR), catalog)
+    logger.info(f'Exported {len(store.tickers)} tickers x {len(rows)} dates to {export_dir}: '
+                f'{nbytes/2**20:.1f}MB')
+    return header
+
+class Export:
+    """
+    read only view of an export, close_px/adj_factor/c2c_ret are (dates x
+    tickers) np.memmap in fortran order (nan where a ticker has no data),
+    nothing is read until it is used and the pages are shared with every
+    other process mapping the same files
+
+        export = Export('/data/export')
+        aapl = export.c2c_ret[:, export.ticker_idx['AAPL']]
+        panel = export.frame('c2c_ret', ['AAPL', 'MSFT'], '2024-01-01', '2024-12-31')
+    """
+
+    def __init__(self, export_dir, retries=3):
+        self.export_dir = export_dir
+        for attempt in range(retries):
+            try:
+                with open(header_path(export_dir)) as f:
+                    self.header = json.load(f)
+                self.dates = np.load(os.path.join(export_dir, self.header['dates']))
+                self.arrays = {column: np.load(os.path.join(export_dir, file_name), mmap_mode='r')
+                               for column, file_name in self.header['files'].items()}
+                break
+            except FileNotFoundError:
+                # a new export replaced the files in between, read its header
+                if attempt == retries - 1:
+                    raise
+        self.tickers = np.array(self.header['tickers'], dtype=object)
+        self.ticker_idx = {ticker: i for i, ticker in enumerate(self.tickers)}
+
+    def __getattr__(self, column):
+        if column in COLUMNS:
+            return self.arrays[column]
+        raise AttributeError(column)
+
+    def store(self):
+        # the SharedStore saved with the export, mapped as it is (no parquet
+        # file is read, nothing is computed)
+        return map_store(os.path.join(self.export_dir, STORE_DIR))
+
+    def stale(self, catalog):
+        # tickers changed (or removed) in the catalog since the export
+        entries = self.header['catalog']
+        return ([ticker for ticker, entry in catalog.items() if entries.get(ticker) != entry],
+                [ticker for ticker in entries if ticker not in catalog])
+
+    def frame(self, column, tickers=None, start_date=None, end_date=None):
+        # a (dates x tickers) copy of a window, end date inclusive
+        tickers = list(self.tickers) if tickers is None else list(tickers)
+        start = 0 if start_date is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date)))
+        end = (len(self.dates) if end_date is None
+               else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end_date)), side='right'))
+        data = self.arrays[column][start:end].take([self.ticker_idx[ticker] for ticker in tickers], axis=1)
+        return pd.DataFrame(data=data, columns=tickers, index=pd.DatetimeIndex(self.dates[start:end], name='date'))
+
+@click.command()
+@click.option('--db_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='store location  [default: db_dir in app_config.yaml]')
+@click.option('--export_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='export location  [default: export_dir in app_config.yaml]')
+@click.option('--dtype',
+              type=click.Choice(['float64', 'float32']),
+              default=None,
+              required=False,
+              help='dtype of the matrices  [default: store_dtype in app_config.yaml]')
+def main(db_dir, export_dir, dtype):
+    """memory mappable export of the store"""
+    app_config = ApplicationConfig(__file__)
+    db_dir = db_dir or app_config.data.db_dir()
+    export_dir = export_dir or app_config.data.export_dir()
+    if not export_dir:
+        raise click.BadParameter("'--export_dir' is required when export_dir is not set in app_config.yaml")
+    export_store(db_dir, export_dir, dtype=dtype or app_config.data.store_dtype() or 'float64')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import io
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+from fastapi import HTTPException
+import metrics
+
+# response formats for the returns end-points, selected with ?format=...
+# or the accept header, json (records with iso dates) stays the default
+MEDIA_TYPES = {'json': 'application/json',
+               'columns': 'application/vnd.yserv.columns+json',
+               'arrow': 'application/vnd.apache.arrow.stream',
+               'csv': 'text/csv',
+               'ndjson': 'application/x-ndjson'}
+
+FORMATS = {media_type: fmt for fmt, media_type in MEDIA_TYPES.items()}
+
+def negotiate(fmt=None, accept=None):
+    if fmt:
+        if fmt not in MEDIA_TYPES:
+            raise HTTPException(status_code=406, detail=f"Format: {fmt} not supported, use one of {list(MEDIA_TYPES)}")
+        return fmt
+    # first supported media type in the accept header, ignoring q values
+    for media_type in (accept or '').split(','):
+        media_type = media_type.split(';')[0].strip()
+        if media_type in FORMATS:
+            return FORMATS[media_type]
+    return 'json'
+
+def to_json(eod_data):
+    return eod_data.reset_index().to_json(orient='records', date_format='iso').encode()
+
+def to_ndjson(eod_data):
+    # a json record per line
+    return eod_data.reset_index().to_json(orient='records', date_format='iso', lines=True).encode()
+
+def to_columns(eod_data):
+    # {"date":[epoch ms,...],"AAPL":[...],...}, nan as null
+    columns = {}
+    for column, values in eod_data.reset_index().items():
+        values = values.values
+        if np.issubdtype(values.dtype, np.datetime64):
+            values = values.astype('datetime64[ms]').astype(np.int64)
+        elif values.dtype == object:
+            values = [str(value) for value in values]
+        else:
+            values = np.ascontiguousarray(values)
+        columns[str(column)] = values
+    return orjson.dumps(columns, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def to_table(eod_data):
+    return pa.Table.from_pandas(eod_data.reset_index(), preserve_index=False)
+
+def to_arrow(eod_data):
+    table = to_table(eod_data)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def to_csv(eod_data, header=True):
+    # arrow's csv writer is an order of magnitude faster than pandas to_csv
+    table = to_table(eod_data)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+    sink = pa.BufferOutputStream()
+    pa.csv.write_csv(table, sink, pa.csv.WriteOptions(include_header=header))
+    return sink.getvalue().to_pybytes()
+
+SERIALIZERS = {'json': to_json, 'columns': to_columns, 'arrow': to_arrow, 'csv': to_csv, 'ndjson': to_ndjson}
+
+class StreamWriter:
+    """
+    incremental encoder for streamed responses, the body is the bytes of
+    write(chunk) for every chunk followed by close(), the same bytes render
+    would produce for the concatenated chunks. columns is not streamable.
+    """
+
+    def __init__(self, fmt):
+        if fmt == 'columns':
+            raise HTTPException(status_code=406, detail=f"Format: {fmt} can not be streamed")
+        self.fmt = fmt
+        self.media_type = MEDIA_TYPES[fmt]
+        self.chunks = 0
+        self.sink = None
+        self.writer = None
+
+    def write(self, eod_data):
+        with metrics.stage('serialize'):
+            first, self.chunks = self.chunks == 0, self.chunks + 1
+            if self.fmt == 'json':
+                # records of every chunk without their enclosing brackets
+                return (b'[' if first else b',') + to_json(eod_data)[1:-1]
+            if self.fmt == 'csv':
+                return to_csv(eod_data, header=first)
+            if self.fmt == 'arrow':
+                # one ipc stream, the schema once then a record batch per chunk
+                table = to_table(eod_data)
+                if first:
+                    self.sink = io.BytesIO()
+                    self.writer = pa.ipc.new_stream(self.sink, table.schema)
+                self.writer.write_table(table)
+                return self._drain()
+            return SERIALIZERS[self.fmt](eod_data)
+
+    def close(self):
+        if self.fmt == 'json':
+            return b']' if self.chunks else b'[]'
+        if self.fmt == 'arrow' and self.writer is not None:
+            self.writer.close()
+            return self._drain()
+        return b''
+
+    def _drain(self):
+        content = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return content
+
+def render(eod_data, fmt='json'):
+    with metrics.stage('serialize'):
+        return SERIALIZERS[fmt](eod_data), MEDIA_TYPES[fmt]
@@ -0,0 +1,198 @@
+import click
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import subprocess
+import requests
+import numpy as np
+import pandas as pd
+import datetime as dt
+from multiprocessing import Pool
+from synth import SyntheticSource, synthetic_tickers
+from logger import logger
+
+# reproducible end to end benchmark: generates a synthetic store, starts yserv
+# on it and runs the benchmark.py scenarios sequentially (latency) plus a wrk
+# like load test (throughput), the results are written as json so they can be
+# compared commit to commit
+
+END_DATE = dt.datetime(2025, 10, 3)
+
+def _random_tickers(rng, tickers):
+    return ','.join(np.unique(rng.choice(tickers, max(2, rng.integers(1, len(tickers))))))
+
+def _random_dates(rng, dates):
+    start_date = dates[rng.integers(0, len(dates)-5)]
+    end_date = start_date + dt.timedelta(days=max(5, int(rng.integers(0, (dates[-1] - start_date).days))))
+    return start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')
+
+# name -> (method, path, json body), mirroring the benchmark.py scenarios
+SCENARIOS = {
+    '/tickers':
+        lambda rng, t, d: ('GET', '/tickers', None),
+    '/returns/ticker/start_date/end_date':
+        lambda rng, t, d: ('GET', f'/returns/{t[0]}/{d[0]:%Y%m%d}/{d[-1]:%Y%m%d}', None),
+    '/returns/ticker/start_date/end_date[random params]':
+        lambda rng, t, d: ('GET', '/returns/{}/{}/{}'.format(rng.choice(t), *_random_dates(rng, d)), None),
+    '/returns/tickers/start_date/end_date':
+        lambda rng, t, d: ('GET', f"/returns/{','.join(t)}/{d[0]:%Y%m%d}/{d[-1]:%Y%m%d}", None),
+    '/returns/tickers/start_date/end_date[random args]':
+        lambda rng, t, d: ('GET', '/returns/{}/{}/{}'.format(_random_tickers(rng, t), *_random_dates(rng, d)), None),
+    '/returns/tickers/query_date':
+        lambda rng, t, d: ('GET', f"/returns/{','.join(t)}/{d[-35]:%Y%m%d}", None),
+    '/returns/tickers/query_date[random args]':
+        lambda rng, t, d: ('GET', f'/returns/{_random_tickers(rng, t)}/{d[rng.integers(0, len(d))]:%Y%m%d}', None),
+    '/returns/query[batch of 100 query_date][random args]':
+        lambda rng, t, d: ('POST', '/returns/query?format=columns',
+                           {'queries': [{'tickers': _random_tickers(rng, t), 'start_date': f'{d[rng.integers(0, len(d))]:%Y%m%d}'}
+                                        for i in range(100)]}),
+}
+
+# the wrk.stats.txt run and its randomized variant
+LOAD_SCENARIOS = ['/returns/tickers/start_date/end_date', '/returns/tickers/start_date/end_date[random args]']
+
+def summarize(latencies, nbytes, errors, elapsed):
+    latencies = np.array(latencies) * 1e3
+    if not len(latencies):
+        return {'requests': 0, 'errors': errors}
+    return {'requests': len(latencies),
+            'errors': errors,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p75_ms': float(np.percentile(latencies, 75)),
+            'p90_ms': float(np.percentile(latencies, 90)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max()),
+            'req_per_sec': len(latencies) / elapsed,
+            'mb_per_sec': nbytes / elapsed / 2**20}
+
+def run_requests(args):
+    # one client (a process in the load test), runs a scenario either a
+    # number of times or for a duration
+    url, name, tickers, dates, seed, count, duration = args
+    rng = np.random.default_rng(seed)
+    session = requests.Session()
+    latencies, nbytes, errors = [], 0, 0
+    start = time.perf_counter()
+    while (count and len(latencies) + errors < count) or (duration and time.perf_counter() - start < duration):
+        method, path, body = SCENARIOS[name](rng, tickers, dates)
+        t = time.perf_counter()
+        response = session.request(method, f'{url}{path}', json=body)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - t)
+            nbytes += len(response.content)
+        else:
+            errors += 1
+    return latencies, nbytes, errors, time.perf_counter() - start
+
+def generate(db_dir, tickers, years, seed):
+    from yfetch import download
+    if os.path.exists(os.path.join(db_dir, '_catalog.json')):
+        return
+    logger.info(f'Generating {tickers} synthetic tickers x {years} years in {db_dir}')
+    asyncio.run(download(','.join(synthetic_tickers(tickers)), None, END_DATE - dt.timedelta(days=365*years),
+                         END_DATE, batch=50, source=SyntheticSource(seed), db_dir=db_dir))
+
+def wait_until_up(url, timeout=120):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            if requests.get(f'{url}/tickers').status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'yserv not up at {url} after {timeout}s')
+
+def start_subprocess(db_dir, host, port, workers):
+    env = dict(os.environ, YSERV_DB_DIR=db_dir)
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yserv.py'),
+                             '--host', host, '--port', str(port), '--workers', str(workers)], env=env)
+
+def start_inprocess(db_dir, host, port):
+    # single uvicorn worker in a thread, yserv reads its db dir at import
+    os.environ['YSERV_DB_DIR'] = db_dir
+    import uvicorn
+    import yserv
+    yserv.metrics.setup()
+    if yserv.app_config.data.preload_store():
+        yserv.STORE = yserv.load_store()
+    server = uvicorn.Server(uvicorn.Config(yserv.app, host=host, port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+@click.command()
+@click.option('--tickers', type=click.INT, default=23, required=False, show_default=True,
+              help='number of synthetic tickers')
+@click.option('--years', type=click.INT, default=3, required=False, show_default=True,
+              help='years of synthetic history')
+@click.option('--seed', type=click.INT, default=0, required=False, show_default=True,
+              help='random seed (data and queries)')
+@click.option('--db_dir', type=click.STRING, default=None, required=False,
+              help='synthetic store location, generated if missing [default: a temp dir per tickers/years/seed]')
+@click.option('--mode', type=click.Choice(['subprocess', 'inprocess']), default='subprocess', required=False,
+              show_default=True, help='run yserv (gunicorn) as a subprocess or a single uvicorn worker in process')
+@click.option('--host', type=click.STRING, default='127.0.0.1', required=False, show_default=True, help='host')
+@click.option('--port', type=click.INT, default=8765, required=False, show_default=True, help='port')
+@click.option('--workers', type=click.INT, default=8, required=False, show_default=True,
+              help='yserv worker processes (subprocess mode)')
+@click.option('--repetitions', type=click.INT, default=20, required=False, show_default=True,
+              help='sequential requests per scenario')
+@click.option('--connections', type=click.INT, default=8, required=False, show_default=True,
+              help='concurrent clients in the load test')
+@click.option('--duration', type=click.FLOAT, default=10.0, required=False, show_default=True,
+              help='seconds per load test scenario, 0 to skip the load test')
+@click.option('--out', type=click.STRING, default=None, required=False,
+              help='json output file [default: stdout]')
+def main(tickers, years, seed, db_dir, mode, host, port, workers, repetitions, connections, duration, out):
+    """reproducible yserv benchmark over synthetic data"""
+    db_dir = db_dir or os.path.join(tempfile.gettempdir(), f'yserv_synth_{tickers}x{years}_{seed}')
+    generate(db_dir, tickers, years, seed)
+
+    url = f'http://{host}:{port}'
+    server = start_subprocess(db_dir, host, port, workers) if mode == 'subprocess' else start_inprocess(db_dir, host, port)
+    try:
+        wait_until_up(url)
+        names = synthetic_tickers(tickers)
+        dates = list(pd.bdate_range(END_DATE - dt.timedelta(days=365*min(years, 2)), END_DATE))
+        results = {'commit': git_commit(),
+                   'config': {'tickers': tickers, 'years': years, 'seed': seed, 'mode': mode, 'workers': workers,
+                              'repetitions': repetitions, 'connections': connections, 'duration': duration},
+                   'scenarios': {}, 'load': {}}
+        for name in SCENARIOS:
+            logger.info(f'Running {name}')
+            results['scenarios'][name] = summarize(*run_requests((url, name, names, dates, seed, repetitions, None)))
+        if duration:
+            for name in LOAD_SCENARIOS:
+                logger.info(f'Load testing {name}: {connections} connections x {duration}s')
+                with Pool(processes=connections) as pool:
+                    runs = pool.map(run_requests, [(url, name, names, dates, seed+i, None, duration)
+                                                   for i in range(connections)])
+                results['load'][name] = summarize([l for run in runs for l in run[0]], sum(run[1] for run in runs),
+                                                  sum(run[2] for run in runs), max(run[3] for run in runs))
+    finally:
+        if mode == 'subprocess':
+            server.terminate()
+            server.wait()
+        else:
+            server.should_exit = True
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+
+if __name__ == "__main__":
+    main()
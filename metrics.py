@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import shutil
+import atexit
+import tempfile
+import threading
+from collections import Counter as Tally
+from contextlib import contextmanager
+from logger import logger
+
+# gunicorn workers are separate processes, prometheus_client multiprocess
+# mode keeps every worker's values in mmap'ed files of a shared dir which
+# /metrics aggregates, the dir has to be known before any metric is created.
+# only the server sets it up (setup, in yserv main before the workers are
+# forked), until then stage/cache record nothing, so the offline tools
+# importing the store never touch the environment or create the dir
+METRICS_DIR = None
+_OWNER = None
+
+STAGE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+CACHE_REQUESTS = STAGE_SECONDS = REQUEST_SECONDS = RESPONSE_BYTES = WORKER_RSS = None
+
+def setup():
+    global METRICS_DIR, _OWNER, CACHE_REQUESTS, STAGE_SECONDS, REQUEST_SECONDS, RESPONSE_BYTES, WORKER_RSS
+    if METRICS_DIR is not None:
+        return METRICS_DIR
+    _OWNER = os.getpid()
+    METRICS_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                        os.path.join(tempfile.gettempdir(), f'yserv_metrics_{_OWNER}'))
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    atexit.register(_cleanup)
+    # imported once the dir is set, prometheus_client picks the multiprocess
+    # values on import
+    from prometheus_client import Counter, Gauge, Histogram
+
+    CACHE_REQUESTS = Counter('yserv_cache_requests_total', 'cache lookups', ['cache', 'result'])
+    STAGE_SECONDS = Histogram('yserv_stage_seconds', 'time spent per stage', ['stage'], buckets=STAGE_BUCKETS)
+    REQUEST_SECONDS = Histogram('yserv_request_seconds', 'request latency (incl. gzip)',
+                                ['endpoint', 'method', 'status'], buckets=STAGE_BUCKETS)
+    RESPONSE_BYTES = Counter('yserv_response_bytes_total', 'bytes served (after gzip)', ['endpoint'])
+    WORKER_RSS = Gauge('yserv_worker_rss_bytes', 'resident set size per worker', multiprocess_mode='all')
+    return METRICS_DIR
+
+def reset():
+    # called in the gunicorn master before forking, drops the files of
+    # a previous run using the same dir
+    for name in os.listdir(METRICS_DIR):
+        os.remove(os.path.join(METRICS_DIR, name))
+
+def _cleanup():
+    if os.getpid() == _OWNER and METRICS_DIR.startswith(os.path.join(tempfile.gettempdir(), 'yserv_metrics_')):
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+def worker_exit(pid):
+    # gunicorn child_exit hook, stops reporting live gauges of dead workers
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(pid)
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def latest():
+    setup()
+    from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+    WORKER_RSS.set(rss())
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def cache(name, hit):
+    # hit None: a miss waiting on the load another request already started
+    if CACHE_REQUESTS is None:
+        return
+    CACHE_REQUESTS.labels(name, 'shared' if hit is None else 'hit' if hit else 'miss').inc()
+
+@contextmanager
+def stage(name):
+    if STAGE_SECONDS is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+class MetricsMiddleware:
+    """
+    asgi middleware timing requests, added twice: once inside the gzip
+    middleware (inner=True) timing the handler and once outside timing the
+    whole request, the difference is accounted as the gzip stage
+    """
+
+    def __init__(self, app, inner=False, rss_secs=5.0):
+        self.app = app
+        self.inner = inner
+        self.rss_secs = rss_secs
+        self.rss_checked = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status, nbytes = [500], [0]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            elif message['type'] == 'http.response.body':
+                nbytes[0] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.inner:
+                scope['yserv.handler_seconds'] = elapsed
+            elif REQUEST_SECONDS is not None:
+                route = scope.get('route')
+                endpoint = route.path if route is not None else 'unmatched'
+                REQUEST_SECONDS.labels(endpoint, scope['method'], str(status[0])).observe(elapsed)
+                RESPONSE_BYTES.labels(endpoint).inc(nbytes[0])
+                if 'yserv.handler_seconds' in scope:
+                    STAGE_SECONDS.labels('gzip').observe(max(0.0, elapsed - scope['yserv.handler_seconds']))
+                if start - self.rss_checked > self.rss_secs:
+                    self.rss_checked = start
+                    WORKER_RSS.set(rss())
+
+class Profiler:
+    """
+    opt-in sampling profiler, a thread samples the stack of the main thread
+    (where the event loop runs) every interval and periodically writes the
+    counts in collapsed stack format, one file per worker, ready for
+    flamegraph.pl or speedscope
+    """
+
+    def __init__(self, out_dir, interval=0.005, flush_secs=10.0):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.flush_secs = flush_secs
+        self.stacks = Tally()
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.running = True
+        self.thread_id = threading.main_thread().ident
+        threading.Thread(target=self._run, daemon=True).start()
+        logger.info(f'Sampling profiler started, writing to {self.out_dir}')
+
+    def stop(self):
+        self.running = False
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        flushed = time.monotonic()
+        while self.running:
+            self._sample()
+            time.sleep(self.interval)
+            if time.monotonic() - flushed > self.flush_secs:
+                flushed = time.monotonic()
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        path = os.path.join(self.out_dir, f'profile.{os.getpid()}.collapsed')
+        with open(f'{path}.tmp', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        os.replace(f'{path}.tmp', path)
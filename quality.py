@@ -0,0 +1,208 @@
+import click
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import datetime as dt
+from utils import *
+from logger import logger
+
+# data quality checks over a wide (dates x tickers) matrix, run once over
+# everything a yfetch run wrote (see yfetch.download) or over the whole store
+# (./quality), the flagged rows come back as a report in long format
+# (date, ticker, check, value, lower, upper) written as parquet or json
+#
+#   gap:            days since the previous row of the ticker >= max_gap_days
+#   outlier:        c2c return outside mean +/- outlier_sigmas std of the
+#                   previous outlier_window returns of the ticker, and the
+#                   row before it
+#   stale:          close unchanged (zero return) for stale_days days, and
+#                   the row before it
+#   market_outlier: return further than market_sigmas cross sectional
+#                   dispersions (scaled mad) from the market (cross sectional
+#                   median), on days with at least market_min_tickers tickers
+#   against_market: the market moved by market_move or more and the ticker
+#                   moved the other way by more than market_sigmas dispersions
+THRESHOLDS = {'max_gap_days': 5,
+              'outlier_window': 5,
+              'outlier_sigmas': 5.0,
+              'stale_days': 1,
+              'market_sigmas': 5.0,
+              'market_move': 0.02,
+              'market_min_tickers': 10}
+
+CHECKS = ['gap', 'outlier', 'stale', 'market_outlier', 'against_market']
+
+REPORT_COLUMNS = ['date', 'ticker', 'check', 'value', 'lower', 'upper']
+
+def thresholds(overrides=None):
+    return dict(THRESHOLDS, **{key: value for key, value in (overrides or {}).items() if value is not None})
+
+def lookback_rows(limits):
+    # rows before the new data the rolling checks need
+    return max(limits['outlier_window'], limits['stale_days']) + 1
+
+def panel(frames):
+    # {ticker: frame(close_px, adj_factor[, new])} -> dates, tickers and the
+    # (dates x tickers) close, adj_factor and new matrices (nan/False where a
+    # ticker has no row)
+    frames = {ticker: eod_data for ticker, eod_data in frames.items() if not eod_data.empty}
+    tickers = np.array(sorted(frames), dtype=object)
+    if not len(tickers):
+        empty = np.empty((0, 0))
+        return np.array([], dtype='datetime64[ns]'), tickers, empty, empty, empty.astype(bool)
+    wide = pd.concat({ticker: frames[ticker] for ticker in tickers}, axis=1, sort=True)
+    close = wide.xs('close_px', level=1, axis=1).to_numpy(dtype=np.float64)
+    adj_factor = wide.xs('adj_factor', level=1, axis=1).to_numpy(dtype=np.float64)
+    if 'new' in wide.columns.get_level_values(1):
+        new = wide.xs('new', level=1, axis=1).eq(True).to_numpy()
+    else:
+        new = np.isfinite(close)
+    return wide.index.values, tickers, close, adj_factor, new
+
+def _packed(valid):
+    # the rows of every column reordered so that the valid ones come first
+    # (in date order), rolling over the packed matrix is rolling over each
+    # ticker's own rows whatever the holes in the shared date axis
+    return np.argsort(~valid, axis=0, kind='stable')
+
+def _unpack(packed, order, fill):
+    out = np.full(packed.shape, fill, dtype=packed.dtype)
+    np.put_along_axis(out, order, packed, axis=0)
+    return out
+
+def _with_previous(p_flagged):
+    # the row before every flagged row of a ticker flagged too, the move
+    # shows between the two
+    p_flagged = p_flagged.copy()
+    p_flagged[:-1] |= p_flagged[1:]
+    return p_flagged
+
+def check(dates, tickers, close, adj_factor, new=None, limits=None):
+    """runs all the checks, only cells flagged in new (default all) are reported"""
+    limits = thresholds(limits)
+    valid = np.isfinite(close)
+    new = valid if new is None else new & valid
+    if not new.any():
+        return pd.DataFrame({column: [] for column in REPORT_COLUMNS})
+
+    order = _packed(valid)
+    p_valid = np.take_along_axis(valid, order, axis=0)
+    p_close = np.take_along_axis(close, order, axis=0)
+    p_adj = np.take_along_axis(np.where(np.isfinite(adj_factor), adj_factor, 1.0), order, axis=0)
+    p_dates = dates[order]
+
+    # per ticker c2c return, adj_factor on t-1 adjusts the previous close
+    p_ret = np.full(p_close.shape, np.nan)
+    p_ret[1:] = p_close[1:] / (p_close[:-1] * p_adj[:-1]) - 1.0
+    p_ret[~p_valid] = np.nan
+
+    flags = []
+
+    # gaps between consecutive rows of a ticker
+    p_gap = np.full(p_close.shape, np.nan)
+    p_gap[1:] = (p_dates[1:] - p_dates[:-1]) / np.timedelta64(1, 'D')
+    p_gap[~p_valid] = np.nan
+    gap = _unpack(p_gap, order, np.nan)
+    flags.append(('gap', gap >= limits['max_gap_days'], gap, np.nan, limits['max_gap_days']))
+
+    # rolling mean/std of the previous outlier_window returns
+    window = limits['outlier_window']
+    prev = pd.DataFrame(p_ret).shift(1).rolling(window)
+    p_mu, p_sd = prev.mean().to_numpy(), prev.std().to_numpy()
+    ret = _unpack(p_ret, order, np.nan)
+    lower, upper = p_mu - limits['outlier_sigmas'] * p_sd, p_mu + limits['outlier_sigmas'] * p_sd
+    p_outlier = (p_ret < lower) | (p_ret > upper)
+    lower, upper = _unpack(lower, order, np.nan), _unpack(upper, order, np.nan)
+    flags.append(('outlier', _unpack(_with_previous(p_outlier), order, False), ret, lower, upper))
+
+    # zero returns for stale_days rows in a row
+    p_stale = p_ret == 0.0
+    for lag in range(1, limits['stale_days']):
+        p_stale[lag:] &= p_ret[:-lag] == 0.0
+        p_stale[:lag] = False
+    flags.append(('stale', _unpack(_with_previous(p_stale), order, False), ret, np.nan, np.nan))
+
+    # cross sectional, the market is the median return of the day and its
+    # dispersion the scaled median absolute deviation
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        market = np.nanmedian(ret, axis=1, keepdims=True)
+        dispersion = 1.4826 * np.nanmedian(np.abs(ret - market), axis=1, keepdims=True)
+    enough = (np.isfinite(ret).sum(axis=1, keepdims=True) >= limits['market_min_tickers']) & (dispersion > 0)
+    band = limits['market_sigmas'] * dispersion
+    lower, upper = market - band, market + band
+    away = enough & ((ret < lower) | (ret > upper))
+    flags.append(('market_outlier', away, ret, lower, upper))
+    against = away & (np.abs(market) >= limits['market_move']) & (np.sign(ret) == -np.sign(market))
+    flags.append(('against_market', against, ret, lower, upper))
+
+    report = []
+    for name, flagged, value, lower, upper in flags:
+        rows, cols = np.nonzero(flagged & new)
+        report.append(pd.DataFrame({'date': dates[rows],
+                                    'ticker': tickers[cols],
+                                    'check': name,
+                                    'value': np.broadcast_to(value, close.shape)[rows, cols],
+                                    'lower': np.broadcast_to(lower, close.shape)[rows, cols],
+                                    'upper': np.broadcast_to(upper, close.shape)[rows, cols]}))
+    report = pd.concat(report, ignore_index=True)
+    return report.sort_values(['date', 'ticker', 'check'], kind='stable', ignore_index=True)
+
+def check_frames(frames, limits=None):
+    return check(*panel(frames), limits=limits)
+
+def summarize(report, max_tickers=10):
+    # one log line per check instead of a frame per ticker
+    for name, flagged in report.groupby('check', sort=False):
+        tickers = flagged['ticker'].value_counts()
+        listed = ', '.join(f'{ticker}({count})' for ticker, count in tickers.iloc[:max_tickers].items())
+        more = f' +{len(tickers) - max_tickers} more' if len(tickers) > max_tickers else ''
+        logger.warning(f'Quality {name}: {len(flagged)} rows, {len(tickers)} tickers: {listed}{more}')
+
+def save_report(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if path.endswith('.json'):
+        report.to_json(path, orient='records', date_format='iso')
+    else:
+        report.to_parquet(path, index=False)
+    logger.info(f'Quality report: {len(report)} rows written to {path}')
+
+def report_path(db_dir, report_dir=None):
+    # {db_dir}/_quality/{timestamp}.parquet by default
+    report_dir = report_dir or os.path.join(db_dir, '_quality')
+    return os.path.join(report_dir, f'{dt.datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.parquet')
+
+@click.command()
+@click.option('--db_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='store location  [default: db_dir in app_config.yaml]')
+@click.option('--start_date',
+              type=click.DateTime(formats=valid_date_formats),
+              default=None,
+              required=False,
+              help='only report rows from this date on (earlier rows are still used by the rolling checks)')
+@click.option('--out',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='report file, .parquet or .json  [default: {db_dir}/_quality/{timestamp}.parquet]')
+def main(db_dir, start_date, out):
+    """data quality checks over the whole store"""
+    from store import read_all
+    app_config = ApplicationConfig(__file__)
+    db_dir = db_dir or app_config.data.db_dir()
+    limits = thresholds(app_config.data.quality())
+    frames = read_all(db_dir, columns=['close_px', 'adj_factor'])
+    dates, tickers, close, adj_factor, new = panel(frames)
+    if start_date:
+        new &= (dates >= np.datetime64(start_date))[:, None]
+    logger.info(f'Checking {len(tickers)} tickers x {len(dates)} dates')
+    report = check(dates, tickers, close, adj_factor, new, limits=limits)
+    summarize(report)
+    save_report(report, out or report_path(db_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,773 @@
+import os
+import json
+import asyncio
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from logger import logger
+from utils import ByteLRUCache
+from analytics import prefix_sums, prefix_products, backward_adjustment, split_factors, window_summary
+import metrics
+
+# the store has two layouts, recorded in {db_dir}/_layout.json (see compact.py):
+#   per_ticker: {db_dir}/{ticker}/{year}.parquet, what yfetch writes
+#   yearly:     {db_dir}/_yearly/{year}.{n}.parquet, all tickers of a year in
+#               one file sorted by (ticker, date) with a row group per ticker,
+#               the layout file maps year -> file and ticker -> row group
+# with the yearly layout any {ticker}/{year}.parquet written by yfetch since
+# the last compaction takes precedence over the row group of that year.
+# in either layout yfetch (upsert_mode: delta) appends new rows as
+# {ticker}/{year}.delta.{seq}.parquet, readers apply the deltas of a partition
+# in seq order on top of it until they are merged back (see merge_deltas)
+LAYOUT_FILE = '_layout.json'
+YEARLY_DIR = '_yearly'
+CODECS = ['gzip', 'zstd', 'lz4', 'snappy', 'none']
+DEFAULT_LAYOUT = {'layout': 'per_ticker', 'codec': 'gzip', 'years': {}}
+
+_LAYOUTS = {}
+
+def layout_path(db_dir):
+    return os.path.join(db_dir, LAYOUT_FILE)
+
+def read_layout(db_dir):
+    # cached on the mtime, the file is only ever replaced atomically
+    try:
+        mtime = os.stat(layout_path(db_dir)).st_mtime_ns
+    except FileNotFoundError:
+        return DEFAULT_LAYOUT
+    cached = _LAYOUTS.get(db_dir)
+    if cached is None or cached[0] != mtime:
+        with open(layout_path(db_dir)) as f:
+            cached = (mtime, dict(DEFAULT_LAYOUT, **json.load(f)))
+        _LAYOUTS[db_dir] = cached
+    return cached[1]
+
+def save_layout(db_dir, layout):
+    path = layout_path(db_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(layout, f)
+    os.replace(tmp_path, path)
+
+def compression(codec):
+    return None if codec == 'none' else codec
+
+@lru_cache(maxsize=256)
+def yearly_metadata(file_path):
+    # yearly files are never rewritten in place (a new one gets a new name)
+    # so their footers can be cached by path
+    return pq.ParquetFile(file_path).metadata
+
+def yearly_file(db_dir, ticker, year):
+    # (path, row group) of a ticker in the yearly file of a year, or None
+    entry = read_layout(db_dir)['years'].get(str(year))
+    if entry is None or ticker not in entry['tickers']:
+        return None
+    return os.path.join(db_dir, YEARLY_DIR, entry['file']), entry['tickers'][ticker]
+
+def ticker_dirs(db_dir):
+    # every sub directory of the db dir is a ticker, anything starting with
+    # '_' or '.' is reserved for internal files/dirs, plus the tickers of
+    # the yearly files
+    path = Path(db_dir)
+    if not path.exists():
+        return []
+    tickers = {p.name for p in path.glob("*") if p.is_dir() and p.name[0] not in '_.'}
+    for entry in read_layout(db_dir)['years'].values():
+        tickers.update(entry['tickers'])
+    return sorted(tickers)
+
+def ticker_files(db_dir, ticker):
+    # yearly partitions {db_dir}/{ticker}/{year}.parquet sorted by year
+    path = Path(os.path.join(db_dir, f'{ticker}'))
+    return sorted(p for p in path.glob("*.parquet") if p.stem.isdigit())
+
+def delta_seq(file_path):
+    year, _, seq, _ = file_path.name.split('.')
+    return int(year), int(seq)
+
+def delta_files(db_dir, ticker, year=None):
+    # deltas of a ticker (or of one of its partitions) in write order
+    path = Path(os.path.join(db_dir, f'{ticker}'))
+    pattern = '*.delta.*.parquet' if year is None else f'{year}.delta.*.parquet'
+    return sorted(path.glob(pattern), key=delta_seq)
+
+def delta_path(db_dir, ticker, year):
+    deltas = delta_files(db_dir, ticker, year)
+    seq = delta_seq(deltas[-1])[1] + 1 if deltas else 0
+    return os.path.join(db_dir, f'{ticker}', f'{year}.delta.{seq}.parquet')
+
+def ticker_years(db_dir, ticker):
+    years = {int(file_path.stem) for file_path in ticker_files(db_dir, ticker)}
+    years.update(delta_seq(file_path)[0] for file_path in delta_files(db_dir, ticker))
+    years.update(int(year) for year, entry in read_layout(db_dir)['years'].items() if ticker in entry['tickers'])
+    return sorted(years)
+
+def file_columns(parquet_file, columns):
+    # the columns asked for that the file has, files written before a column
+    # was added (split_ratio) lack it, see with_columns
+    names = parquet_file.schema_arrow.names
+    return None if columns is None else [column for column in columns if column in names]
+
+def with_columns(eod_data, columns):
+    # a column a file lacks reads back as nan
+    if columns is None or len(eod_data.columns) == len(columns):
+        return eod_data
+    return eod_data.reindex(columns=columns)
+
+def read_parquet(file_path, columns=None):
+    # same frame as pd.read_parquet (the date index is restored from the
+    # pandas metadata) without the dataset layer, ~2x faster on small files
+    parquet_file = pq.ParquetFile(file_path)
+    table = parquet_file.read(columns=file_columns(parquet_file, columns), use_pandas_metadata=True)
+    return with_columns(table.to_pandas(), columns)
+
+def read_dates(file_path, row_group=None):
+    parquet_file = pq.ParquetFile(file_path, metadata=yearly_metadata(file_path) if row_group is not None else None)
+    table = (parquet_file.read(columns=['date']) if row_group is None
+             else parquet_file.read_row_group(row_group, columns=['date']))
+    return table.column('date').to_numpy()
+
+def read_row_group(file_path, row_group, columns=None):
+    parquet_file = pq.ParquetFile(file_path, metadata=yearly_metadata(file_path))
+    present = file_columns(parquet_file, columns)
+    table = parquet_file.read_row_group(row_group, columns=None if present is None else ['date'] + present)
+    if 'ticker' in table.column_names:
+        table = table.drop_columns(['ticker'])
+    # the date index is restored from the pandas metadata
+    return with_columns(table.to_pandas(), columns)
+
+def read_base(db_dir, ticker, year, columns=None):
+    # the partition without its deltas, None if there is none
+    file_path = os.path.join(db_dir, f'{ticker}', f'{year}.parquet')
+    if os.path.exists(file_path):
+        return read_parquet(file_path, columns=columns)
+    yearly = yearly_file(db_dir, ticker, year)
+    if yearly is None:
+        return None
+    return read_row_group(*yearly, columns=columns)
+
+def apply_deltas(eod_data, file_paths, columns=None):
+    # a date in a later delta replaces the same date in the partition or in
+    # an earlier delta
+    if not file_paths:
+        return eod_data
+    frames = [] if eod_data is None else [eod_data]
+    frames += [read_parquet(file_path, columns=columns) for file_path in file_paths]
+    eod_data = pd.concat(frames, sort=False, copy=False)
+    return eod_data[~eod_data.index.duplicated(keep='last')].sort_index()
+
+def read_partition(db_dir, ticker, year, columns=None, retries=3):
+    # the deltas are listed before the base is read, a merge_deltas in
+    # between has folded them into the base (applying them again changes
+    # nothing), one that already removed them (or a compact that removed the
+    # base) fails the read and it starts over
+    for attempt in range(retries):
+        deltas = delta_files(db_dir, ticker, year)
+        try:
+            eod_data = apply_deltas(read_base(db_dir, ticker, year, columns=columns), deltas, columns=columns)
+            break
+        except FileNotFoundError:
+            if attempt == retries - 1:
+                raise
+    if eod_data is None:
+        raise FileNotFoundError(f'No {year} partition for {ticker} in {db_dir}')
+    return eod_data
+
+def row_group_dates(metadata, row_group):
+    # (first date, last date, rows) of a row group from the statistics of its
+    # date column, the dates are None when it has none
+    stats = metadata.row_group(row_group).column(metadata.schema.names.index('date')).statistics
+    rows = metadata.row_group(row_group).num_rows
+    if stats is None or not stats.has_min_max:
+        return None, None, rows
+    return pd.Timestamp(stats.min), pd.Timestamp(stats.max), rows
+
+def partition_files(db_dir, ticker, year):
+    # the (open parquet file, row group) of a partition in write order, the
+    # row groups of its file (or its row group of the yearly file) then its
+    # deltas, reading from the open files sees them as they were listed
+    deltas = delta_files(db_dir, ticker, year)
+    file_path = os.path.join(db_dir, f'{ticker}', f'{year}.parquet')
+    if os.path.exists(file_path):
+        parquet_file = pq.ParquetFile(file_path)
+        parts = [(parquet_file, row_group) for row_group in range(parquet_file.metadata.num_row_groups)]
+    elif (yearly := yearly_file(db_dir, ticker, year)) is not None:
+        parts = [(pq.ParquetFile(yearly[0], metadata=yearly_metadata(yearly[0])), yearly[1])]
+    else:
+        parts = []
+    return parts + [(pq.ParquetFile(file_path), 0) for file_path in deltas]
+
+def read_tail(db_dir, ticker, year, end_date, rows, columns=None, retries=3):
+    # the last rows of a partition before end_date, without reading all of
+    # it: the row groups (of its file and deltas) that may hold one of them
+    # going by the date statistics of their footers, latest dates first until
+    # the next one only has dates older than the rows found
+    end_date = pd.Timestamp(end_date)
+    for attempt in range(retries):
+        try:
+            parts = partition_files(db_dir, ticker, year)
+            order = []
+            for i, (parquet_file, row_group) in enumerate(parts):
+                first, last, _ = row_group_dates(parquet_file.metadata, row_group)
+                if first is None or first < end_date:
+                    order.append((end_date if last is None else min(last, end_date), i))
+            found, dates = {}, np.array([], dtype='datetime64[ns]')
+            for last, i in sorted(order, reverse=True):
+                if len(dates) >= rows and last < dates[-rows]:
+                    break
+                parquet_file, row_group = parts[i]
+                present = file_columns(parquet_file, columns)
+                table = parquet_file.read_row_group(row_group, columns=None if present is None else ['date'] + present,
+                                                    use_pandas_metadata=True)
+                if 'ticker' in table.column_names:
+                    table = table.drop_columns(['ticker'])
+                eod_data = with_columns(table.to_pandas(), columns)
+                found[i] = eod_data.loc[eod_data.index < end_date]
+                dates = np.union1d(dates, found[i].index.values)
+            break
+        except FileNotFoundError:
+            # a merge_deltas (or compact) removed a file in between
+            if attempt == retries - 1:
+                raise
+    if not found:
+        return None
+    # a date in a later file replaces the same date in an earlier one
+    eod_data = pd.concat([found[i] for i in sorted(found)], sort=False, copy=False)
+    return eod_data[~eod_data.index.duplicated(keep='last')].sort_index().iloc[-rows:]
+
+def read_ticker(db_dir, ticker, columns=None):
+    years = ticker_years(db_dir, ticker)
+    if not years:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([read_partition(db_dir, ticker, year, columns=columns)
+                     for year in years], sort=False, copy=False)
+
+def read_all(db_dir, columns=None):
+    # every ticker of the store, a yearly file is read in one go (one open
+    # per year instead of one per ticker and year)
+    tickers = ticker_dirs(db_dir)
+    layout = read_layout(db_dir)
+    if not layout['years']:
+        return {ticker: read_ticker(db_dir, ticker, columns=columns) for ticker in tickers}
+
+    yearly = {}
+    for year, entry in layout['years'].items():
+        table = pq.read_table(os.path.join(db_dir, YEARLY_DIR, entry['file']),
+                              columns=None if columns is None else ['ticker', 'date'] + list(columns))
+        for ticker, eod_data in table.to_pandas().groupby('ticker', observed=True, sort=False):
+            yearly[(ticker, int(year))] = eod_data.drop(columns=['ticker'])
+
+    data = {}
+    for ticker in tickers:
+        parts = []
+        for year in ticker_years(db_dir, ticker):
+            # per ticker files written since the compaction win
+            file_path = os.path.join(db_dir, f'{ticker}', f'{year}.parquet')
+            eod_data = (read_parquet(file_path, columns=columns) if os.path.exists(file_path)
+                        else yearly.get((ticker, year)))
+            parts.append(apply_deltas(eod_data, delta_files(db_dir, ticker, year), columns=columns))
+        data[ticker] = pd.concat(parts, sort=False, copy=False) if parts else pd.DataFrame(columns=columns)
+    return data
+
+def write_parquet(eod_data, file_path, codec):
+    # temp file + rename, readers (yserv, the catalog) never see a partial file
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    eod_data.to_parquet(tmp_path, index=True, compression=compression(codec))
+    os.replace(tmp_path, file_path)
+
+def merge_deltas(db_dir, ticker, year, codec):
+    # folds the deltas of a partition into {ticker}/{year}.parquet, the
+    # deltas are only removed once the merged file is in place (applying them
+    # again on top of it changes nothing)
+    deltas = delta_files(db_dir, ticker, year)
+    write_parquet(read_partition(db_dir, ticker, year), os.path.join(db_dir, f'{ticker}', f'{year}.parquet'), codec)
+    for file_path in deltas:
+        file_path.unlink()
+
+def c2c_ret(close_px, adj_factor):
+    # close to close return, adj_factor on t-1 adjusts the previous close
+    # for any splits/dividends effective on t
+    ret = (close_px.ffill() / (close_px.multiply(adj_factor, axis='rows')).ffill().shift(1)) - 1.0
+    return ret.fillna(0.0)
+
+PRICE_COLUMNS = ['open_px', 'high_px', 'low_px', 'close_px', 'volume']
+# what the backward adjustment of the prices reads
+ADJUST_COLUMNS = ['adj_factor', 'split_ratio']
+
+def adjust_prices(eod_data, factors, splits):
+    # prices times the backward adjustment, volume divided by the split part
+    # of it only (as yahoo does), dividends do not change the share count
+    adjusted = eod_data.mul(factors, axis='rows')
+    if 'volume' in adjusted:
+        adjusted['volume'] = eod_data['volume'] / splits
+    return adjusted
+
+# business day ordinals: days since 1970-01-01 not counting the weekends, the
+# date axis of the SharedStore is a range of them
+BDAY_EPOCH = np.datetime64('1970-01-01', 'D')
+
+def bday_ordinals(dates):
+    # ordinal of each date, a weekend date gets the one of the next monday
+    dates = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[D]')
+    return np.busday_count(BDAY_EPOCH, dates).astype(np.int32)
+
+def bday_dates(ordinals):
+    return np.busday_offset(BDAY_EPOCH, ordinals).astype('datetime64[ns]')
+
+class SharedStore:
+    """
+    columnar store of close_px, adj_factor and c2c_ret for all tickers
+
+    the date axis is a range of business days (int32 ordinals, see
+    bday_ordinals) shared by all tickers, the history of a ticker is a run of
+    it from its first to its last row (nan on the holidays in between),
+    lengths[i] values at offsets[i] of 1-d arrays holding the runs of all the
+    tickers back to back. a short history only takes its own rows (no
+    padding to a common date range, no index per ticker). the store is built
+    once in the gunicorn master before the workers are forked, the workers
+    only ever read the arrays so the pages stay shared between all of them
+    (copy on write).
+
+    with dtype float32 the arrays are stored in single precision (c2c_ret is
+    computed in float64 before it is rounded), the prefix sums/products are
+    still accumulated in float64 and every read is upcast to float64, so
+    responses keep their schema and only carry the rounding of the stored
+    values (a relative error of at most 2**-24, about 6e-8).
+    """
+
+    columns = ['close_px', 'adj_factor', 'c2c_ret']
+    # version of the export the arrays were mapped from (see export.py) and
+    # the catalog they were loaded from (see yserv.load_store)
+    version = None
+    catalog = None
+
+    def __init__(self, tickers, starts, lengths, arrays, prefix=None, adj_prefix=None, by_date=None):
+        self.tickers = tickers
+        self.ticker_idx = {ticker: i for i, ticker in enumerate(tickers)}
+        self.dtype = arrays['c2c_ret'].dtype
+        self.starts = np.asanyarray(starts, dtype=np.int32)
+        self.lengths = np.asanyarray(lengths, dtype=np.int32)
+        self.offsets = np.zeros(len(tickers) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.origin = int(self.starts.min()) if len(tickers) else 0
+        self.dates = bday_dates(np.arange(self.origin, int((self.starts + self.lengths).max()) if len(tickers)
+                                          else self.origin, dtype=np.int32))
+        self.close_px = arrays['close_px']
+        self.adj_factor = arrays['adj_factor']
+        self.c2c_ret = arrays['c2c_ret']
+        # prefix sums of the returns for O(1) window aggregates and prefix
+        # products of adj_factor (adjusted prices of any window are a
+        # division of two rows), a run of lengths[i] + 1 rows per ticker
+        # starting at offsets[i] + i
+        if prefix is None:
+            prefix, adj_prefix = self._prefixes()
+        self.prefix = prefix
+        self.adj_prefix = adj_prefix
+        if by_date is None:
+            by_date = self._index_dates()
+        self.date_ptr, self.date_cols, self.date_values = by_date
+
+    def _prefixes(self):
+        size = self.offsets[-1] + len(self.tickers)
+        prefix = {'n': np.empty(size, dtype=np.int32), 'sum': np.empty(size), 'sq': np.empty(size),
+                  'log': np.empty(size)}
+        adj_prefix = np.empty(size)
+        for i in range(len(self.tickers)):
+            run = slice(self.offsets[i], self.offsets[i+1])
+            target = slice(self.offsets[i] + i, self.offsets[i+1] + i + 1)
+            for key, values in prefix_sums(self.c2c_ret[run]).items():
+                prefix[key][target] = values
+            adj_prefix[target] = prefix_products(self.adj_factor[run])
+        return prefix, adj_prefix
+
+    def _index_dates(self):
+        # date major copy of close_px and c2c_ret: the tickers trading on a
+        # date (in ticker order) are date_cols[date_ptr[row]:date_ptr[row+1]]
+        # and their values the same rows of date_values, the cross section of
+        # a date is one contiguous read
+        tickers = np.repeat(np.arange(len(self.tickers), dtype=np.int32), self.lengths)
+        rows = (np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], self.lengths)
+                + np.repeat(self.starts - self.origin, self.lengths))
+        positions = np.flatnonzero(np.isfinite(self.close_px))
+        # a stable sort keeps the ticker order within a date
+        positions = positions[np.argsort(rows[positions], kind='stable')]
+        date_values = np.empty((len(positions), 2), dtype=self.dtype)
+        date_values[:, 0], date_values[:, 1] = self.close_px[positions], self.c2c_ret[positions]
+        date_ptr = np.zeros(len(self.dates) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[positions], minlength=len(self.dates)), out=date_ptr[1:])
+        return date_ptr, tickers[positions], date_values
+
+    def state(self):
+        # every array of the store by name, the values, the prefix sums and
+        # the date major copy, see from_state
+        state = {'starts': self.starts, 'lengths': self.lengths}
+        state.update({column: getattr(self, column) for column in self.columns})
+        state.update({f'prefix_{key}': prefix for key, prefix in self.prefix.items()})
+        state.update(adj_prefix=self.adj_prefix, date_ptr=self.date_ptr, date_cols=self.date_cols,
+                     date_values=self.date_values)
+        return state
+
+    @classmethod
+    def from_state(cls, tickers, state):
+        # the store on arrays saved from state() (eg. memory mapped, see
+        # export.map_store), nothing is computed
+        return cls(tickers, state['starts'], state['lengths'], {column: state[column] for column in cls.columns},
+                   prefix={key[len('prefix_'):]: array for key, array in state.items() if key.startswith('prefix_')},
+                   adj_prefix=state['adj_prefix'],
+                   by_date=(state['date_ptr'], state['date_cols'], state['date_values']))
+
+    @classmethod
+    def load(cls, db_dir, dtype=np.float64):
+        data = read_all(db_dir, columns=['close_px', 'adj_factor'])
+        store = cls.from_frames({ticker: cls.returns_frame(eod_data) for ticker, eod_data in data.items()},
+                                dtype=dtype)
+        logger.info(f'Loaded store: {len(store.tickers)} tickers, {store.offsets[-1]} rows on {len(store.dates)} '
+                    f'business days ({np.dtype(dtype).name}), {store.nbytes/2**20:.1f}MB')
+        return store
+
+    @staticmethod
+    def returns_frame(eod_data):
+        if not eod_data.empty:
+            eod_data['c2c_ret'] = c2c_ret(eod_data['close_px'], eod_data['adj_factor'])
+        return eod_data
+
+    @classmethod
+    def read(cls, db_dir, ticker):
+        return cls.returns_frame(read_ticker(db_dir, ticker, columns=['close_px', 'adj_factor']))
+
+    @classmethod
+    def from_runs(cls, tickers, runs, dtype=np.float64):
+        # runs are the (sorted) ordinals of the rows of each ticker and the
+        # values of every column on them
+        starts = np.array([ordinals[0] for ordinals, _ in runs], dtype=np.int32)
+        lengths = np.array([ordinals[-1] - ordinals[0] + 1 for ordinals, _ in runs], dtype=np.int32)
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        arrays = {column: np.full(offsets[-1], np.nan, dtype=dtype) for column in cls.columns}
+        for i, (ordinals, values) in enumerate(runs):
+            positions = offsets[i] + ordinals - starts[i]
+            for column in cls.columns:
+                arrays[column][positions] = values[column]
+        return cls(np.array(tickers, dtype=object), starts, lengths, arrays)
+
+    @classmethod
+    def from_frames(cls, data, dtype=np.float64):
+        # the axis only has business days, yfetch never writes weekend rows
+        data = {ticker: eod_data[eod_data.index.dayofweek < 5] for ticker, eod_data in sorted(data.items())
+                if not eod_data.empty}
+        data = {ticker: eod_data for ticker, eod_data in data.items() if not eod_data.empty}
+        return cls.from_runs(list(data), [(bday_ordinals(eod_data.index.values),
+                                           {column: eod_data[column].values for column in cls.columns})
+                                          for eod_data in data.values()], dtype=dtype)
+
+    def matrix(self, column, rows=None, out=None):
+        # (dates x tickers) copy of a column in fortran order on the given
+        # rows of the date axis (sorted, all of them by default), nan where a
+        # ticker has no data
+        rows = np.arange(len(self.dates)) if rows is None else np.asarray(rows)
+        if out is None:
+            out = np.empty((len(rows), len(self.tickers)), dtype=self.dtype, order='F')
+        values = getattr(self, column)
+        for i in range(len(self.tickers)):
+            start = self.starts[i] - self.origin
+            lo, hi = np.searchsorted(rows, [start, start + self.lengths[i]])
+            out[:lo, i] = out[hi:, i] = np.nan
+            out[lo:hi, i] = values[self.offsets[i] + rows[lo:hi] - start]
+        return out
+
+    def frame(self, ticker):
+        i = self.ticker_idx[ticker]
+        run = slice(self.offsets[i], self.offsets[i+1])
+        valid = np.isfinite(self.close_px[run])
+        dates = bday_dates(self.starts[i] + np.arange(self.lengths[i], dtype=np.int32))
+        return pd.DataFrame(data={column: getattr(self, column)[run][valid] for column in self.columns},
+                            index=pd.DatetimeIndex(dates[valid], name='date'))
+
+    def refresh(self, db_dir, tickers, removed=()):
+        # new store with the given tickers re-read from the parquet files and
+        # the removed ones dropped, only those are read, the runs (values and
+        # prefix sums) of every other ticker are copied over as they are (no
+        # frame per ticker, no full rebuild)
+        data = {ticker: self.read(db_dir, ticker) for ticker in tickers}
+        fresh = type(self).from_frames(data, dtype=self.dtype)
+        dropped = set(tickers) | set(removed)
+        kept = [ticker for ticker in self.tickers if ticker not in dropped]
+        new_tickers = np.array(sorted(kept + list(fresh.tickers)), dtype=object)
+        sources = [(fresh, fresh.ticker_idx[ticker]) if ticker in fresh else (self, self.ticker_idx[ticker])
+                   for ticker in new_tickers]
+        starts = np.array([store.starts[i] for store, i in sources], dtype=np.int32)
+        lengths = np.array([store.lengths[i] for store, i in sources], dtype=np.int32)
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+        arrays = {column: np.empty(offsets[-1], dtype=self.dtype) for column in self.columns}
+        prefix = {key: np.empty(offsets[-1] + len(new_tickers), dtype=values.dtype)
+                  for key, values in self.prefix.items()}
+        adj_prefix = np.empty(offsets[-1] + len(new_tickers))
+        for j, (store, i) in enumerate(sources):
+            run, target = slice(store.offsets[i], store.offsets[i+1]), slice(offsets[j], offsets[j+1])
+            for column in self.columns:
+                arrays[column][target] = getattr(store, column)[run]
+            run, target = slice(run.start + i, run.stop + i + 1), slice(target.start + j, target.stop + j + 1)
+            for key in prefix:
+                prefix[key][target] = store.prefix[key][run]
+            adj_prefix[target] = store.adj_prefix[run]
+
+        store = type(self)(new_tickers, starts, lengths, arrays, prefix=prefix, adj_prefix=adj_prefix)
+        store.version = self.version
+        logger.info(f'Refreshed store: {len(fresh.tickers)} tickers read, {len(self.tickers) - len(kept)} dropped, '
+                    f'{len(new_tickers)} tickers, {offsets[-1]} rows, {store.nbytes/2**20:.1f}MB')
+        return store
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.state().values()) + self.offsets.nbytes
+
+    def __contains__(self, ticker):
+        return ticker in self.ticker_idx
+
+    def rows(self, start_date, end_date):
+        # rows [start, end) of the date axis, end date is inclusive
+        start = bday_ordinals(np.datetime64(start_date, 'ns')) - self.origin
+        end = bday_ordinals(np.datetime64(end_date, 'ns') + np.timedelta64(1, 'D')) - self.origin
+        start = int(np.clip(start, 0, len(self.dates)))
+        return start, int(np.clip(end, start, len(self.dates)))
+
+    def _index(self, cols, rows):
+        # positions of the cells (rows broadcast against cols) in the runs,
+        # -1 outside a run
+        cols = np.asarray(cols, dtype=np.int64)
+        rel = rows - (self.starts[cols] - self.origin)
+        return np.where((rel >= 0) & (rel < self.lengths[cols]), self.offsets[cols] + rel, -1)
+
+    def _prefix_index(self, cols, rows):
+        # positions of the prefix rows of the cells, a row before the run is
+        # its leading row and one after it its last
+        cols = np.asarray(cols, dtype=np.int64)
+        rel = np.clip(rows - (self.starts[cols] - self.origin), 0, self.lengths[cols])
+        return self.offsets[cols] + cols + rel
+
+    @staticmethod
+    def _take(values, index):
+        # float64 values at the positions, nan outside the runs
+        taken = values.take(np.maximum(index, 0)).astype(np.float64) if len(values) else np.zeros(index.shape)
+        taken[index < 0] = np.nan
+        return taken
+
+    def returns(self, ticker, start_date, end_date):
+        i = self.ticker_idx[ticker]
+        start, end = self.rows(start_date, end_date)
+        # the window is a slice of the run of the ticker
+        run_start = self.starts[i] - self.origin
+        lo, hi = max(start - run_start, 0), max(min(end - run_start, self.lengths[i]), 0)
+        run = slice(self.offsets[i] + lo, self.offsets[i] + max(lo, hi))
+        close_px = self.close_px[run]
+        # only the dates the ticker actually traded on
+        valid = np.isfinite(close_px)
+        dates = self.dates[run_start + lo:run_start + max(lo, hi)]
+        return pd.DataFrame(data={'c2c_ret': self.c2c_ret[run][valid].astype(np.float64)},
+                            index=pd.DatetimeIndex(dates[valid], name='date'))
+
+    def panel(self, tickers, start_date, end_date):
+        # c2c_ret of several tickers aligned on the shared date axis, a single
+        # date search plus a vectorized take instead of a per ticker slice + join
+        cols = [self.ticker_idx[ticker] for ticker in tickers]
+        start, end = self.rows(start_date, end_date)
+        c2c_ret = self._take(self.c2c_ret, self._index(cols, np.arange(start, end)[:, None]))
+        # drop the dates none of the tickers traded on, c2c_ret is only nan
+        # where a ticker has no data
+        valid = np.isfinite(c2c_ret)
+        rows = valid.any(axis=1)
+        return (pd.DataFrame(data=c2c_ret[rows], columns=list(tickers),
+                             index=pd.DatetimeIndex(self.dates[start:end][rows], name='date')),
+                valid.any(axis=0))
+
+    def found(self, tickers, start_date, end_date):
+        # whether each ticker has data in the window, from the prefix counts
+        cols = [self.ticker_idx[ticker] for ticker in tickers]
+        n = self.prefix['n'].take(self._prefix_index(cols, np.array(self.rows(start_date, end_date))[:, None]))
+        return n[1] - n[0] > 0
+
+    def panel_chunks(self, tickers, start_date, end_date, chunk_rows):
+        # panel in chunks of chunk_rows dates, only one chunk is materialized
+        # at a time, for streamed responses
+        cols = [self.ticker_idx[ticker] for ticker in tickers]
+        start, end = self.rows(start_date, end_date)
+        for chunk_start in range(start, end, chunk_rows):
+            chunk_end = min(end, chunk_start + chunk_rows)
+            c2c_ret = self._take(self.c2c_ret, self._index(cols, np.arange(chunk_start, chunk_end)[:, None]))
+            rows = np.isfinite(c2c_ret).any(axis=1)
+            if rows.any():
+                yield pd.DataFrame(data=c2c_ret[rows], columns=list(tickers),
+                                   index=pd.DatetimeIndex(self.dates[chunk_start:chunk_end][rows], name='date'))
+
+    def prices(self, tickers, start_date, end_date, adjusted=False):
+        # close_px of several tickers in long format (date, ticker, close_px),
+        # optionally backward adjusted to the end of the window
+        cols = [self.ticker_idx[ticker] for ticker in tickers]
+        start, end = self.rows(start_date, end_date)
+        rows = np.arange(start, end)[:, None]
+        close_px = self._take(self.close_px, self._index(cols, rows))
+        if adjusted:
+            # prefix rows [start, end) so the adjustment is relative to the last row
+            close_px = close_px * backward_adjustment(self.adj_prefix.take(self._prefix_index(cols, rows)))
+        valid = np.isfinite(close_px)
+        rows, cols = np.nonzero(valid)
+        return (pd.DataFrame(data={'ticker': np.asarray(tickers, dtype=object)[cols],
+                                   'close_px': close_px[rows, cols]},
+                             index=pd.DatetimeIndex(self.dates[start:end][rows], name='date')),
+                valid.any(axis=0))
+
+    def snapshot(self, date, tickers=None):
+        # close_px and c2c_ret of all the tickers (or the given ones) trading
+        # on the date, empty if it is not a trading date
+        row, end = self.rows(date, date)
+        lo, hi = self.date_ptr[row:row+2] if end > row else (0, 0)
+        cols, values = self.date_cols[lo:hi], self.date_values[lo:hi].astype(np.float64)
+        if tickers is not None and len(cols):
+            wanted = np.array([self.ticker_idx[ticker] for ticker in tickers], dtype=np.int32)
+            at = np.minimum(np.searchsorted(cols, wanted), len(cols) - 1)
+            found = cols[at] == wanted
+            cols, values = wanted[found], values[at[found]]
+        return pd.DataFrame(data={'close_px': values[:, 0], 'c2c_ret': values[:, 1]},
+                            index=pd.Index(self.tickers[cols], name='ticker'))
+
+    def batch(self, queries):
+        # many (tickers, start_date, end_date) queries in one pass, the date
+        # searches are vectorized and the returns gathered with a single take,
+        # the result is in long format (query, date, ticker, c2c_ret)
+        bounds = [self.rows(start_date, end_date) for _, start_date, end_date in queries]
+        ids, rows, cols = [], [], []
+        for q, (tickers, _, _) in enumerate(queries):
+            q_rows = np.arange(*bounds[q])
+            q_cols = np.array([self.ticker_idx[ticker] for ticker in tickers], dtype=np.int64)
+            ids.append(np.full(len(q_rows) * len(q_cols), q))
+            rows.append(np.repeat(q_rows, len(q_cols)))
+            cols.append(np.tile(q_cols, len(q_rows)))
+        ids, rows, cols = np.concatenate(ids), np.concatenate(rows), np.concatenate(cols)
+        c2c_ret = self._take(self.c2c_ret, self._index(cols, rows))
+        valid = np.isfinite(c2c_ret)
+        return pd.DataFrame(data={'date': self.dates[rows[valid]],
+                                  'ticker': self.tickers[cols[valid]],
+                                  'c2c_ret': c2c_ret[valid]},
+                            index=pd.Index(ids[valid], name='query'))
+
+    def summary(self, tickers, start_date, end_date):
+        cols = [self.ticker_idx[ticker] for ticker in tickers]
+        start, end = self.rows(start_date, end_date)
+        index = self._prefix_index(cols, np.arange(start, end + 1)[:, None])
+        return window_summary({key: prefix.take(index) for key, prefix in self.prefix.items()},
+                              self.dates[start:end], tickers)
+
+class PartitionStore:
+    """
+    range aware reader over the yearly parquet partitions
+
+    only the {year}.parquet files overlapping the requested window are read
+    (plus the last row of the previous partition when the window starts on
+    the first row of a partition, needed for the c2c_ret of that row), the
+    partitions are cached per (ticker, year) in an lru cache bounded in bytes
+
+    the readers are coroutines, a cache hit is served right away on the
+    event loop, a miss is read in the executor (bounded thread pool) so it
+    never blocks the loop, and concurrent misses of the same partition wait
+    on the one read in flight (single flight)
+    """
+
+    columns = ['close_px', 'adj_factor']
+
+    def __init__(self, db_dir, max_bytes, columns=None, executor=None):
+        self.db_dir = db_dir
+        self.cache = ByteLRUCache(max_bytes)
+        self.columns = columns or self.columns
+        self.executor = executor
+        self.loading = {}
+
+    async def chunk(self, ticker, year):
+        key = (ticker, year)
+        eod_data = self.cache.get(key)
+        if eod_data is not None:
+            metrics.cache('partitions', True)
+            return eod_data
+        task = self.loading.get(key)
+        if task is None:
+            metrics.cache('partitions', False)
+            task = self.loading[key] = asyncio.ensure_future(self._read(key))
+            task.add_done_callback(lambda task: self._loaded(key, task))
+        else:
+            metrics.cache('partitions', None)
+        # a cancelled request does not cancel the read the others wait on
+        return await asyncio.shield(task)
+
+    async def _read(self, key):
+        with metrics.stage('parquet_read'):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, read_partition, self.db_dir,
+                                                                    *key, self.columns)
+
+    def _loaded(self, key, task):
+        failed = task.cancelled() or task.exception() is not None
+        # unless the ticker was evicted while the read was in flight
+        if self.loading.get(key) is task:
+            del self.loading[key]
+            if not failed:
+                eod_data = task.result()
+                self.cache.put(key, eod_data, int(eod_data.memory_usage(index=True).sum()))
+
+    def evict(self, ticker):
+        for key in [key for key in self.cache.keys() if key[0] == ticker]:
+            self.cache.pop(key)
+        for key in [key for key in self.loading if key[0] == ticker]:
+            self.loading.pop(key)
+
+    async def chunks(self, ticker, years):
+        return await asyncio.gather(*[self.chunk(ticker, year) for year in years])
+
+    async def window(self, ticker, start_date, end_date, years=None):
+        # the rows of the window as they are stored
+        years = ticker_years(self.db_dir, ticker) if years is None else sorted(years)
+        window_years = [year for year in years if start_date.year <= year <= end_date.year]
+        if not window_years:
+            return pd.DataFrame(columns=self.columns, dtype=np.float64)
+        eod_data = pd.concat(await self.chunks(ticker, window_years), sort=False, copy=False)
+        start = eod_data.index.searchsorted(start_date, side='left')
+        end = eod_data.index.searchsorted(end_date, side='right')
+        return eod_data.iloc[start:end]
+
+    async def prices(self, ticker, start_date, end_date, years=None, adjusted=False):
+        # ohlcv of the window, optionally backward adjusted to its last row
+        eod_data = await self.window(ticker, start_date, end_date, years=years)
+        prices = eod_data[PRICE_COLUMNS]
+        if adjusted:
+            # prefix rows [0, n) of the window
+            adj_factor = eod_data['adj_factor'].to_numpy()
+            factors = backward_adjustment(prefix_products(adj_factor)[:-1])
+            split_ratio = eod_data['split_ratio'].to_numpy() if 'split_ratio' in eod_data else np.ones(len(eod_data))
+            splits = backward_adjustment(prefix_products(split_factors(split_ratio))[:-1])
+            prices = adjust_prices(prices, factors, splits)
+        return prices
+
+    async def returns(self, ticker, start_date, end_date, years=None):
+        years = ticker_years(self.db_dir, ticker) if years is None else sorted(years)
+        window_years = [year for year in years if start_date.year <= year <= end_date.year]
+        if not window_years:
+            return pd.DataFrame(columns=['c2c_ret'], dtype=np.float64)
+
+        eod_data = pd.concat(await self.chunks(ticker, window_years), sort=False, copy=False)
+        start = eod_data.index.searchsorted(start_date, side='left')
+        end = eod_data.index.searchsorted(end_date, side='right')
+        if start > 0:
+            # keep one prior row for the shift
+            eod_data = eod_data.iloc[start-1:end]
+            prior = 1
+        else:
+            eod_data = eod_data.iloc[:end]
+            prior_years = [year for year in years if year < window_years[0]]
+            prior = 1 if prior_years and end > 0 else 0
+            if prior:
+                prior_data = await self.chunk(ticker, prior_years[-1])
+                eod_data = pd.concat([prior_data.iloc[-1:], eod_data], sort=False)
+
+        eod_data = eod_data.assign(c2c_ret=c2c_ret(eod_data['close_px'], eod_data['adj_factor']))
+        return eod_data[['c2c_ret']].iloc[prior:]
@@ -0,0 +1,119 @@
+import click
+import re
+import zlib
+import numpy as np
+import pandas as pd
+import datetime as dt
+from utils import *
+from logger import logger
+
+# all synthetic series start from the same origin, so any window of a ticker
+# is the same whatever the requested start/end dates are
+ORIGIN = pd.Timestamp('1990-01-01')
+
+# yf.download periods, 1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max
+PERIODS = {'d': 'days', 'mo': 'months', 'y': 'years'}
+
+class SyntheticSource:
+    """
+    deterministic synthetic prices in yf.download format (a yfetch --source)
+
+    close is a geometric random walk per ticker with quarterly dividends
+    (close drops by the dividend on the ex date) and the odd split (close is
+    divided by the split ratio), adj close is backward adjusted for both so
+    the adj_factor derived by yfetch.upsert carries the splits and dividends.
+    stock splits has the split ratio on its ex date (0 otherwise) as yahoo.
+    tickers list at a random date, every series only depends on the seed and
+    the ticker name.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def prices(self, ticker, end_date):
+        dates = pd.bdate_range(ORIGIN, end_date, name='Date')
+        n = len(dates)
+        key = zlib.crc32(ticker.encode())
+        # a stream per array so values never depend on how many dates are drawn
+        rng = [np.random.default_rng([self.seed, key, i]) for i in range(8)]
+        listing = rng[0].integers(0, 252*30)
+        vol = rng[0].uniform(0.01, 0.03)
+        div_yield = rng[0].uniform(0.0, 0.01)
+        log_ret = rng[1].normal(0.0003, vol, n)
+        # dividends every ~63 days, a split roughly every 10 years
+        div_yield = div_yield * (np.arange(n) % 63 == (key % 63))
+        splits = np.where(rng[2].random(n) < 1/2520, rng[3].choice([2.0, 3.0, 4.0], n), 1.0)
+
+        # dividends (as a fraction of the previous close) drop the close on
+        # the ex date, splits divide it by the split ratio
+        close = 50.0 * np.cumprod((np.exp(log_ret) - div_yield) / splits)
+        # backward adjustment, every event after t scales the price on t
+        event = (1.0 - div_yield) / splits
+        adj = np.append(np.cumprod(event[::-1])[::-1][1:], 1.0)
+
+        high = rng[4].uniform(0.0, 0.01, n)
+        low = rng[5].uniform(0.0, 0.01, n)
+        data = pd.DataFrame(data={'Open': close * (1.0 + high - low),
+                                  'High': close * (1.0 + high),
+                                  'Low': close * (1.0 - low),
+                                  'Close': close,
+                                  'Adj Close': close * adj,
+                                  'Volume': rng[6].integers(1e5, 1e7, n).astype(np.float64),
+                                  'Stock Splits': np.where(splits != 1.0, splits, 0.0)},
+                            index=dates)
+        return data.iloc[listing:]
+
+    def fetch(self, tickers, period=None, start_date=None, end_date=None):
+        end_date = pd.Timestamp(end_date or yesterday(business_day=True))
+        if period == 'ytd':
+            start_date = pd.Timestamp(end_date.year, 1, 1)
+        elif period and period != 'max':
+            n, unit = re.match(r'(\d+)(d|mo|y)$', period).groups()
+            start_date = end_date - pd.DateOffset(**{PERIODS[unit]: int(n)})
+        start_date = pd.Timestamp(start_date or ORIGIN)
+        frames = {ticker: self.prices(ticker, end_date).loc[start_date:end_date] for ticker in tickers}
+        return pd.concat(frames, axis=1)
+
+def synthetic_tickers(n):
+    return [f'S{i:04d}' for i in range(n)]
+
+@click.command()
+@click.option('--tickers',
+              type=click.INT,
+              default=100,
+              required=False,
+              show_default=True,
+              help='number of synthetic tickers')
+@click.option('--years',
+              type=click.INT,
+              default=10,
+              required=False,
+              show_default=True,
+              help='number of years of history')
+@click.option('--end_date',
+              type=click.DateTime(formats=valid_date_formats),
+              default='2025-10-03',
+              required=False,
+              show_default=True,
+              help='last date of the history')
+@click.option('--seed',
+              type=click.INT,
+              default=0,
+              required=False,
+              show_default=True,
+              help='random seed')
+@click.option('--db_dir',
+              type=click.STRING,
+              required=True,
+              help='where to write the parquet files')
+def main(tickers, years, end_date, seed, db_dir):
+    """synthetic data generator"""
+    import asyncio
+    from yfetch import download
+    start_date = end_date - dt.timedelta(days=365*years)
+    logger.info(f'Generating {tickers} tickers x {years} years in {db_dir}')
+    asyncio.run(download(','.join(synthetic_tickers(tickers)), None, start_date, end_date,
+                         batch=50, source=SyntheticSource(seed), db_dir=db_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import pandas as pd
+import numpy as np
+from analytics import compound, covariance
+
+def test_compound():
+    # one reduceat over the period boundaries is the per period product
+    dates = pd.bdate_range('2019-12-25', '2023-02-10')
+    returns = pd.DataFrame(np.random.default_rng(0).normal(0, 0.01, (len(dates), 3)), index=dates)
+    returns.iloc[:40, 1] = np.nan
+    returns.iloc[100:160, 2] = np.nan
+    for freq, period in [('W', 'W-SUN'), ('M', 'M'), ('Q', 'Q'), ('Y', 'Y')]:
+        ends, compounded = compound(dates.values, returns.to_numpy(), freq)
+        groups = (1.0 + returns).groupby(dates.to_period(period))
+        assert np.array_equal(ends, groups.apply(lambda group: group.index[-1]).values)
+        assert np.allclose(compounded, groups.prod(min_count=1) - 1.0, equal_nan=True)
+
+def test_covariance():
+    # pairwise complete like pandas, tickers listed/delisted at different dates
+    returns = pd.DataFrame(np.random.default_rng(1).normal(0, 0.01, (300, 4)))
+    returns.iloc[:50, 1] = np.nan
+    returns.iloc[200:, 2] = np.nan
+    returns.iloc[100:120, 3] = np.nan
+    assert np.allclose(covariance(returns.to_numpy()), returns.cov(), equal_nan=True)
+    assert np.allclose(covariance(returns.to_numpy(), correlation=True), returns.corr(), equal_nan=True)
+    ewm = returns.ewm(halflife=20)
+    assert np.allclose(covariance(returns.to_numpy(), halflife=20), ewm.cov().loc[299], equal_nan=True)
+    assert np.allclose(covariance(returns.to_numpy(), halflife=20, correlation=True), ewm.corr().loc[299],
+                       equal_nan=True)
+
+if __name__ == "__main__":
+    test_compound()
+    test_covariance()
@@ -0,0 +1,32 @@
+import tempfile
+import datetime as dt
+import pandas as pd
+import numpy as np
+from catalog import load_catalog
+from store import read_ticker, SharedStore
+from synth import SyntheticSource
+from compact import compact
+from testing import ingest
+
+def test_compact():
+    # upserts on top of a compacted store land in per ticker files which win
+    # over the yearly files until the next compaction
+    source = SyntheticSource(seed=2)
+    tickers = 'S0001,S0002,S0003'
+    with tempfile.TemporaryDirectory() as db_dir, tempfile.TemporaryDirectory() as ref_dir:
+        for path in (db_dir, ref_dir):
+            ingest(path, tickers, dt.datetime(2023, 6, 1), dt.datetime(2024, 12, 31), source)
+        compact(db_dir, layout='yearly', codec='zstd')
+        for path in (db_dir, ref_dir):
+            ingest(path, tickers, dt.datetime(2025, 1, 1), dt.datetime(2025, 1, 10), source)
+        for layout in ('yearly', 'per_ticker'):
+            assert load_catalog(db_dir)['S0002']['files'] == ['2023.parquet', '2024.parquet', '2025.parquet']
+            for ticker in tickers.split(','):
+                pd.testing.assert_frame_equal(read_ticker(db_dir, ticker), read_ticker(ref_dir, ticker),
+                                              check_freq=False)
+            store, ref = SharedStore.load(db_dir), SharedStore.load(ref_dir)
+            assert np.array_equal(store.c2c_ret, ref.c2c_ret, equal_nan=True)
+            compact(db_dir, layout=layout, codec='lz4')
+
+if __name__ == "__main__":
+    test_compact()
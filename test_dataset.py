@@ -0,0 +1,59 @@
+import asyncio
+import datetime as dt
+import pandas as pd
+from store import merge_deltas, PartitionStore, PRICE_COLUMNS, ADJUST_COLUMNS
+from synth import SyntheticSource
+from compact import compact
+from dataset import DatasetStore
+from testing import ingest, temp_db
+
+def test_dataset_backend():
+    # the dataset scans read the same rows as the partition reads, over a
+    # yearly store with per ticker files and deltas on top
+    source = SyntheticSource(seed=6)
+    tickers = 'S0001,S0002'
+    with temp_db(tickers, dt.datetime(2022, 6, 1), dt.datetime(2024, 6, 28), source) as db_dir:
+        compact(db_dir, layout='yearly', codec='zstd')
+        for start_date, end_date in [(dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12)),
+                                     (dt.datetime(2024, 7, 12), dt.datetime(2024, 7, 19))]:
+            ingest(db_dir, tickers, start_date, end_date, source, mode='delta')
+        columns = PRICE_COLUMNS + ADJUST_COLUMNS
+        partitions, prices = PartitionStore(db_dir, max_bytes=2**26), PartitionStore(db_dir, 2**26, columns)
+        dataset, dataset_prices = DatasetStore(db_dir), DatasetStore(db_dir, columns=columns)
+
+        async def check(ticker, start_date, end_date):
+            pd.testing.assert_frame_equal(await dataset.returns(ticker, start_date, end_date),
+                                          await partitions.returns(ticker, start_date, end_date),
+                                          check_names=False, check_index_type=False, check_freq=False)
+            pd.testing.assert_frame_equal(await dataset_prices.prices(ticker, start_date, end_date, adjusted=True),
+                                          await prices.prices(ticker, start_date, end_date, adjusted=True),
+                                          check_names=False, check_index_type=False, check_freq=False)
+        for window in [(dt.datetime(2022, 1, 1), dt.datetime(2024, 12, 31)),
+                       (dt.datetime(2023, 1, 1), dt.datetime(2023, 1, 31)),
+                       (dt.datetime(2024, 7, 10), dt.datetime(2024, 7, 17)),
+                       (dt.datetime(2024, 7, 13), dt.datetime(2024, 7, 14)),
+                       (dt.datetime(2025, 1, 1), dt.datetime(2025, 6, 30))]:
+            for ticker in tickers.split(','):
+                asyncio.run(check(ticker, *window))
+
+def test_dataset_compact():
+    # a compact (or a merge of the deltas) behind the back of a dataset store,
+    # no evict, the next scans list the new files
+    source = SyntheticSource(seed=7)
+    tickers = 'S0001,S0002'
+    with temp_db(tickers, dt.datetime(2022, 6, 1), dt.datetime(2024, 6, 28), source) as db_dir:
+        dataset, partitions = DatasetStore(db_dir), PartitionStore(db_dir, max_bytes=2**26)
+        start_date, end_date = dt.datetime(2022, 1, 1), dt.datetime(2024, 12, 31)
+        before = asyncio.run(dataset.returns('S0001', start_date, end_date))
+        compact(db_dir, layout='yearly', codec='zstd')
+        pd.testing.assert_frame_equal(asyncio.run(dataset.returns('S0001', start_date, end_date)), before)
+        ingest(db_dir, tickers, dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12), source, mode='delta')
+        asyncio.run(dataset.returns('S0002', start_date, end_date))
+        merge_deltas(db_dir, 'S0002', 2024, 'zstd')
+        pd.testing.assert_frame_equal(asyncio.run(dataset.returns('S0002', start_date, end_date)),
+                                      asyncio.run(partitions.returns('S0002', start_date, end_date)),
+                                      check_names=False, check_index_type=False, check_freq=False)
+
+if __name__ == "__main__":
+    test_dataset_backend()
+    test_dataset_compact()
@@ -0,0 +1,75 @@
+import asyncio
+import tempfile
+import datetime as dt
+from synth import SyntheticSource
+from events import read_events, append_events, events_path, rotated_path, EventHub
+import events as events_module
+from testing import ingest, temp_db
+
+def test_events():
+    # every ingest appends an event per ticker written with the dates of the
+    # new rows, readers pick them up from the last id they have seen
+    source = SyntheticSource(seed=8)
+    with temp_db('S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), source) as db_dir:
+        events, offset = read_events(db_dir, 0)
+        assert sorted(event['ticker'] for event in events) == ['S0001', 'S0002']
+        assert [event['generation'] for event in events] == [1, 1]
+        ingest(db_dir, 'S0002', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12), source)
+        # a line still being written is left for the next read
+        with open(events_path(db_dir), 'a') as f:
+            f.write('{"ticker": "S0')
+        events, end = read_events(db_dir, offset)
+        assert [(event['ticker'], event['start_date'], event['end_date'], event['generation']) for event in events] \
+            == [('S0002', '2024-06-28T00:00:00', '2024-07-12T00:00:00', 2)]
+        assert events[-1]['id'] == end and read_events(db_dir, end) == ([], end)
+
+def test_events_truncated():
+    # a log truncated by hand and grown again past the offset of a reader,
+    # the reader (and a hub) start over from the new lines instead of parsing
+    # from the middle of one, a bad line is skipped
+    with tempfile.TemporaryDirectory() as db_dir:
+        append_events(db_dir, [{'ticker': f'T{i}'} for i in range(3)])
+        _, offset = read_events(db_dir, 0)
+
+        async def render(events):
+            return [(event, event['ticker']) for event in events]
+        hub = EventHub(db_dir, render, poll_secs=0.01)
+
+        async def subscribe():
+            queue = await hub.subscribe([f'T{i}' for i in range(10)])
+            with open(events_path(db_dir), 'w') as f:
+                f.write('not json\n')
+            append_events(db_dir, [{'ticker': f'T{i}'} for i in range(3, 10)])
+            messages = [await asyncio.wait_for(queue.get(), 5) for _ in range(7)]
+            hub.unsubscribe(queue)
+            return messages
+        assert asyncio.run(subscribe()) == [f'T{i}' for i in range(3, 10)]
+        events, end = read_events(db_dir, offset)
+        assert [event['ticker'] for event in events] == [f'T{i}' for i in range(3, 10)] and end > offset
+
+def test_events_rotated():
+    # past EVENTS_ROTATE_BYTES the log moves aside, ids keep growing and a
+    # reader behind the rotation reads the rest of the moved log first
+    rotate_bytes = events_module.EVENTS_ROTATE_BYTES
+    events_module.EVENTS_ROTATE_BYTES = 100
+    try:
+        with tempfile.TemporaryDirectory() as db_dir:
+            offsets = [0]
+            for i in range(10):
+                append_events(db_dir, [{'ticker': f'T{i}'}])
+                offsets.append(read_events(db_dir, offsets[-1])[1])
+            with open(rotated_path(db_dir)) as f:
+                assert f.readline().startswith('{"base":')
+            assert offsets == sorted(set(offsets))
+            for offset in offsets[-4:-1]:
+                events, end = read_events(db_dir, offset)
+                assert [event['ticker'] for event in events] == [f'T{i}' for i in range(offsets.index(offset), 10)]
+                assert [event['id'] for event in events] == offsets[offsets.index(offset) + 1:]
+                assert end == offsets[-1] and read_events(db_dir, end) == ([], end)
+    finally:
+        events_module.EVENTS_ROTATE_BYTES = rotate_bytes
+
+if __name__ == "__main__":
+    test_events()
+    test_events_truncated()
+    test_events_rotated()
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import datetime as dt
+import pandas as pd
+import numpy as np
+from catalog import load_catalog
+from store import SharedStore
+from synth import SyntheticSource
+from export import Export
+from testing import ingest, temp_db
+
+def test_export():
+    # every download rewrites the export, the mapped matrices are the store
+    source = SyntheticSource(seed=9)
+    with tempfile.TemporaryDirectory() as export_dir, \
+            temp_db('S0001,S0002', dt.datetime(2023, 1, 2), dt.datetime(2024, 6, 28), source,
+                    export_dir=export_dir) as db_dir:
+        previous = Export(export_dir)
+        ingest(db_dir, 'S0002,S0003', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12), source,
+               export_dir=export_dir)
+        export, store = Export(export_dir), SharedStore.load(db_dir)
+        assert export.header['version'] != previous.header['version'] and len(os.listdir(export_dir)) == 6
+        assert isinstance(export.c2c_ret, np.memmap) and export.c2c_ret.flags['F_CONTIGUOUS']
+        rows = np.searchsorted(store.dates, export.dates)
+        assert list(export.tickers) == list(store.tickers) and np.array_equal(store.dates[rows], export.dates)
+        for column in ['close_px', 'adj_factor', 'c2c_ret']:
+            assert np.array_equal(export.arrays[column], store.matrix(column, rows), equal_nan=True)
+        window = dt.datetime(2024, 1, 1), dt.datetime(2024, 7, 12)
+        pd.testing.assert_frame_equal(export.frame('c2c_ret', ['S0003', 'S0001'], *window),
+                                      store.panel(['S0003', 'S0001'], *window)[0], check_freq=False)
+        mapped = export.store()
+        assert isinstance(mapped.prefix['sum'], np.memmap) and isinstance(mapped.date_values, np.memmap)
+        pd.testing.assert_frame_equal(mapped.summary(store.tickers, *window), store.summary(store.tickers, *window))
+        assert export.stale(load_catalog(db_dir)) == ([], [])
+        assert previous.stale(load_catalog(db_dir)) == (['S0002', 'S0003'], [])
+
+if __name__ == "__main__":
+    test_export()
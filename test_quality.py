@@ -0,0 +1,81 @@
+import tempfile
+import datetime as dt
+import pandas as pd
+import numpy as np
+from synth import SyntheticSource
+import quality
+from testing import ingest
+
+def test_quality():
+    # a flat market of 12 tickers with one of each problem injected
+    dates = pd.bdate_range('2024-01-01', periods=60)
+    rng = np.random.default_rng(0)
+    frames = {}
+    for i in range(12):
+        close = 100.0 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates))))
+        frames[f'T{i:02d}'] = pd.DataFrame({'close_px': close, 'adj_factor': 1.0}, index=dates)
+    frames['T00'].iloc[30:, 0] *= 1.5                       # outlier
+    frames['T01'].iloc[40, 0] = frames['T01'].iloc[39, 0]   # stale
+    frames['T02'] = frames['T02'].drop(dates[20:25])        # gap
+    for ticker in frames:                                   # market down 5%
+        frames[ticker].loc[dates[50]:, 'close_px'] *= 0.95 if ticker != 'T03' else 1.05
+    report = quality.check_frames(frames)
+    flagged = set(zip(report['check'], report['ticker'], report['date']))
+    assert ('outlier', 'T00', dates[30]) in flagged
+    assert ('stale', 'T01', dates[40]) in flagged
+    assert ('gap', 'T02', dates[25]) in flagged
+    assert ('against_market', 'T03', dates[50]) in flagged
+    assert set(report.loc[report['check'] == 'against_market', 'ticker']) == {'T03'}
+
+    # and once per download, the report covers the new rows only
+    with tempfile.TemporaryDirectory() as db_dir:
+        ingest(db_dir, 'S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), SyntheticSource(seed=4),
+               report_file=f'{db_dir}/report.json')
+        report = ingest(db_dir, 'S0001,S0002', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 31),
+                        SyntheticSource(seed=4))
+        assert pd.read_json(f'{db_dir}/report.json').columns.tolist() == quality.REPORT_COLUMNS
+        assert report.empty or report['date'].min() >= pd.Timestamp('2024-06-28')
+
+def legacy_flags(data_, data_len):
+    # the outlier/stale checks upsert ran per ticker before quality.py
+    roll_adj_cum_prod = data_['adj_factor'][::-1].cumprod()[::-1]
+    adj_close_px = data_['close_px'].multiply(roll_adj_cum_prod, axis='rows')
+    c2c_ret = ((adj_close_px.ffill() / adj_close_px.ffill().shift(1)) - 1.0)*100.0
+    mu = c2c_ret.shift(1).rolling(5).mean()
+    sd = c2c_ret.shift(1).rolling(5).std()
+    check_max = c2c_ret > mu + 5 * sd
+    check_min = c2c_ret < mu - 5 * sd
+    check_max = check_max | check_max.shift(-1)
+    check_min = check_min | check_min.shift(-1)
+    check_stale = c2c_ret == 0.0
+    check_stale = check_stale | check_stale.shift(-1)
+    flags = {'outlier': (check_max | check_min).astype(bool), 'stale': check_stale.astype(bool)}
+    for flagged in flags.values():
+        flagged.iloc[:-data_len] = False
+    return flags
+
+def test_quality_parity():
+    # the vectorized outlier/stale flags are the per ticker ones, row for row,
+    # the row before a jump included
+    dates = pd.bdate_range('2023-01-02', periods=250)
+    rng = np.random.default_rng(3)
+    frames = {}
+    for i in range(6):
+        close = 100.0 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates))))
+        adj_factor = np.where(np.arange(len(dates)) % 63 == 10 + i, 0.99, 1.0)
+        eod_data = pd.DataFrame({'close_px': close, 'adj_factor': adj_factor}, index=dates)
+        for row in rng.choice(np.arange(30, 240), 4, replace=False):
+            eod_data.iloc[row:, 0] *= rng.choice([0.7, 1.4])
+        for row in rng.choice(np.arange(30, 240), 3, replace=False):
+            eod_data.iloc[row, 0] = eod_data.iloc[row - 1, 0]
+        # the first rows stored already, only the others are new
+        frames[f'T{i:02d}'] = eod_data.assign(new=np.arange(len(dates)) >= 20 * i)
+    report = quality.check_frames(frames)
+    for ticker, eod_data in frames.items():
+        for name, flagged in legacy_flags(eod_data, int(eod_data['new'].sum())).items():
+            found = report.loc[(report['ticker'] == ticker) & (report['check'] == name), 'date']
+            assert flagged.any() and list(found) == list(flagged.index[flagged.to_numpy()])
+
+if __name__ == "__main__":
+    test_quality()
+    test_quality_parity()
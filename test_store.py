@@ -0,0 +1,174 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import pandas as pd
+import numpy as np
+from catalog import load_catalog
+from store import delta_files, merge_deltas, SharedStore, PartitionStore, PRICE_COLUMNS, ADJUST_COLUMNS
+from synth import SyntheticSource
+import store as store_module
+from testing import ingest, temp_db
+
+def test_store_refresh():
+    # the columns copied over by refresh plus the tickers re-read match a
+    # store built from scratch, for new dates, a new ticker and a removal
+    source = SyntheticSource(seed=4)
+    with temp_db('S0001,S0002,S0003', dt.datetime(2023, 1, 2), dt.datetime(2024, 6, 28), source) as db_dir:
+        store = SharedStore.load(db_dir)
+        ingest(db_dir, 'S0002,S0004', dt.datetime(2024, 1, 2), dt.datetime(2024, 7, 31), source)
+        for tickers, removed in [(['S0002', 'S0004'], []), (['S0002', 'S0004'], ['S0001', 'S0003'])]:
+            refreshed = store.refresh(db_dir, tickers, removed)
+            expected = SharedStore.from_frames({ticker: SharedStore.read(db_dir, ticker)
+                                                for ticker in sorted(load_catalog(db_dir)) if ticker not in removed})
+            assert list(refreshed.tickers) == list(expected.tickers)
+            assert np.array_equal(refreshed.dates, expected.dates)
+            assert np.array_equal(refreshed.starts, expected.starts)
+            assert np.array_equal(refreshed.lengths, expected.lengths)
+            for column in SharedStore.columns:
+                assert np.array_equal(getattr(refreshed, column), getattr(expected, column), equal_nan=True)
+            for key in expected.prefix:
+                assert np.array_equal(refreshed.prefix[key], expected.prefix[key])
+            assert np.array_equal(refreshed.adj_prefix, expected.adj_prefix)
+            for name in ['date_ptr', 'date_cols', 'date_values']:
+                assert np.array_equal(getattr(refreshed, name), getattr(expected, name))
+
+def test_partition_merge_race():
+    # a merge_deltas while the year file is read, the read still sees the
+    # rows of the deltas
+    source = SyntheticSource(seed=5)
+    with temp_db('S0001', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), source) as db_dir:
+        ingest(db_dir, 'S0001', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 31), source, mode='delta')
+        expected = store_module.read_partition(db_dir, 'S0001', 2024)
+        read_base, merged = store_module.read_base, []
+
+        def merging_read_base(*args, **kwargs):
+            # the year file as it was, merged right after it was read (on the
+            # first read only, the merge itself reads the partition)
+            eod_data = read_base(*args, **kwargs)
+            if not merged:
+                merged.append(True)
+                merge_deltas(db_dir, 'S0001', 2024, 'gzip')
+            return eod_data
+        store_module.read_base = merging_read_base
+        try:
+            pd.testing.assert_frame_equal(store_module.read_partition(db_dir, 'S0001', 2024), expected)
+        finally:
+            store_module.read_base = read_base
+        assert not delta_files(db_dir, 'S0001', 2024)
+
+def test_adjusted_prices():
+    # prices backward adjusted to the end of any window are the synthetic adj
+    # close rescaled to the close of that day, from the store and the files
+    source = SyntheticSource(seed=1)
+    start_date, end_date = dt.datetime(2015, 1, 1), dt.datetime(2024, 12, 31)
+    with temp_db('S0001,S0002,S0003', start_date, end_date, source) as db_dir:
+        store = SharedStore.load(db_dir)
+        partitions = PartitionStore(db_dir, max_bytes=2**26, columns=PRICE_COLUMNS + ADJUST_COLUMNS)
+        for window in [(dt.datetime(2016, 3, 1), dt.datetime(2021, 6, 30)), (start_date, end_date)]:
+            for ticker in store.tickers:
+                data = source.fetch([ticker], start_date=start_date, end_date=end_date)[ticker].loc[window[0]:window[1]]
+                expected = data['Adj Close'] * data['Close'].iloc[-1] / data['Adj Close'].iloc[-1]
+                prices = asyncio.run(partitions.prices(ticker, *window, adjusted=True))
+                assert np.allclose(prices['close_px'], expected)
+                # volume only adjusted for the splits, by the ratios the source reports
+                splits = data['Stock Splits'].replace(0.0, 1.0).shift(-1).fillna(1.0)
+                assert np.allclose(prices['volume'], data['Volume'] * splits[::-1].cumprod()[::-1])
+                closes, found = store.prices([ticker], *window, adjusted=True)
+                assert found.all() and np.allclose(closes['close_px'], expected)
+                assert np.allclose(asyncio.run(partitions.prices(ticker, *window))['close_px'], data['Close'])
+
+class EventSource:
+    """a flat close with a 30% special dividend on 2024-03-01 and a 5:4 split plus a 1% dividend on 2024-06-03"""
+
+    def fetch(self, tickers, period=None, start_date=None, end_date=None):
+        dates = pd.bdate_range(start_date, end_date, name='Date')
+        close = np.where(dates < '2024-03-01', 100.0, 70.0)
+        close = np.where(dates < '2024-06-03', close, 70.0 * 0.99 / 1.25)
+        adj = np.where(dates < '2024-03-01', 0.7, 1.0) * np.where(dates < '2024-06-03', 0.99 / 1.25, 1.0)
+        frame = pd.DataFrame(data={'Open': close, 'High': close, 'Low': close, 'Close': close,
+                                   'Adj Close': close * adj, 'Volume': 1e6,
+                                   'Dividends': np.where(dates == '2024-03-01', 30.0, 0.0),
+                                   'Stock Splits': np.where(dates == '2024-06-03', 1.25, 0.0)}, index=dates)
+        return pd.concat({ticker: frame for ticker in tickers}, axis=1)
+
+def test_adjusted_volume():
+    # dividends (a special one as large as a split) leave the volume alone, a
+    # split (5:4, as small as a dividend, with a dividend the same day)
+    # scales it by the split ratio the source reports only
+    with temp_db('AAA', dt.datetime(2024, 1, 2), dt.datetime(2024, 8, 30), EventSource()) as db_dir:
+        partitions = PartitionStore(db_dir, max_bytes=2**26, columns=PRICE_COLUMNS + ADJUST_COLUMNS)
+        prices = asyncio.run(partitions.prices('AAA', dt.datetime(2024, 1, 2), dt.datetime(2024, 5, 31),
+                                               adjusted=True))
+        assert np.allclose(prices['volume'], 1e6)
+        assert np.allclose(prices['close_px'], 70.0)
+        prices = asyncio.run(partitions.prices('AAA', dt.datetime(2024, 1, 2), dt.datetime(2024, 8, 30),
+                                               adjusted=True))
+        assert np.allclose(prices['volume'], np.where(prices.index < '2024-06-03', 1.25e6, 1e6))
+        assert np.allclose(prices['close_px'], 70.0 * 0.99 / 1.25)
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+def test_partition_single_flight():
+    # concurrent misses of a partition share one read, later ones are hits
+    with temp_db('S0001', dt.datetime(2023, 1, 2), dt.datetime(2024, 6, 28), SyntheticSource(seed=5)) as db_dir:
+        executor = CountingExecutor()
+        partitions = PartitionStore(db_dir, max_bytes=2**26, executor=executor)
+
+        async def query():
+            window = dt.datetime(2023, 3, 1), dt.datetime(2024, 3, 1)
+            results = await asyncio.gather(*[partitions.returns('S0001', *window) for _ in range(10)])
+            return results + [await partitions.returns('S0001', *window)]
+        results = asyncio.run(query())
+        assert executor.submitted == 2
+        assert all(result.equals(results[0]) for result in results)
+        assert not partitions.loading
+
+def test_store_float32():
+    # a single precision store reads back (as float64) within the rounding of
+    # the stored values, the aggregates are still accumulated in float64
+    with temp_db('S0001,S0002,S0003', dt.datetime(2020, 1, 1), dt.datetime(2024, 12, 31),
+                 SyntheticSource(seed=7)) as db_dir:
+        store, compact_store = SharedStore.load(db_dir), SharedStore.load(db_dir, dtype=np.float32)
+        assert compact_store.c2c_ret.dtype == np.float32 and compact_store.nbytes < store.nbytes
+        window = store.tickers, dt.datetime(2021, 3, 1), dt.datetime(2024, 6, 28)
+        panel, compact_panel = store.panel(*window)[0], compact_store.panel(*window)[0]
+        assert compact_panel.dtypes.eq(np.float64).all()
+        assert np.allclose(compact_panel, panel, rtol=2**-23, atol=0)
+        assert np.allclose(compact_store.summary(*window).iloc[:, 3:], store.summary(*window).iloc[:, 3:],
+                           rtol=1e-5, atol=1e-9)
+        refreshed = compact_store.refresh(db_dir, ['S0002'])
+        assert refreshed.dtype == np.float32 and np.array_equal(refreshed.c2c_ret, compact_store.c2c_ret,
+                                                                equal_nan=True)
+
+def test_store_runs():
+    # a ticker only takes the rows from its first to its last date on the
+    # business day axis, a holiday is a row nobody has data on
+    dates = pd.bdate_range('2024-01-01', '2024-03-29', name='date').drop(pd.Timestamp('2024-02-19'))
+    data = {'LONG': pd.DataFrame({'close_px': np.linspace(10.0, 20.0, len(dates)), 'adj_factor': 1.0}, index=dates),
+            'SHORT': pd.DataFrame({'close_px': [5.0, 5.5, 5.0], 'adj_factor': 1.0}, index=dates[40:43])}
+    store = SharedStore.from_frames({ticker: SharedStore.returns_frame(eod_data) for ticker, eod_data in data.items()})
+    assert len(store.dates) == len(dates) + 1 and list(store.lengths) == [len(dates) + 1, 3]
+    assert len(store.c2c_ret) == len(dates) + 4
+    for ticker, eod_data in data.items():
+        pd.testing.assert_frame_equal(store.frame(ticker), eod_data, check_freq=False)
+    assert store.snapshot(dt.datetime(2024, 2, 19)).empty and store.snapshot(dt.datetime(2024, 2, 17)).empty
+    assert list(store.snapshot(dates[41]).index) == ['LONG', 'SHORT']
+    panel, found = store.panel(['SHORT', 'LONG'], dt.datetime(2024, 2, 10), dt.datetime(2024, 3, 8))
+    assert pd.Timestamp('2024-02-19') not in panel.index and found.all()
+    assert panel['SHORT'].notna().sum() == 3 and panel['LONG'].notna().all()
+
+if __name__ == "__main__":
+    test_store_refresh()
+    test_partition_merge_race()
+    test_adjusted_prices()
+    test_adjusted_volume()
+    test_partition_single_flight()
+    test_store_float32()
+    test_store_runs()
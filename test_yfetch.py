@@ -0,0 +1,173 @@
+import asyncio
+import os
+import tempfile
+import datetime as dt
+import pandas as pd
+import numpy as np
+from yfetch import download, GapError
+from catalog import load_catalog, build_catalog, partition_stats
+from store import read_ticker, read_partition, read_tail, delta_files, SharedStore
+from synth import SyntheticSource
+from compact import compact
+from testing import ingest, temp_db
+
+class LocalSource:
+    """offline stand-in for yahoo, a random walk per ticker in yf.download format"""
+
+    def __init__(self, fail=0, attempts_file=None, drop=None):
+        # fail the first n fetches, the fetches run in other processes so
+        # the attempts are counted in a file, drop leaves a column out
+        self.fail = fail
+        self.attempts_file = attempts_file
+        self.drop = drop
+
+    def fetch(self, tickers, period=None, start_date=None, end_date=None):
+        if self.attempts_file:
+            with open(self.attempts_file, 'a+') as f:
+                f.seek(0)
+                attempts = len(f.read())
+                f.write('x')
+            if attempts < self.fail:
+                raise ConnectionError('yahoo is down')
+        dates = pd.bdate_range(start_date, end_date, name='Date')
+        frames = {}
+        for ticker in tickers:
+            rng = np.random.default_rng(sum(map(ord, ticker)))
+            close = 100.0 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates))))
+            frames[ticker] = pd.DataFrame(data={'Open': close, 'High': close, 'Low': close, 'Close': close,
+                                                'Adj Close': close, 'Volume': 1e6}, index=dates)
+            if self.drop:
+                frames[ticker] = frames[ticker].drop(columns=[self.drop])
+        return pd.concat(frames, axis=1)
+
+def test_download():
+    tickers = 'AAPL,MSFT,NVDA,GOOG,AMZN,META,TSLA'
+    with tempfile.TemporaryDirectory() as db_dir:
+        asyncio.run(download(tickers, None, dt.datetime(2024, 12, 2), dt.datetime(2025, 1, 31),
+                             batch=2, workers=3, processes=2, source=LocalSource(), db_dir=db_dir))
+        catalog = load_catalog(db_dir)
+        assert sorted(catalog) == sorted(tickers.split(','))
+        assert catalog['AAPL']['files'] == ['2024.parquet', '2025.parquet']
+        assert catalog['AAPL']['rows'] == len(pd.bdate_range('2024-12-02', '2025-01-31'))
+        eod_data = read_ticker(db_dir, 'TSLA')
+        assert eod_data.index[-1] == pd.Timestamp('2025-01-31')
+        assert np.allclose(eod_data['adj_factor'], 1.0)
+
+def test_download_retry():
+    with tempfile.TemporaryDirectory() as db_dir:
+        source = LocalSource(fail=2, attempts_file=f'{db_dir}/attempts')
+        ingest(db_dir, 'AAPL', dt.datetime(2025, 1, 2), dt.datetime(2025, 1, 31), source, retries=2, backoff=0.01)
+        assert 'AAPL' in load_catalog(db_dir)
+
+def test_download_empty():
+    # nothing new (an up to date ticker) is fetched once, no retry
+    with tempfile.TemporaryDirectory() as db_dir:
+        source = LocalSource(attempts_file=f'{db_dir}/attempts')
+        ingest(db_dir, 'AAPL', dt.datetime(2025, 1, 4), dt.datetime(2025, 1, 5), source, retries=2, backoff=60)
+        with open(f'{db_dir}/attempts') as f:
+            assert f.read() == 'x'
+        assert 'AAPL' not in load_catalog(db_dir)
+
+def test_download_gap():
+    # new rows too far after the stored ones fail the ingest with a GapError
+    # raised in the upsert process, the ticker is left as it was
+    with temp_db('AAPL', dt.datetime(2025, 1, 2), dt.datetime(2025, 1, 31), LocalSource()) as db_dir:
+        try:
+            ingest(db_dir, 'AAPL', dt.datetime(2025, 6, 2), dt.datetime(2025, 6, 30), LocalSource())
+        except GapError:
+            pass
+        else:
+            assert False, 'the ingest did not fail'
+        assert load_catalog(db_dir)['AAPL']['end_date'] == '2025-01-31T00:00:00'
+
+def test_download_upsert_error():
+    # a failing upsert ends the ingest with its error, more batches than the
+    # queue holds so the fetchers would block on it
+    with tempfile.TemporaryDirectory() as db_dir:
+        try:
+            asyncio.run(asyncio.wait_for(download('AAPL,MSFT,NVDA,GOOG,AMZN,META', None, dt.datetime(2025, 1, 2),
+                                                  dt.datetime(2025, 1, 31), batch=1, workers=2, processes=1,
+                                                  source=LocalSource(drop='Adj Close'), db_dir=db_dir), 60))
+        except KeyError:
+            pass
+        else:
+            assert False, 'the ingest did not fail'
+
+def test_synthetic_adj_factor():
+    # c2c_ret from the stored close/adj_factor must match the synthetic total
+    # return (adj close), across splits, dividends and year boundaries
+    source = SyntheticSource(seed=1)
+    start_date, end_date = dt.datetime(2019, 1, 1), dt.datetime(2024, 12, 31)
+    with temp_db('S0001,S0002,S0003', start_date, end_date, source) as db_dir:
+        store = SharedStore.load(db_dir)
+        snapshot = store.snapshot(store.dates[-1])
+        assert np.allclose(snapshot['close_px'], [store.frame(ticker)['close_px'].iloc[-1] for ticker in snapshot.index])
+        for ticker in store.tickers:
+            adj_close = source.fetch([ticker], start_date=start_date, end_date=end_date)[ticker]['Adj Close']
+            returns = store.returns(ticker, start_date, end_date)['c2c_ret']
+            assert np.allclose(returns.iloc[1:], adj_close.pct_change().iloc[1:])
+
+def test_delta_upsert():
+    # daily appends as deltas (each download overlapping the previous last
+    # day, like --period auto) must read back as one download of the window
+    source = SyntheticSource(seed=3)
+    tickers = 'S0004,S0005'
+    ends = pd.bdate_range('2024-06-03', '2024-07-12', freq='W-FRI')
+    with tempfile.TemporaryDirectory() as db_dir, tempfile.TemporaryDirectory() as ref_dir:
+        ingest(ref_dir, tickers, dt.datetime(2024, 1, 2), ends[-1], source)
+        ingest(db_dir, tickers, dt.datetime(2024, 1, 2), ends[0], source)
+        for start_date, end_date in zip(ends[:-1], ends[1:]):
+            ingest(db_dir, tickers, start_date, end_date, source, mode='delta')
+        assert len(delta_files(db_dir, 'S0004', 2024)) == len(ends) - 1
+
+        def check():
+            assert load_catalog(db_dir)['S0005']['rows'] == load_catalog(ref_dir)['S0005']['rows']
+            for ticker in tickers.split(','):
+                pd.testing.assert_frame_equal(read_ticker(db_dir, ticker), read_ticker(ref_dir, ticker),
+                                              check_freq=False)
+        check()
+        # and once folded back into the year files
+        compact(db_dir, layout='per_ticker', codec='gzip')
+        assert not delta_files(db_dir, 'S0004')
+        check()
+
+def test_delta_tail():
+    # the tail of a partition and its catalog stats, read from the footers and
+    # the files they point to, match a full read, for appends and for a
+    # delta rewriting earlier rows, the catalog updates go to its log
+    source = SyntheticSource(seed=5)
+    windows = [(dt.datetime(2024, 5, 31), dt.datetime(2024, 6, 14)),
+               (dt.datetime(2024, 6, 14), dt.datetime(2024, 6, 28)),
+               (dt.datetime(2024, 3, 1), dt.datetime(2024, 3, 15))]
+    with temp_db('S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 5, 31), source) as db_dir:
+        with open(os.path.join(db_dir, '_catalog.json')) as f:
+            catalog_file = f.read()
+        for start_date, end_date in windows:
+            ingest(db_dir, 'S0001', start_date, end_date, source, mode='delta')
+            eod_data = read_partition(db_dir, 'S0001', 2024)
+            for before in [dt.datetime(2024, 7, 1), dt.datetime(2024, 6, 10), dt.datetime(2024, 3, 8),
+                           dt.datetime(2024, 1, 2)]:
+                for rows in [1, 6, 40]:
+                    expected = eod_data.loc[eod_data.index < before].iloc[-rows:]
+                    tail = read_tail(db_dir, 'S0001', 2024, before, rows)
+                    if expected.empty:
+                        assert tail is None or tail.empty
+                    else:
+                        pd.testing.assert_frame_equal(tail, expected, check_freq=False)
+            assert partition_stats(db_dir, 'S0001', 2024) == (eod_data.index[0], eod_data.index[-1], len(eod_data))
+            catalog = load_catalog(db_dir)
+            assert {ticker: {key: value for key, value in entry.items() if key != 'generation'}
+                    for ticker, entry in catalog.items()} == build_catalog(db_dir)
+        assert catalog['S0001']['generation'] == len(windows) + 1 and catalog['S0002']['generation'] == 1
+        with open(os.path.join(db_dir, '_catalog.json')) as f:
+            assert f.read() == catalog_file
+
+if __name__ == "__main__":
+    test_download()
+    test_download_retry()
+    test_download_empty()
+    test_download_gap()
+    test_download_upsert_error()
+    test_synthetic_adj_factor()
+    test_delta_upsert()
+    test_delta_tail()
@@ -1,7 +1,17 @@
 import requests
+import os
+import sys
+import tempfile
+import importlib
+import datetime as dt
 from logger import logger
 from io import StringIO
 import math
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+from synth import SyntheticSource
+from testing import ingest, temp_db
 
 YSERV_URL = 'http://127.0.0.1:8000'
 
@@ -26,21 +36,219 @@ def test_returns_by_date():
     assert math.isclose(returns.sum(axis=1).iloc[0], np.float64(-0.0253342119))
     #logger.info(f'\n{returns}')
 
+def test_returns_formats():
+    url = f'{YSERV_URL}/returns/NVDA,MSFT,AAPL,GOOG,AMZN,META/20250811'
+    response = requests.get(url, params={'format':'arrow'})
+    assert response.status_code == 200
+    returns = pa.ipc.open_stream(response.content).read_pandas().set_index('date')
+    assert math.isclose(returns.sum(axis=1).iloc[0], np.float64(-0.0253342119))
+    response = requests.get(url, headers={'accept':'text/csv'})
+    assert response.status_code == 200
+    returns = pd.read_csv(StringIO(response.text)).set_index('date')
+    assert math.isclose(returns.sum(axis=1).iloc[0], np.float64(-0.0253342119))
+    response = requests.get(url, params={'format':'columns'})
+    assert response.status_code == 200
+    returns = pd.DataFrame(response.json()).set_index('date')
+    assert math.isclose(returns.sum(axis=1).iloc[0], np.float64(-0.0253342119))
+
+def test_period_returns():
+    response = requests.get(f'{YSERV_URL}/returns/AAPL,MSFT/20231004/20250926')
+    daily = pd.read_json(StringIO(response.text)).set_index('date')
+    response = requests.get(f'{YSERV_URL}/returns/AAPL,MSFT/20231004/20250926/M')
+    assert response.status_code == 200
+    monthly = pd.read_json(StringIO(response.text)).set_index('date')
+    assert len(monthly) == len(daily.index.to_period('M').unique())
+    assert np.allclose((1.0 + monthly).prod(), (1.0 + daily).prod())
+    response = requests.get(f'{YSERV_URL}/returns/AAPL,MSFT/20231004/20250926/X')
+    assert response.status_code == 422
+
+def test_stats():
+    response = requests.get(f'{YSERV_URL}/returns/AAPL,MSFT/20231004/20250926')
+    returns = pd.read_json(StringIO(response.text)).set_index('date')
+    response = requests.get(f'{YSERV_URL}/stats/AAPL,MSFT/20231004/20250926')
+    assert response.status_code == 200
+    stats = pd.read_json(StringIO(response.text)).set_index('ticker')
+    assert np.allclose(stats['total_return'], (1.0 + returns).prod() - 1.0)
+    assert np.allclose(stats['ann_vol'], returns.std() * np.sqrt(252))
+    response = requests.get(f'{YSERV_URL}/cumreturns/AAPL,MSFT/20231004/20250926')
+    assert response.status_code == 200
+    cumreturns = pd.read_json(StringIO(response.text)).set_index('ticker')
+    assert np.allclose(cumreturns['total_return'], stats['total_return'])
+
+def test_prices():
+    url = f'{YSERV_URL}/prices/AAPL,MSFT/20231004/20250926'
+    response = requests.get(url, params={'adjusted':'true', 'fields':'close_px'})
+    assert response.status_code == 200
+    prices = pd.read_json(StringIO(response.text)).set_index('date')
+    response = requests.get(f'{YSERV_URL}/returns/AAPL/20231004/20250926')
+    returns = pd.read_json(StringIO(response.text)).set_index('date')
+    # adjusted closes compound to the returns
+    aapl = prices.loc[prices['ticker'] == 'AAPL', 'close_px']
+    assert math.isclose(aapl.iloc[-1] / aapl.iloc[0] - 1.0, (1.0 + returns['c2c_ret'].iloc[1:]).prod() - 1.0)
+    response = requests.get(url)
+    assert response.status_code == 200
+    assert pd.read_json(StringIO(response.text)).columns.tolist() == ['date', 'ticker', 'open_px', 'high_px',
+                                                                      'low_px', 'close_px', 'volume']
+
+def test_covariance():
+    response = requests.get(f'{YSERV_URL}/returns/AAPL,MSFT,NVDA/20231004/20250926')
+    returns = pd.read_json(StringIO(response.text)).set_index('date')
+    response = requests.get(f'{YSERV_URL}/covariance/AAPL,MSFT,NVDA/20231004/20250926')
+    assert response.status_code == 200
+    assert np.allclose(pd.read_json(StringIO(response.text)).set_index('ticker'), returns.cov())
+    response = requests.get(f'{YSERV_URL}/correlation/AAPL,MSFT,NVDA/20231004/20250926', params={'halflife':63})
+    assert response.status_code == 200
+    assert np.allclose(pd.read_json(StringIO(response.text)).set_index('ticker'),
+                       returns.ewm(halflife=63).corr().loc[returns.index[-1]])
+
+def test_snapshot():
+    response = requests.get(f'{YSERV_URL}/snapshot/20250811', params={'tickers':'NVDA,MSFT,AAPL,GOOG,AMZN,META'})
+    assert response.status_code == 200
+    snapshot = pd.read_json(StringIO(response.text)).set_index('ticker')
+    assert math.isclose(snapshot['c2c_ret'].sum(), np.float64(-0.0253342119))
+    response = requests.get(f'{YSERV_URL}/snapshot/20250811')
+    assert response.status_code == 200
+    assert set(snapshot.index) <= set(pd.read_json(StringIO(response.text))['ticker'])
+    # a saturday
+    response = requests.get(f'{YSERV_URL}/snapshot/20250809')
+    assert response.status_code == 404
+
+def test_returns_by_queries():
+    queries = {'queries':[{'tickers':'AAPL','start_date':'20231004','end_date':'20250926'},
+                          {'tickers':'NVDA,MSFT,AAPL,GOOG,AMZN,META','start_date':'20250811'}]}
+    response = requests.post(f'{YSERV_URL}/returns/query', json=queries)
+    assert response.status_code == 200
+    returns = pd.read_json(StringIO(response.text)).set_index('query')
+    assert math.isclose(returns.loc[0,'c2c_ret'].sum(), np.float64(0.4720421852))
+    assert math.isclose(returns.loc[1,'c2c_ret'].sum(), np.float64(-0.0253342119))
+
+def test_returns_stream():
+    url = f'{YSERV_URL}/returns/NVDA,MSFT,AAPL,GOOG,AMZN,META/20150101/20250926'
+    for fmt in ['json', 'csv', 'ndjson']:
+        response = requests.get(url, params={'format':fmt})
+        streamed = requests.get(url, params={'format':fmt, 'stream':'true'})
+        assert streamed.status_code == 200
+        assert streamed.content == response.content
+    streamed = requests.get(url, params={'format':'arrow', 'stream':'true'})
+    returns = pa.ipc.open_stream(streamed.content).read_pandas().set_index('date')
+    assert math.isclose(returns.loc['2025-08-11'].sum(), np.float64(-0.0253342119))
+    response = requests.get(f'{YSERV_URL}/returns/AAPLXX/20231004/20250926', params={'stream':'true'})
+    assert response.status_code == 404
+
+def test_conditional_get():
+    url = f'{YSERV_URL}/returns/AAPL,MSFT/20231004/20250926'
+    response = requests.get(url)
+    assert response.status_code == 200
+    assert 'max-age' in response.headers['cache-control']
+    cached = requests.get(url, headers={'if-none-match':response.headers['etag']})
+    assert cached.status_code == 304
+    cached = requests.get(url, headers={'if-modified-since':response.headers['last-modified']})
+    assert cached.status_code == 304
+    # same query, same etag
+    assert requests.get(f'{YSERV_URL}/returns/aapl,msft/2023-10-04/20250926').headers['etag'] == response.headers['etag']
+
 def test_missing_ric():
     # will raise not found error
     response = requests.get(f'{YSERV_URL}/returns/AAPLXX/20231004/20250926')
     assert response.status_code == 404
     #logger.info(f'{response.json()}')
 
+def test_subscribe():
+    # the stream opens with the reconnect delay, new rows only come after
+    # a yfetch run
+    with requests.get(f'{YSERV_URL}/subscribe/NVDA,MSFT,AAPL', stream=True, timeout=5) as response:
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        assert next(response.iter_lines(decode_unicode=True)).startswith('retry: ')
+    response = requests.get(f'{YSERV_URL}/subscribe/AAPLXX')
+    assert response.status_code == 404
+
 def test_invalid_date():
     # will raise value error
     response = requests.get(f'{YSERV_URL}/returns/AAPL/20230014/20250926')
     assert response.status_code == 422
     #logger.info(f'{response.json()}')
 
+def test_metrics():
+    requests.get(f'{YSERV_URL}/returns/AAPL/20231004/20250926')
+    response = requests.get(f'{YSERV_URL}/metrics')
+    assert response.status_code == 200
+    assert 'yserv_request_seconds_count{endpoint="/returns/{tickers}/{start_date}/{end_date}"' in response.text
+    assert 'yserv_worker_rss_bytes' in response.text
+
+def test_preload_ingest():
+    # in process: an ingest between the preload (in the gunicorn master) and
+    # the first request of a worker, the worker serves the new rows
+    source = SyntheticSource(seed=10)
+    with temp_db('S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), source) as db_dir:
+        # yserv reads its db dir at import
+        os.environ['YSERV_DB_DIR'] = db_dir
+        from fastapi.testclient import TestClient
+        yserv = importlib.reload(sys.modules['yserv']) if 'yserv' in sys.modules else importlib.import_module('yserv')
+        yserv.STORE = yserv.load_store()
+        ingest(db_dir, 'S0001', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12), source)
+        client = TestClient(yserv.app)
+        response = client.get('/returns/S0001/20240701/20240712')
+        assert response.status_code == 200
+        assert len(pd.read_json(StringIO(response.text))) == 10
+        assert yserv.STORE.dates[-1] == np.datetime64('2024-07-12')
+        assert client.get('/returns/S0002/20240701/20240712').status_code == 404
+
+def test_shared_store():
+    # in process: the workers map the store saved in the store dir, an ingest
+    # is read by the first worker reloading, the others map its new version
+    source = SyntheticSource(seed=11)
+    with temp_db('S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), source) as db_dir, \
+            tempfile.TemporaryDirectory() as store_dir:
+        os.environ['YSERV_DB_DIR'] = db_dir
+        yserv = importlib.reload(sys.modules['yserv']) if 'yserv' in sys.modules else importlib.import_module('yserv')
+        from catalog import load_catalog
+        yserv.STORE_DIR = store_dir
+        store = yserv.load_store()
+        assert all(isinstance(array, np.memmap) for array in store.state().values())
+        ingest(db_dir, 'S0001,S0003', dt.datetime(2024, 6, 28), dt.datetime(2024, 7, 12), source)
+        catalog = load_catalog(db_dir)
+        changed, removed = yserv.catalog_changes(store.catalog, catalog)
+        first = yserv.reload_store(store, catalog, changed, removed)
+        second = yserv.reload_store(store, catalog, changed, removed)
+        assert first.version != store.version and second.version == first.version
+        assert isinstance(second.prefix['sum'], np.memmap) and yserv.reload_store(second, catalog, [], []) is second
+        expected = yserv.SharedStore.load(db_dir)
+        assert list(second.tickers) == list(expected.tickers)
+        for name, array in expected.state().items():
+            assert np.array_equal(second.state()[name], array, equal_nan=True)
+
+def test_stream_no_rows():
+    # in process, from the partitions: a window inside the catalog date range
+    # of a ticker without any of its rows (a weekend) is a 404 streamed too
+    with temp_db('S0001,S0002', dt.datetime(2024, 1, 2), dt.datetime(2024, 6, 28), SyntheticSource(seed=12)) as db_dir:
+        os.environ['YSERV_DB_DIR'] = db_dir
+        from fastapi.testclient import TestClient
+        yserv = importlib.reload(sys.modules['yserv']) if 'yserv' in sys.modules else importlib.import_module('yserv')
+        yserv.STORE = None
+        client = TestClient(yserv.app)
+        for stream in ['false', 'true']:
+            assert client.get('/returns/S0001,S0002/20240309/20240310', params={'stream': stream}).status_code == 404
+            response = client.get('/returns/S0001,S0002/20240301/20240310', params={'stream': stream})
+            assert response.status_code == 200 and len(pd.read_json(StringIO(response.text))) == 6
+
 if __name__ == "__main__":
     test_tickers()
     test_returns()
     test_returns_by_date()
+    test_returns_formats()
+    test_period_returns()
+    test_stats()
+    test_prices()
+    test_covariance()
+    test_snapshot()
+    test_returns_by_queries()
+    test_returns_stream()
+    test_conditional_get()
+    test_subscribe()
     test_missing_ric()
     test_invalid_date()
+    test_metrics()
+    test_preload_ingest()
+    test_shared_store()
+    test_stream_no_rows()
@@ -0,0 +1,18 @@
+"""shared set up for the offline tests"""
+import asyncio
+import tempfile
+from contextlib import contextmanager
+from yfetch import download
+
+def ingest(db_dir, tickers, start_date, end_date, source, **kwargs):
+    # one download into db_dir with a single fetcher and upsert process,
+    # returns the quality report of the ingest
+    return asyncio.run(download(tickers, None, start_date, end_date, workers=1, processes=1, source=source,
+                                db_dir=db_dir, **kwargs))
+
+@contextmanager
+def temp_db(tickers, start_date, end_date, source, **kwargs):
+    # a temporary db dir holding a first download of tickers from source
+    with tempfile.TemporaryDirectory() as db_dir:
+        ingest(db_dir, tickers, start_date, end_date, source, **kwargs)
+        yield db_dir
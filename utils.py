@@ -3,6 +3,7 @@ import numpy as np
 from dependency_injector import providers, containers
 from os import path, getcwd
 import os
+from collections import OrderedDict
 
 valid_date_formats = ['%Y%m%d', '%Y-%m-%d', '%Y.%m.%d', '%Y/%m/%d', '%d/%m/%Y', '%Y-%m-%dD%H:%M:%S.000000000',
                           '%Y-%m-%d %H:%M:%S']
@@ -38,3 +39,53 @@ class ApplicationConfig:
     def __init__(self, _location=None):
         self.data = providers.Configuration()
         self.data.from_yaml(yaml_path('app_config.yaml', './', '', _location), required=True)
+        # the data location can be overridden from the environment, eg. to
+        # run against a synthetic store
+        if os.environ.get('YSERV_DB_DIR'):
+            self.data.db_dir.from_value(os.environ['YSERV_DB_DIR'])
+
+class ByteLRUCache:
+    """lru cache bounded by the total size (in bytes) of the cached values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def put(self, key, value, nbytes):
+        self.pop(key)
+        # never cache something larger than the whole cache
+        if nbytes > self.max_bytes:
+            return value
+        self._data[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._data.popitem(last=False)
+            self.nbytes -= evicted
+        return value
+
+    def pop(self, key):
+        if key in self._data:
+            value, nbytes = self._data.pop(key)
+            self.nbytes -= nbytes
+            return value
+        return None
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
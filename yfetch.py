@@ -8,8 +8,12 @@ from logger import logger
 import pandas as pd
 import numpy as np
 import datetime as dt
-from yserv import _get_tickers
-import sys
+from catalog import load_catalog, update_catalog, catalog_frame
+from store import read_layout, read_partition, read_tail, ticker_years, delta_files, delta_path, write_parquet, merge_deltas
+from synth import SyntheticSource
+from export import export_store
+import quality
+from concurrent.futures import ProcessPoolExecutor
 
 app_config = ApplicationConfig(__file__)
 base_dir = app_config.data.base_dir()
@@ -20,108 +24,155 @@ __default_rics__='NVDA,MSFT,AAPL,GOOG,AMZN,META,AVGO,TSLA,JPM,WMT,ORCL,LLY,V,MA,
 #DB_DIR = os.path.join(os.path.dirname(__file__), "parquet")
 DB_DIR = app_config.data.db_dir()
 
-async def upsert(tickers, eod_data):
+# delta: new rows are appended as small delta files, folded into the year
+# file once a partition has more than max_deltas, rewrite: the year file is
+# rewritten on every upsert
+UPSERT_MODES = ['delta', 'rewrite']
+UPSERT_MODE = app_config.data.upsert_mode() or 'delta'
+MAX_DELTAS = app_config.data.max_deltas() or 20
+
+# thresholds of the data quality checks, defaults in quality.THRESHOLDS
+QUALITY = quality.thresholds(app_config.data.quality())
+
+# memory mappable export of the store rewritten after every download that
+# wrote anything (see export.py), none: no export
+EXPORT_DIR = app_config.data.export_dir()
+
+class GapError(ValueError):
+    """new rows of a ticker starting max_gap_days or more after its last stored row"""
+
+class YahooSource:
+    """yahoo finance via yfinance, returns the yf.download frame (group_by tickers) with the actions"""
+
+    def fetch(self, tickers, period=None, start_date=None, end_date=None):
+        if period:
+            return yf.download(tickers=' '.join(tickers), period=period, group_by="tickers",auto_adjust=False,
+                               actions=True)
+        # to make end_date inclusive we add a day to it
+        return yf.download(tickers=' '.join(tickers), start=start_date, end=end_date+dt.timedelta(days=1), group_by="tickers",auto_adjust=False,
+                           actions=True)
+
+# data sources selectable with --source, any object with a fetch method
+# returning a yf.download like frame can be plugged in
+SOURCES = {'yahoo': YahooSource, 'synthetic': SyntheticSource}
+
+def fetch(source, tickers, period=None, start_date=None, end_date=None):
+    eod_data = source.fetch(tickers, period=period, start_date=start_date, end_date=end_date)
+    if not eod_data.empty:
+        eod_data.rename(columns={'Open':'open_px','High':'high_px','Low':'low_px','Close':'close_px',
+                                 'Adj Close':'adj_factor','Volume':'volume','Stock Splits':'split_ratio'}, inplace=True)
+        # the dividends are in adj close already
+        eod_data = eod_data.drop(columns='Dividends', level=1, errors='ignore')
+        eod_data.index.name = 'date'
+        eod_data.columns.names=['ticker','price']
+    return eod_data
+
+def upsert(tickers, eod_data, db_dir=None, mode=None):
+    """
+    writes the downloaded tickers, returns the tickers written and per ticker
+    the close_px/adj_factor of the new rows plus the stored rows just before
+    them (new=False), the input of the quality checks run once per download
+    """
+    db_dir = db_dir or DB_DIR
+    mode = mode or UPSERT_MODE
     # ensure we only have weekdays
     eod_data = eod_data.loc[eod_data.index.weekday < 5] 
+    written, checked = [], {}
+    try:
+        _upsert(tickers, eod_data, written, checked, db_dir, mode)
+    finally:
+        # keep the ticker catalog in line with what has been written, the
+        # event log tells yserv subscribers about the new rows
+        if written:
+            windows = {ric: checked[ric].index[checked[ric]['new']][[0, -1]] for ric in written}
+            update_catalog(db_dir, written, windows=windows)
+    return written, checked
+
+def _lookback(db_dir, ticker, date, years, rows):
+    # the last rows stored before date, walking back over the partitions,
+    # only the end of each is read (see read_tail)
+    columns = ['close_px', 'adj_factor']
+    parts = []
+    for year in sorted((year for year in years if year <= date.year), reverse=True):
+        eod_data = read_tail(db_dir, ticker, year, date, rows - sum(len(part) for part in parts), columns=columns)
+        if eod_data is not None:
+            parts.insert(0, eod_data)
+        if sum(len(part) for part in parts) >= rows:
+            break
+    if not parts:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='date'), dtype=np.float64)
+    return pd.concat(parts, sort=False).iloc[-rows:]
+
+def _upsert(tickers, eod_data, written, checked, db_dir, mode):
+    codec = read_layout(db_dir)['codec']
     for ric in tickers:
         logger.info(f'Processing {ric}')
         if ric in eod_data.columns.get_level_values('ticker'):
             data = eod_data[ric]
-            # derive the adjustment factor
-            for year, data in eod_data[ric].groupby(eod_data.index.year):
-                # excluded nans
-                data = data.loc[np.isfinite(data['close_px'])]
-                # note: there is no point in saving adj_close_px as its backward
-                # adjusted so purely depends on the start and end date window 
-                # requested by the client, we can potentially save c2c_ret but
-                # its a straight forward calculation which can be done on the fly
-                # in the service api, so we just calculate the adj_factor applicable
-                # on the day t and save it along with ohlc and volume
-                adjs = data['adj_factor'].ffill()/data['close_px'].ffill()
-                data['adj_factor'] = (adjs[::-1]/adjs[::-1].shift(1).fillna(1.0))[::-1]
-                # a tab on how much data is being updated
-                data_len = len(data)
-                dir_path = os.path.join(DB_DIR, f'{ric}')
-                if not os.path.exists(dir_path):
-                    os.makedirs(dir_path)
-                file_path = os.path.join(dir_path, f'{year}.parquet')
-                # need to check if file already exists, if it does then we need to
-                # update the existing version...
-                if os.path.exists(file_path):
-                    existing = pd.read_parquet(file_path)
-                    # get the last date of existing data
-                    existing_end_date = existing.index[-1].date()
-                    data_start_date = data.index[0].date()
-                    delta_days = data_start_date - existing_end_date
-                    if delta_days.days >= 5:
-                        logger.error(f'New data insertion for {ric} creates a gap of >= 5 days [{existing_end_date} : {data_start_date}], please check!! aborting...')
-                        sys.exit(1)
-                    # ignore those dates which are there in data
-                    ignored = np.isin(existing.index, data.index)
-                    data = pd.concat([existing[~ignored], data], sort=False).sort_index()
-                    
-                # hold a pointer to data for checks
-                data_ = data
-                # if we dont have much as we could be at the start of the
-                # year, we have to load a bit for checks
-                if len(data) < 20:
-                    lookback_date = data.index[0].date()-dt.timedelta(2*20)
-                    if lookback_date.year < year:
-                        file_path = os.path.join(dir_path, f'{lookback_date.year}.parquet')
-                        if os.path.exists(file_path):
-                            sel = [("date",">=",lookback_date)]
-                            lookback_data = pd.read_parquet(file_path, filters=sel)
-                            data_ = pd.concat((lookback_data, data_), sort=False).sort_index()
-                # data checks, winsorisation if any..
-                if len(data_) > 20:
-                    # detect gaps
-                    gap_ts = data_.index.diff().days.fillna(0)
-                    max_gap = gap_ts.max()
-                    if max_gap >= 5:
-                        max_gap_idx = np.argmax(gap_ts)
-                        logger.error(f'{max_gap} days gap detected for {ric}, please check!!')
-                        logger.error(f'\n{data_.iloc[max_gap_idx-1:max_gap_idx+1]}')
-                    # check if there is an outlier in the data
-                    # this can be based on either percentage change
-                    # or some std away from a rolling average
-                    roll_adj_cum_prod = data_['adj_factor'][::-1].cumprod()[::-1]
-                    adj_close_px = data_['close_px'].multiply(roll_adj_cum_prod, axis='rows')
-                    adj_close_px.name = 'adj_close_px'
-                    c2c_ret = ((adj_close_px.ffill() / adj_close_px.ffill().shift(1)) - 1.0)*100.0
-                    c2c_ret.name = 'c2c_ret'
-                    # rolling mean of 5 days
-                    mu = c2c_ret.shift(1).rolling(5).mean()
-                    sd = c2c_ret.shift(1).rolling(5).std()
-                    min_level = mu - 5 * sd # < 5 std
-                    max_level = mu + 5 * sd # > 5 std
-                    check_max = c2c_ret > max_level 
-                    check_min = c2c_ret < min_level 
-                    # to show the previous entry to the outlier
-                    check_max = check_max | check_max.shift(-1)
-                    check_min = check_min | check_min.shift(-1)
-                    #check_max = check_max.fillna(False).infer_objects(copy=False)
-                    #check_min = check_min.fillna(False).infer_objects(copy=False)
-                    # only check for the length of the new data
-                    check_max.iloc[:-data_len] = False
-                    check_min.iloc[:-data_len] = False
-                    if np.any(check_max):
-                        logger.warning(f'Detected outliers for {ric} > +5 std (based on 5 day rolling mean), please check!')
-                        logger.warning(f"\n{pd.concat((data_['close_px'],adj_close_px,c2c_ret),axis=1)[check_max]}")
-                    if np.any(check_min):
-                        logger.warning(f'Detected outliers for {ric} < -5 std (based on 5 day rolling mean), please check!')
-                        #logger.warning(f"\n{data_.loc[check_min,['close_px','c2c_ret']]}")
-                        logger.warning(f"\n{pd.concat((data_['close_px'],adj_close_px,c2c_ret),axis=1)[check_min]}")
-                    check_stale = c2c_ret == 0.0
-                    check_stale = check_stale | check_stale.shift(-1)
-                    check_stale.iloc[:-data_len] = False
-                    if np.any(check_stale):
-                        logger.warning(f'Detected stale prices for {ric}, please check!')
-                        logger.warning(f"\n{pd.concat((data_['close_px'],adj_close_px,c2c_ret),axis=1)[check_stale]}")
-
-                # write to parquet file
-                data.to_parquet(file_path, index=True, compression='gzip')
-
-async def download(tickers, period, start_date, end_date, batch=5):
+            # excluded nans
+            data = data.loc[np.isfinite(data['close_px'])].copy()
+            if data.empty:
+                continue
+            # note: there is no point in saving adj_close_px as its backward
+            # adjusted so purely depends on the start and end date window 
+            # requested by the client, we can potentially save c2c_ret but
+            # its a straight forward calculation which can be done on the fly
+            # in the service api, so we just calculate the adj_factor applicable
+            # on the day t and save it along with ohlc and volume
+            # derive the adjustment factor over the whole download, not per
+            # year, the factor on the last day of a year depends on the next day
+            adjs = data['adj_factor'].ffill()/data['close_px'].ffill()
+            data['adj_factor'] = (adjs[::-1]/adjs[::-1].shift(1).fillna(1.0))[::-1]
+            # the split ratio on its ex date as the source reports it (yahoo's
+            # stock splits, 0 on the other days), 1 without a split, the
+            # adjusted volume only follows the splits
+            split_ratio = data['split_ratio'] if 'split_ratio' in data else pd.Series(1.0, index=data.index)
+            data['split_ratio'] = split_ratio.where(split_ratio > 0, 1.0)
+            years = ticker_years(db_dir, ric)
+            # what is stored just before the new data, the context of the
+            # rolling quality checks (see quality.py)
+            lookback = _lookback(db_dir, ric, data.index[0], years, quality.lookback_rows(QUALITY))
+            if not lookback.empty:
+                existing_end_date = lookback.index[-1].date()
+                data_start_date = data.index[0].date()
+                delta_days = data_start_date - existing_end_date
+                if delta_days.days >= QUALITY['max_gap_days']:
+                    # raised in the upsert process, logged by the pipeline
+                    raise GapError(f'New data insertion for {ric} creates a gap of >= {QUALITY["max_gap_days"]} days [{existing_end_date} : {data_start_date}], please check!!')
+            checked[ric] = pd.concat([lookback.assign(new=False),
+                                      data[['close_px', 'adj_factor']].assign(new=True)], sort=False)
+
+            for year, data in data.groupby(data.index.year):
+                file_path = os.path.join(db_dir, f'{ric}', f'{year}.parquet')
+                if mode == 'delta' and year in years:
+                    # only the new rows, the deltas of a partition are folded
+                    # into its year file once there are more than max_deltas
+                    write_parquet(data, delta_path(db_dir, ric, year), codec)
+                    if len(delta_files(db_dir, ric, year)) > MAX_DELTAS:
+                        merge_deltas(db_dir, ric, year, codec)
+                else:
+                    deltas = delta_files(db_dir, ric, year)
+                    # need to check if file already exists, if it does then we need to
+                    # update the existing version...
+                    if year in years:
+                        # the year file or, after a compaction, the row group of
+                        # the yearly file (see compact.py) plus its deltas
+                        existing = read_partition(db_dir, ric, year)
+                        # ignore those dates which are there in data
+                        ignored = np.isin(existing.index, data.index)
+                        data = pd.concat([existing[~ignored], data], sort=False).sort_index()
+                    # the deltas (if any) are now folded in
+                    write_parquet(data, file_path, codec)
+                    for delta in deltas:
+                        delta.unlink()
+                if ric not in written:
+                    written.append(ric)
+
+async def download(tickers, period, start_date, end_date, batch=5, workers=4, processes=4, retries=3,
+                   backoff=1.0, source=None, db_dir=None, mode=None, report_file=None, export_dir=None):
+    db_dir = db_dir or DB_DIR
+    export_dir = export_dir or EXPORT_DIR
+    source = source or YahooSource()
     tickers = np.array(tickers.split(','))
     batches = [(tickers[i:i+batch], (period,start_date,end_date)) for i in range(0, len(tickers), batch)]
     if period:
@@ -129,15 +180,13 @@ async def download(tickers, period, start_date, end_date, batch=5):
         if period == 'auto':
             end_date = yesterday(business_day=True)
             batches = []
-            _get_tickers.cache_clear()
-            db_tickers = (await _get_tickers()).set_index('ticker')
+            db_tickers = catalog_frame(load_catalog(db_dir)).set_index('ticker')
             # what if there are new tickers !!??
             # we need a default start_date else complain and exit
             new_tickers_mask = ~np.isin(tickers, db_tickers.index.values)
             if np.any(new_tickers_mask):
                 if not start_date:
-                    logger.warning(f"New tickers provided {tickers[new_tickers_mask]},\ncant identify default start date for new tickers with '--period=auto' mode, please also provide '--start_date'!! aborting...")
-                    sys.exit(1)
+                    raise click.UsageError(f"New tickers provided {tickers[new_tickers_mask]},\ncant identify default start date for new tickers with '--period=auto' mode, please also provide '--start_date'!!")
                 new_tickers = tickers[new_tickers_mask]
                 batches = [(new_tickers[i:i+batch], (None,start_date,end_date)) for i in range(0, len(new_tickers), batch)]
                 
@@ -149,24 +198,93 @@ async def download(tickers, period, start_date, end_date, batch=5):
             for item in db_tickers.items():
                 start_date = item[0].to_pydatetime()
                 upsert_tickers = [str(t) for t in item[1]]
-                batches.append([(upsert_tickers[i:i+batch], (None,start_date,end_date)) for i in range(0, len(upsert_tickers), batch)][0])
+                batches.extend([(upsert_tickers[i:i+batch], (None,start_date,end_date)) for i in range(0, len(upsert_tickers), batch)])
+
+    checked = await pipeline(batches, source, db_dir, workers=workers, processes=processes, retries=retries,
+                             backoff=backoff, mode=mode)
+
+    # data quality checks, once over everything written by this run
+    report = quality.check_frames(checked, limits=QUALITY)
+    quality.summarize(report)
+    if report_file or not report.empty:
+        quality.save_report(report, report_file or quality.report_path(db_dir, app_config.data.quality_dir()))
 
+    if export_dir and checked:
+        export_store(db_dir, export_dir, dtype=app_config.data.store_dtype() or 'float64')
+    return report
+
+async def pipeline(batches, source, db_dir, workers=4, processes=4, retries=3, backoff=1.0, mode=None):
+    # workers fetch batches concurrently (each in its own process, yfinance
+    # keeps module level state per download) and feed a bounded queue drained
+    # by a process pool running the upserts, so network and parquet/gzip cpu
+    # overlap, the queue bounds how many downloaded batches are held in memory
+    loop = asyncio.get_running_loop()
+    todo = asyncio.Queue()
     for batch in batches:
-        batch_tickers = batch[0]
-        batch_period, batch_start_date, batch_end_date = batch[1]
-        if batch_period:
-            logger.info(f'Processing batch: tickers: {batch_tickers}, period: {batch_period}')
-            eod_data = yf.download(tickers=' '.join(batch_tickers), period=batch_period, group_by="tickers",auto_adjust=False)
-        else:
-            logger.info(f'Processing batch: tickers: {batch_tickers}, start_date: {batch_start_date.date()}, end_date: {batch_end_date.date()}')
-            # to make end_date inclusive we add a day to it
-            eod_data = yf.download(tickers=' '.join(batch_tickers), start=batch_start_date, end=batch_end_date+dt.timedelta(days=1), group_by="tickers",auto_adjust=False)
-        if not eod_data.empty:
-            eod_data.rename(columns={'Open':'open_px','High':'high_px','Low':'low_px','Close':'close_px',
-                                     'Adj Close':'adj_factor','Volume':'volume'}, inplace=True)
-            eod_data.index.name = 'date'
-            eod_data.columns.names=['ticker','price']
-            await upsert(batch_tickers, eod_data)
+        todo.put_nowait(batch)
+    fetched = asyncio.Queue(maxsize=2*processes)
+    checked = {}
+
+    async def fetcher(fetch_pool):
+        while True:
+            try:
+                batch_tickers, (batch_period, batch_start_date, batch_end_date) = todo.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if batch_period:
+                logger.info(f'Processing batch: tickers: {batch_tickers}, period: {batch_period}')
+            else:
+                logger.info(f'Processing batch: tickers: {batch_tickers}, start_date: {batch_start_date.date()}, end_date: {batch_end_date.date()}')
+            for attempt in range(retries+1):
+                try:
+                    eod_data = await loop.run_in_executor(fetch_pool, fetch, source, list(batch_tickers),
+                                                          batch_period, batch_start_date, batch_end_date)
+                    break
+                except Exception as e:
+                    if attempt == retries:
+                        raise
+                    logger.warning(f'Failed batch: tickers: {batch_tickers}, attempt {attempt+1}/{retries+1}: {e}')
+                await asyncio.sleep(backoff * 2**attempt)
+            # no rows is an answer (nothing new since the last run), not a
+            # failure to retry
+            if eod_data.empty:
+                logger.info(f'No new data for batch: tickers: {batch_tickers}')
+            else:
+                await fetched.put((list(batch_tickers), eod_data))
+
+    async def writer(upsert_pool):
+        while True:
+            item = await fetched.get()
+            try:
+                if item is None:
+                    return
+                batch_tickers, eod_data = item
+                _, batch_checked = await loop.run_in_executor(upsert_pool, upsert, batch_tickers, eod_data, db_dir, mode)
+                checked.update(batch_checked)
+            finally:
+                fetched.task_done()
+
+    with ProcessPoolExecutor(max_workers=workers) as fetch_pool, ProcessPoolExecutor(max_workers=processes) as upsert_pool:
+        async def fetchers():
+            await asyncio.gather(*[fetcher(fetch_pool) for i in range(workers)])
+            for i in range(processes):
+                await fetched.put(None)
+
+        # fetchers and writers awaited together, the first failure (a batch
+        # out of retries, an upsert raising) ends the run, a dead writer must
+        # not leave the fetchers blocked on the full queue
+        tasks = [asyncio.create_task(fetchers())] + [asyncio.create_task(writer(upsert_pool))
+                                                     for i in range(processes)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            logger.error(f'Ingest failed: {e}')
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return checked
 
 @click.command()
 @click.option('--tickers',
@@ -181,6 +299,46 @@ async def download(tickers, period, start_date, end_date, batch=5):
               required=False,
               show_default=True,
               help='1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max,auto\n[auto: automatically detect last available date for present tickers and backfills till yesterday, please also provide --start_date if there are any new tickers and auto option is used, start_date will be applied on new tickers only]')
+@click.option('--source',
+              type=click.Choice(list(SOURCES)),
+              default='yahoo',
+              required=False,
+              show_default=True,
+              help='data source')
+@click.option('--workers',
+              type=click.INT,
+              default=4,
+              required=False,
+              show_default=True,
+              help='number of concurrent download workers')
+@click.option('--processes',
+              type=click.INT,
+              default=4,
+              required=False,
+              show_default=True,
+              help='number of processes writing the parquet files')
+@click.option('--retries',
+              type=click.INT,
+              default=3,
+              required=False,
+              show_default=True,
+              help='number of retries (with exponential backoff) of a failed download')
+@click.option('--mode',
+              type=click.Choice(UPSERT_MODES),
+              default=UPSERT_MODE,
+              required=False,
+              show_default=True,
+              help='delta: append new rows as delta files, rewrite: rewrite the year files (upsert_mode in app_config.yaml)')
+@click.option('--report',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='data quality report, .parquet or .json  [default: {db_dir}/_quality/{timestamp}.parquet when anything is flagged]')
+@click.option('--export_dir',
+              type=click.STRING,
+              default=None,
+              required=False,
+              help='rewrite the memory mappable export of the store after the download  [default: export_dir in app_config.yaml, no export when not set]')
 @click.option('--start_date',
               type=click.DateTime(formats=valid_date_formats),
               default=None,
@@ -193,7 +351,7 @@ async def download(tickers, period, start_date, end_date, batch=5):
               required=False,
               show_default=True,
               help='query end date')
-def main(tickers, period, start_date, end_date):
+def main(tickers, period, source, workers, processes, retries, mode, report, export_dir, start_date, end_date):
     """yfinance downloader"""
     logger.info(f"DB_DIR: {DB_DIR}")
 
@@ -216,7 +374,12 @@ def main(tickers, period, start_date, end_date):
     if not period and not start_date and not end_date:
         raise click.BadArgumentUsage("Please provide an option '--period' or a combination of '--start_date' and '--end_date'") 
 
-    asyncio.run(download(tickers, period, start_date, end_date))
+    try:
+        asyncio.run(download(tickers, period, start_date, end_date, workers=workers, processes=processes,
+                             retries=retries, source=SOURCES[source](), mode=mode, report_file=report,
+                             export_dir=export_dir))
+    except GapError as e:
+        raise click.ClickException(str(e))
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,8 @@
 import click
 from gunicorn.app.base import BaseApplication
-from fastapi import FastAPI, Depends, HTTPException, Response
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
 from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
 from datetime import date
 import glob
 from pathlib import Path
@@ -10,13 +11,33 @@ import datetime as dt
 import os
 import pandas as pd
 import numpy as np
-from async_lru import alru_cache
 from pydantic import BaseModel, field_validator, AfterValidator, BeforeValidator
 from typing import Annotated, Optional
 from logger import logger
+from store import SharedStore, PartitionStore, PRICE_COLUMNS, ADJUST_COLUMNS
+from dataset import DatasetStore
+from catalog import load_catalog, catalog_frame, catalog_mtime
+from formats import negotiate, render, to_json, StreamWriter
+from events import EventHub
+from export import STORE_DIR as EXPORT_STORE_DIR, store_lock, store_header_path, read_store_header, save_store, map_store
+from cache import ResponseCache
+from analytics import prefix_sums, window_summary, compound, covariance, PERIODS
+from metrics import MetricsMiddleware, Profiler
+import metrics
+import gc
+import shutil
+import tempfile
+import time
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 app = FastAPI()
+# the metrics middleware wraps the gzip middleware on both sides, the inner
+# one times the handler and the outer one the whole request
+app.add_middleware(MetricsMiddleware, inner=True)
 app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(MetricsMiddleware)
 
 app_config = ApplicationConfig(__file__)
 base_dir = app_config.data.base_dir()
@@ -24,23 +45,167 @@ base_dir = app_config.data.base_dir()
 #DB_DIR = os.path.join(os.path.dirname(__file__), "parquet")
 DB_DIR = app_config.data.db_dir()
 
-@alru_cache(maxsize=1)
+# shared columnar store, loaded in the gunicorn master before the workers are
+# forked (see main), when not loaded we fall back to reading the parquet files
+STORE = None
+# float64 or float32 (half the memory for the value arrays, see SharedStore)
+STORE_DTYPE = app_config.data.store_dtype() or 'float64'
+# when yfetch keeps an export of the store (see export.py) the store is
+# mapped from the store dir saved with it instead of read from the parquet
+# files
+EXPORT_DIR = app_config.data.export_dir()
+# the store dir every worker maps the store from (see export.save_store), the
+# one of the export or a temporary one of the server (see main), none: each
+# process holds its own store
+STORE_DIR = os.path.join(EXPORT_DIR, EXPORT_STORE_DIR) if EXPORT_DIR else None
+
+def load_store():
+    # the catalog is read first and kept with the store, a worker diffs its
+    # first catalog against it (an ingest after the preload, see _load_catalog)
+    if STORE_DIR is not None:
+        return shared_store()
+    catalog = load_catalog(DB_DIR)
+    store = SharedStore.load(DB_DIR, dtype=STORE_DTYPE)
+    store.catalog = catalog
+    return store
+
+def shared_store(store=None):
+    # the store of the store dir brought up to date with the catalog, the
+    # first worker seeing a change refreshes it and saves a new version under
+    # the lock, the others find it up to date and only map it, so the store
+    # (prefix sums and date major copy included) is built once and its pages
+    # shared by every worker
+    with store_lock(STORE_DIR):
+        catalog = load_catalog(DB_DIR)
+        if os.path.exists(store_header_path(STORE_DIR)):
+            header = read_store_header(STORE_DIR)
+            changed, removed = catalog_changes(header['catalog'], catalog)
+            if not (changed or removed):
+                if store is not None and store.version == header['version']:
+                    return store
+                return map_store(STORE_DIR)
+            # only the tickers written since are read from the parquet files
+            refreshed = map_store(STORE_DIR).refresh(DB_DIR, changed, removed)
+        else:
+            refreshed = SharedStore.load(DB_DIR, dtype=STORE_DTYPE)
+        save_store(refreshed, STORE_DIR, catalog)
+    # the private arrays of the refresh are dropped for the saved ones
+    return map_store(STORE_DIR)
+
+def reload_store(store, catalog, changed, removed):
+    # with a store dir the shared store is brought up to date (read once by
+    # whichever worker gets there first, mapped by the others), otherwise
+    # only the changed tickers are read into a copy of the store of this
+    # worker
+    if STORE_DIR is not None:
+        return shared_store(store)
+    store = store.refresh(DB_DIR, changed, removed)
+    store.catalog = catalog
+    return store
+
+def catalog_changes(current, catalog):
+    # tickers changed (or new) and removed from current to catalog
+    return ([ticker for ticker, entry in catalog.items() if current.get(ticker) != entry],
+            [ticker for ticker in current if ticker not in catalog])
+
+# cold loads (parquet reads, the catalog) run in a bounded pool of threads
+# so they never block the event loop, pyarrow releases the gil while reading
+LOADERS = ThreadPoolExecutor(max_workers=app_config.data.load_workers() or 4, thread_name_prefix='loader')
+
+# range aware reader of the yearly parquet partitions, only reads the years
+# a query needs and caches them per (ticker, year) bounded by size, or with
+# backend: dataset pushed down pyarrow dataset scans of the files (no cache)
+BACKENDS = {'pandas': PartitionStore, 'dataset': DatasetStore}
+BACKEND = BACKENDS[app_config.data.backend() or 'pandas']
+PARTITIONS = BACKEND(DB_DIR, max_bytes=(app_config.data.partition_cache_mb() or 256)*2**20, executor=LOADERS)
+# the same for the ohlcv of /prices, the shared store only has close_px
+PRICES = BACKEND(DB_DIR, max_bytes=(app_config.data.partition_cache_mb() or 256)*2**20,
+                 columns=PRICE_COLUMNS + ADJUST_COLUMNS, executor=LOADERS)
+
+# the catalog doubles as the data version, yfetch.upsert rewrites it
+# atomically on every ingest bumping the generation of the tickers it wrote,
+# its mtime is checked at most every reload_check_secs and the changed
+# tickers are reloaded in the background while the old data keeps serving
+RELOAD_CHECK_SECS = app_config.data.reload_check_secs() or 1.0
+CATALOG = {'catalog': None, 'tickers': None, 'mtime': None, 'checked': 0.0, 'refresh': None, 'loading': None}
+
+# ?stream=true responses are sent in chunks of about this many cells
+# (dates x tickers), bounding the memory a large query holds at any time
+STREAM_CHUNK_CELLS = app_config.data.stream_chunk_cells() or 1_000_000
+
+# encoded (and gzipped) responses keyed on the normalized query and the data
+# version, response_cache_mb: 0 disables it
+RESPONSE_CACHE_MB = app_config.data.response_cache_mb()
+RESPONSES = ResponseCache(max_bytes=(256 if RESPONSE_CACHE_MB is None else RESPONSE_CACHE_MB)*2**20,
+                          max_age=app_config.data.response_cache_max_age() or 60, executor=LOADERS)
+
+async def _load_catalog():
+    global STORE
+    with metrics.stage('catalog_load'):
+        mtime = catalog_mtime(DB_DIR)
+        catalog = await asyncio.get_running_loop().run_in_executor(LOADERS, load_catalog, DB_DIR)
+    if STORE is not None and STORE.catalog is not None:
+        # the store preloaded in the master predates anything yfetch wrote
+        # before this worker loaded its catalog
+        changed, removed = catalog_changes(STORE.catalog, catalog)
+        if changed or removed:
+            logger.info(f'Reloading tickers written since the preload: {changed + removed}')
+            with metrics.stage('store_reload'):
+                STORE = await asyncio.get_running_loop().run_in_executor(LOADERS, reload_store, STORE, catalog,
+                                                                         changed, removed)
+    CATALOG.update(catalog=catalog, mtime=mtime, checked=time.monotonic())
+
+async def _get_catalog():
+    if CATALOG['catalog'] is None:
+        # the first requests of a worker all wait on the same load
+        metrics.cache('catalog', None if CATALOG['loading'] else False)
+        if CATALOG['loading'] is None:
+            CATALOG['loading'] = asyncio.ensure_future(_load_catalog())
+            CATALOG['loading'].add_done_callback(lambda task: CATALOG.update(loading=None))
+        await asyncio.shield(CATALOG['loading'])
+        return CATALOG['catalog']
+    metrics.cache('catalog', True)
+    if time.monotonic() - CATALOG['checked'] > RELOAD_CHECK_SECS:
+        CATALOG['checked'] = time.monotonic()
+        if catalog_mtime(DB_DIR) != CATALOG['mtime'] and CATALOG['refresh'] is None:
+            CATALOG['refresh'] = asyncio.create_task(_refresh_catalog())
+    return CATALOG['catalog']
+
+async def _refresh_catalog():
+    global STORE
+    try:
+        mtime = catalog_mtime(DB_DIR)
+        catalog = await asyncio.to_thread(load_catalog, DB_DIR)
+        changed, removed = catalog_changes(CATALOG['catalog'], catalog)
+        if changed or removed:
+            logger.info(f'Reloading tickers: {changed + removed}')
+            if STORE is not None:
+                with metrics.stage('store_reload'):
+                    STORE = await asyncio.get_running_loop().run_in_executor(LOADERS, reload_store, STORE,
+                                                                             catalog, changed, removed)
+            for ticker in changed + removed:
+                PARTITIONS.evict(ticker)
+                PRICES.evict(ticker)
+        CATALOG.update(catalog=catalog, tickers=None, mtime=mtime)
+    except Exception as e:
+        logger.error(f'Failed to reload the catalog: {e}')
+    finally:
+        CATALOG['refresh'] = None
+
+async def _sync_catalog():
+    # the catalog (and the store/partitions) of this worker brought up to
+    # date right away instead of on the next reload check
+    await _get_catalog()
+    if CATALOG['refresh'] is None and catalog_mtime(DB_DIR) != CATALOG['mtime']:
+        CATALOG['refresh'] = asyncio.create_task(_refresh_catalog())
+    if CATALOG['refresh'] is not None:
+        await asyncio.shield(CATALOG['refresh'])
+
 async def _get_tickers():
-    path = Path(DB_DIR)
-    tickers_arr = np.sort([p.name for p in path.glob("*") if p.is_dir()])
-    tickers = pd.DataFrame()
-    #tickers = pd.Series(data=np.sort([p.name for p in path.glob("*") if p.is_dir()]))
-    # lets also store start and end dates for which we have the data
-    for ticker in tickers_arr:
-        path = Path(os.path.join(DB_DIR, f'{ticker}'))
-        file_paths = np.sort([p for p in path.glob("*")])
-        data = pd.read_parquet(file_paths[0], columns=['close_px'])
-        start_date = data.index[0]
-        data = pd.read_parquet(file_paths[-1], columns=['close_px'])
-        end_date = data.index[-1]
-        ticker_row = pd.DataFrame(data={'ticker':[ticker],'start_date':[start_date],'end_date':[end_date]})
-        tickers = ticker_row if tickers.empty else pd.concat([tickers,ticker_row],ignore_index=True)
-    return tickers
+    catalog = await _get_catalog()
+    if CATALOG['tickers'] is None:
+        CATALOG['tickers'] = catalog_frame(catalog)
+    return CATALOG['tickers']
 
 @app.get("/tickers/")
 async def get_tickers():
@@ -49,72 +214,225 @@ async def get_tickers():
         raise HTTPException(status_code=404, detail="No Tickers found")
     return Response(tickers.to_json(orient='records',date_format='iso'), media_type='application/json')
 
-@alru_cache(maxsize=64)
-async def _get_cached_returns_by_ticker(ticker):
-    path = Path(os.path.join(DB_DIR, f'{ticker}'))
-
-    file_paths = np.sort([p for p in path.glob("*")])
-
-    eod_data = pd.concat([pd.read_parquet(file_path, columns=['close_px','adj_factor'])
-                         for file_path in file_paths], sort=False, copy=False)
-
-    if eod_data.empty:
-        raise HTTPException(status_code=404, detail="No Ticker/Dates found")
-
-    # if the client requires backward adjusted close
-    #eod_data['roll_adj_cum_prod'] = eod_data['adj_factor'][::-1].cumprod()[::-1]
-    #eod_data['adj_close_px'] = eod_data['close_px'].multiply(eod_data['roll_adj_cum_prod'], axis='rows')
-    #eod_data['c2c_ret'] = (eod_data['adj_close_px'].ffill() / eod_data['adj_close_px'].ffill().shift(1)) - 1.0
-
-    # incase only return is required
-    eod_data['c2c_ret'] = (eod_data['close_px'].ffill() / (eod_data['close_px'].multiply(eod_data['adj_factor'], axis='rows')).ffill().shift(1)) - 1.0
-    eod_data.fillna(value={'c2c_ret':0.0},inplace=True)
-
-    return eod_data
-
 async def _get_returns_by_ticker(ticker, start_date, end_date, include_ric=False):
-    db_tickers = await _get_tickers()
-    if db_tickers.empty:
+    db_tickers = await _get_catalog()
+    if not db_tickers:
         raise HTTPException(status_code=404, detail="No Tickers found")
 
-    if not ticker in db_tickers['ticker'].values:
+    if not ticker in db_tickers:
         raise HTTPException(status_code=404, detail=f"Ticker: {ticker} not found")
 
-    eod_data = await _get_cached_returns_by_ticker(ticker)
-
-    if eod_data.empty:
-        raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+    metrics.cache('store', STORE is not None and ticker in STORE)
+    if STORE is not None and ticker in STORE:
+        with metrics.stage('slice'):
+            eod_data = STORE.returns(ticker, start_date, end_date)
+        if eod_data.empty:
+            raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+        return eod_data.rename(columns={'c2c_ret':ticker}) if include_ric else eod_data
 
-    #eod_data = eod_data.loc[(eod_data.index.date >= start_date.date()) & (eod_data.index.date <= end_date.date()),:]
-    eod_data = eod_data.loc[start_date:end_date]
+    years = [int(Path(f).stem) for f in db_tickers[ticker]['files']]
+    eod_data = await PARTITIONS.returns(ticker, start_date, end_date, years=years)
 
     if eod_data.empty:
         raise HTTPException(status_code=404, detail="No Ticker/Dates found")
 
     return eod_data[['c2c_ret']].rename(columns={'c2c_ret':ticker}) if include_ric else eod_data[['c2c_ret']]
 
-async def _get_returns_by_tickers(tickers, start_date, end_date):
+async def _check_tickers(tickers, start_date, end_date):
     tickers = np.array([ticker.upper() for ticker in tickers.split(',')])
 
-    db_tickers = await _get_tickers()
-    if db_tickers.empty:
+    db_tickers = await _get_catalog()
+    if not db_tickers:
         raise HTTPException(status_code=404, detail="No Tickers found")
 
-    missing = ~np.isin(tickers, db_tickers['ticker'].values)
+    missing = np.array([not ticker in db_tickers for ticker in tickers])
     if np.any(missing):
         raise HTTPException(status_code=404, detail=f"Tickers: {tickers[missing]} not found")
     
     if end_date < start_date:
         raise HTTPException(status_code=404, detail="End Date < Start Date")
 
-    eod_data = pd.concat([await _get_returns_by_ticker(ticker, start_date, end_date, include_ric=len(tickers)>1)
-                         for ticker in tickers], sort=False, copy=False, axis=1)
+    return tickers
+
+async def _get_returns_by_tickers(tickers, start_date, end_date):
+    tickers = await _check_tickers(tickers, start_date, end_date)
+
+    if STORE is not None and all(ticker in STORE for ticker in tickers):
+        metrics.cache('store', True)
+        with metrics.stage('slice'):
+            eod_data, found = STORE.panel(tickers, start_date, end_date)
+        # every ticker needs data in the window
+        if eod_data.empty or not found.all():
+            raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+        return eod_data if len(tickers) > 1 else eod_data.set_axis(['c2c_ret'], axis=1)
+
+    # the tickers are read concurrently
+    eod_data = pd.concat(await asyncio.gather(*[_get_returns_by_ticker(ticker, start_date, end_date,
+                                                                       include_ric=len(tickers)>1)
+                                                for ticker in tickers]), sort=False, copy=False, axis=1)
 
     if eod_data.empty:
         raise HTTPException(status_code=404, detail="No Ticker/Dates found")
 
     return eod_data
 
+async def _stream_returns_by_tickers(tickers, start_date, end_date):
+    # same rows as _get_returns_by_tickers as a generator of chunks, all the
+    # checks run before anything is sent so a 404 is still possible
+    tickers = await _check_tickers(tickers, start_date, end_date)
+    names = list(tickers) if len(tickers) > 1 else ['c2c_ret']
+
+    # the store is pinned for the whole stream, a reload in the meantime
+    # swaps STORE but not the arrays this response reads from
+    store = STORE
+    if store is not None and all(ticker in store for ticker in tickers):
+        metrics.cache('store', True)
+        if not store.found(tickers, start_date, end_date).all():
+            raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+        chunk_rows = max(1, STREAM_CHUNK_CELLS // len(tickers))
+
+        async def store_chunks():
+            for chunk in store.panel_chunks(tickers, start_date, end_date, chunk_rows):
+                yield chunk.set_axis(names, axis=1)
+        return store_chunks()
+
+    # a year of the partitions at a time, the catalog date range rules out
+    # a ticker without reading anything
+    metrics.cache('store', False)
+    db_tickers = await _get_catalog()
+    for ticker in tickers:
+        entry = db_tickers[ticker]
+        if pd.Timestamp(entry['end_date']) < start_date or pd.Timestamp(entry['start_date']) > end_date:
+            raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+    years = {ticker: [int(Path(f).stem) for f in db_tickers[ticker]['files']] for ticker in tickers}
+
+    def year_window(year):
+        return max(start_date, dt.datetime(year, 1, 1)), min(end_date, dt.datetime(year, 12, 31))
+
+    async def found(ticker):
+        # rows in the window (the range can straddle it with none in it), up
+        # to the first year that has some, the partitions read stay cached
+        # for the first chunks
+        for year in sorted(set(years[ticker]) & set(range(start_date.year, end_date.year + 1))):
+            if not (await PARTITIONS.returns(ticker, *year_window(year), years=years[ticker])).empty:
+                return True
+        return False
+    if not all(await asyncio.gather(*[found(ticker) for ticker in tickers])):
+        raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+
+    async def chunks():
+        for year in range(start_date.year, end_date.year + 1):
+            frames = await asyncio.gather(*[PARTITIONS.returns(ticker, *year_window(year), years=years[ticker])
+                                            for ticker in tickers])
+            frames = [frame.set_axis([name], axis=1) for frame, name in zip(frames, names)]
+            frames = [frame for frame in frames if not frame.empty]
+            if frames:
+                yield pd.concat(frames, sort=False, copy=False, axis=1).reindex(columns=names)
+    return chunks()
+
+async def _stream(chunks, writer):
+    async for chunk in chunks:
+        yield await asyncio.to_thread(writer.write, chunk)
+    yield writer.close()
+
+async def _get_snapshot(query_date, tickers=None):
+    # cross section of a date, (ticker, close_px, c2c_ret) for the tickers
+    # trading on it, all of them unless tickers are given
+    if tickers:
+        tickers = await _check_tickers(tickers, query_date, query_date)
+    if STORE is not None and (tickers is None or all(ticker in STORE for ticker in tickers)):
+        metrics.cache('store', True)
+        with metrics.stage('slice'):
+            eod_data = STORE.snapshot(query_date, tickers)
+    else:
+        # a read of the year of every ticker listed on the date
+        metrics.cache('store', False)
+        db_tickers = await _get_catalog()
+        if tickers is None:
+            tickers = [ticker for ticker, entry in db_tickers.items()
+                       if pd.Timestamp(entry['start_date']) <= query_date <= pd.Timestamp(entry['end_date'])]
+        years = {ticker: [int(Path(f).stem) for f in db_tickers[ticker]['files']] for ticker in tickers}
+        closes = await asyncio.gather(*[PARTITIONS.window(ticker, query_date, query_date, years=years[ticker])
+                                        for ticker in tickers])
+        returns = await asyncio.gather(*[PARTITIONS.returns(ticker, query_date, query_date, years=years[ticker])
+                                         for ticker in tickers])
+        found = [not close.empty for close in closes]
+        eod_data = pd.DataFrame(data={'close_px': [close['close_px'].iloc[0] for close in closes if not close.empty],
+                                      'c2c_ret': [ret['c2c_ret'].iloc[0] for ret in returns if not ret.empty]},
+                                index=pd.Index(np.asarray(tickers, dtype=object)[found], name='ticker'))
+    if eod_data.empty:
+        raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+    return eod_data
+
+async def _get_period_returns_by_tickers(tickers, start_date, end_date, freq):
+    # daily returns of the window (the shared arrays when loaded) compounded
+    # per period, labelled with the last date of the period
+    eod_data = await _get_returns_by_tickers(tickers, start_date, end_date)
+    with metrics.stage('compound'):
+        dates, c2c_ret = compound(eod_data.index.values, eod_data.to_numpy(), freq)
+    return pd.DataFrame(data=c2c_ret, columns=eod_data.columns, index=pd.DatetimeIndex(dates, name='date'))
+
+async def _get_covariance_by_tickers(tickers, start_date, end_date, halflife=None, correlation=False):
+    # (tickers x tickers) matrix over the daily returns of the window
+    eod_data = await _get_returns_by_tickers(tickers, start_date, end_date)
+    names = [ticker.upper() for ticker in tickers.split(',')]
+    with metrics.stage('covariance'):
+        matrix = covariance(eod_data.to_numpy(), halflife=halflife, correlation=correlation)
+    return pd.DataFrame(data=matrix, columns=names, index=pd.Index(names, name='ticker'))
+
+async def _get_prices_by_tickers(tickers, start_date, end_date, fields, adjusted):
+    # long format (date, ticker, fields...), dates then tickers in request order
+    tickers = await _check_tickers(tickers, start_date, end_date)
+
+    if fields == ['close_px'] and STORE is not None and all(ticker in STORE for ticker in tickers):
+        metrics.cache('store', True)
+        with metrics.stage('slice'):
+            eod_data, found = STORE.prices(tickers, start_date, end_date, adjusted=adjusted)
+        if not found.all():
+            raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+        return eod_data
+
+    metrics.cache('store', False)
+    db_tickers = await _get_catalog()
+    prices = await asyncio.gather(*[PRICES.prices(ticker, start_date, end_date, adjusted=adjusted,
+                                                  years=[int(Path(f).stem) for f in db_tickers[ticker]['files']])
+                                    for ticker in tickers])
+    if any(eod_data.empty for eod_data in prices):
+        raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+    eod_data = [eod_data[fields].assign(ticker=ticker)[['ticker'] + fields] for ticker, eod_data in zip(tickers, prices)]
+    return pd.concat(eod_data, sort=False).sort_index(kind='stable')
+
+async def _get_summary_by_tickers(tickers, start_date, end_date):
+    if STORE is not None:
+        tickers_ = await _check_tickers(tickers, start_date, end_date)
+        if all(ticker in STORE for ticker in tickers_):
+            metrics.cache('store', True)
+            with metrics.stage('slice'):
+                summary = STORE.summary(tickers_, start_date, end_date)
+            if not (summary['days'] > 0).all():
+                raise HTTPException(status_code=404, detail="No Ticker/Dates found")
+            return summary
+
+    # aggregate the returns of the window instead
+    eod_data = await _get_returns_by_tickers(tickers, start_date, end_date)
+    tickers = [ticker.upper() for ticker in tickers.split(',')]
+    return window_summary(prefix_sums(eod_data.values), eod_data.index.values, tickers)
+
+def _data_version(catalog, tickers):
+    # what a response depends on, the catalog entry of each ticker changes
+    # (new generation) on every yfetch write of the ticker
+    return tuple((entry.get('generation', 0), entry['rows'], entry['end_date'])
+                 if (entry := catalog.get(ticker)) else None for ticker in tickers)
+
+async def _cached(request, endpoint, tickers, start_date, end_date, fmt, build):
+    # tickers keep the request order, it is the column order of the response,
+    # no tickers (all of them) depends on the whole catalog
+    catalog = await _get_catalog()
+    tickers = tuple(ticker.upper() for ticker in tickers.split(',')) if tickers else ()
+    version = _data_version(catalog, tickers) if tickers else CATALOG['mtime']
+    key = (endpoint, tickers, start_date, end_date, fmt, version)
+    return await RESPONSES.respond(request, key, build, last_modified=CATALOG['mtime'] or time.time_ns())
+
 def date_parser(value):
     if isinstance(value, str):
         parsed = parse_date(value)
@@ -125,24 +443,219 @@ def date_parser(value):
 
 DatetimeParam = Annotated[dt.datetime, BeforeValidator(date_parser)]
 
+def response_format(request: Request, format: Optional[str] = None):
+    # json/columns/arrow/csv from ?format=... or the accept header
+    return negotiate(format, request.headers.get('accept'))
+
 class Params1(BaseModel):
     tickers : str
     start_date: DatetimeParam
     end_date: DatetimeParam
     
 @app.get("/returns/{tickers}/{start_date}/{end_date}")
-async def get_returns_by_tickers(params: Params1 = Depends()):
-    eod_data = await _get_returns_by_tickers(params.tickers, params.start_date, params.end_date)
-    return Response(eod_data.reset_index().to_json(orient='records',date_format='iso'), media_type='application/json')
+async def get_returns_by_tickers(request: Request, params: Params1 = Depends(),
+                                 fmt: str = Depends(response_format), stream: bool = False):
+    if stream:
+        # chunked transfer, the body is the same as without stream
+        writer = StreamWriter(fmt)
+        chunks = await _stream_returns_by_tickers(params.tickers, params.start_date, params.end_date)
+        return StreamingResponse(_stream(chunks, writer), media_type=writer.media_type)
+
+    async def build():
+        return render(await _get_returns_by_tickers(params.tickers, params.start_date, params.end_date), fmt)
+    return await _cached(request, 'returns', params.tickers, params.start_date, params.end_date, fmt, build)
 
 class Params2(BaseModel):
     tickers : str
     query_date: DatetimeParam
 
 @app.get("/returns/{tickers}/{query_date}")
-async def get_returns_by_date(params: Params2 = Depends()):
-    eod_data = await _get_returns_by_tickers(params.tickers, params.query_date, params.query_date)
-    return Response(eod_data.reset_index().to_json(orient='records',date_format='iso'), media_type='application/json')
+async def get_returns_by_date(request: Request, params: Params2 = Depends(), fmt: str = Depends(response_format)):
+    async def build():
+        return render(await _get_returns_by_tickers(params.tickers, params.query_date, params.query_date), fmt)
+    # the same response as returns/{tickers}/{query_date}/{query_date}
+    return await _cached(request, 'returns', params.tickers, params.query_date, params.query_date, fmt, build)
+
+def freq_parser(value):
+    if value.upper() not in PERIODS:
+        raise ValueError(f'Invalid freq: {value}, use one of {list(PERIODS)}')
+    return value.upper()
+
+class Params3(Params1):
+    freq: Annotated[str, AfterValidator(freq_parser)]
+
+@app.get("/returns/{tickers}/{start_date}/{end_date}/{freq}")
+async def get_period_returns_by_tickers(request: Request, params: Params3 = Depends(),
+                                        fmt: str = Depends(response_format)):
+    # weekly (W), monthly (M), quarterly (Q) or yearly (Y) compounded returns
+    async def build():
+        eod_data = await _get_period_returns_by_tickers(params.tickers, params.start_date, params.end_date,
+                                                        params.freq)
+        return render(eod_data, fmt)
+    return await _cached(request, ('returns', params.freq), params.tickers, params.start_date, params.end_date,
+                         fmt, build)
+
+class Params4(BaseModel):
+    query_date: DatetimeParam
+
+@app.get("/snapshot/{query_date}")
+async def get_snapshot(request: Request, params: Params4 = Depends(), fmt: str = Depends(response_format),
+                       tickers: Optional[str] = None):
+    # every ticker trading on the date, or only ?tickers=...
+    async def build():
+        return render(await _get_snapshot(params.query_date, tickers), fmt)
+    return await _cached(request, 'snapshot', tickers, params.query_date, params.query_date, fmt, build)
+
+class Query(BaseModel):
+    tickers: str
+    start_date: DatetimeParam
+    end_date: Optional[DatetimeParam] = None
+
+class Queries(BaseModel):
+    queries: list[Query]
+
+async def _get_returns_by_queries(queries):
+    db_tickers = await _get_catalog()
+    batch = []
+    for query in queries:
+        tickers = np.array([ticker.upper() for ticker in query.tickers.split(',')])
+        missing = np.array([not ticker in db_tickers for ticker in tickers])
+        if np.any(missing):
+            raise HTTPException(status_code=404, detail=f"Tickers: {tickers[missing]} not found")
+        end_date = query.end_date or query.start_date
+        if end_date < query.start_date:
+            raise HTTPException(status_code=404, detail="End Date < Start Date")
+        batch.append((tickers, query.start_date, end_date))
+
+    in_store = STORE is not None and all(ticker in STORE for tickers, _, _ in batch for ticker in tickers)
+    metrics.cache('store', in_store)
+    if in_store:
+        with metrics.stage('slice'):
+            return STORE.batch(batch)
+
+    eod_data = []
+    for q, (tickers, start_date, end_date) in enumerate(batch):
+        for ticker in tickers:
+            years = [int(Path(f).stem) for f in db_tickers[ticker]['files']]
+            returns = await PARTITIONS.returns(ticker, start_date, end_date, years=years)
+            eod_data.append(pd.DataFrame(data={'date': returns.index.values, 'ticker': ticker,
+                                               'c2c_ret': returns['c2c_ret'].values},
+                                         index=pd.Index(np.full(len(returns), q), name='query')))
+    return pd.concat(eod_data, sort=False).sort_values(['date'], kind='stable').sort_index(kind='stable')
+
+@app.post("/returns/query")
+async def get_returns_by_queries(queries: Queries, fmt: str = Depends(response_format)):
+    # rows in long format (query, date, ticker, c2c_ret), query is the
+    # position of the query in the request, empty windows give no rows
+    if not queries.queries:
+        raise HTTPException(status_code=404, detail="No Queries found")
+    eod_data = await _get_returns_by_queries(queries.queries)
+    content, media_type = render(eod_data, fmt)
+    return Response(content, media_type=media_type)
+
+@app.get("/prices/{tickers}/{start_date}/{end_date}")
+async def get_prices_by_tickers(request: Request, params: Params1 = Depends(), fmt: str = Depends(response_format),
+                                adjusted: bool = False, fields: Optional[str] = None):
+    # raw or backward adjusted (to end_date) ohlcv, fields defaults to all of them
+    fields = [field.lower() for field in fields.split(',')] if fields else PRICE_COLUMNS
+    unknown = [field for field in fields if field not in PRICE_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Fields: {unknown} not found, use some of {PRICE_COLUMNS}")
+
+    async def build():
+        eod_data = await _get_prices_by_tickers(params.tickers, params.start_date, params.end_date, fields, adjusted)
+        return render(eod_data, fmt)
+    return await _cached(request, ('prices', tuple(fields), adjusted), params.tickers,
+                         params.start_date, params.end_date, fmt, build)
+
+async def _matrix_response(request, params, fmt, halflife, correlation):
+    # pairwise complete over the window, exponentially weighted with a halflife (in days)
+    if halflife is not None and not halflife > 0:
+        raise HTTPException(status_code=422, detail=f"Invalid halflife: {halflife}")
+    async def build():
+        matrix = await _get_covariance_by_tickers(params.tickers, params.start_date, params.end_date,
+                                                  halflife=halflife, correlation=correlation)
+        return render(matrix, fmt)
+    return await _cached(request, ('correlation' if correlation else 'covariance', halflife), params.tickers,
+                         params.start_date, params.end_date, fmt, build)
+
+@app.get("/covariance/{tickers}/{start_date}/{end_date}")
+async def get_covariance_by_tickers(request: Request, params: Params1 = Depends(),
+                                    fmt: str = Depends(response_format), halflife: Optional[float] = None):
+    return await _matrix_response(request, params, fmt, halflife, correlation=False)
+
+@app.get("/correlation/{tickers}/{start_date}/{end_date}")
+async def get_correlation_by_tickers(request: Request, params: Params1 = Depends(),
+                                     fmt: str = Depends(response_format), halflife: Optional[float] = None):
+    return await _matrix_response(request, params, fmt, halflife, correlation=True)
+
+@app.get("/cumreturns/{tickers}/{start_date}/{end_date}")
+async def get_cumreturns_by_tickers(request: Request, params: Params1 = Depends(),
+                                    fmt: str = Depends(response_format)):
+    async def build():
+        summary = await _get_summary_by_tickers(params.tickers, params.start_date, params.end_date)
+        return render(summary[['start_date','end_date','total_return']], fmt)
+    return await _cached(request, 'cumreturns', params.tickers, params.start_date, params.end_date, fmt, build)
+
+@app.get("/stats/{tickers}/{start_date}/{end_date}")
+async def get_stats_by_tickers(request: Request, params: Params1 = Depends(), fmt: str = Depends(response_format)):
+    async def build():
+        return render(await _get_summary_by_tickers(params.tickers, params.start_date, params.end_date), fmt)
+    return await _cached(request, 'stats', params.tickers, params.start_date, params.end_date, fmt, build)
+
+async def _render_events(events):
+    # an sse message per event with the returns of the rows it wrote, read
+    # once per worker whatever the number of subscribers
+    await _sync_catalog()
+    messages = []
+    for event in events:
+        try:
+            returns = await _get_returns_by_tickers(event['ticker'], pd.Timestamp(event['start_date']),
+                                                    pd.Timestamp(event['end_date']))
+        except HTTPException:
+            # removed (or rewritten) since
+            continue
+        data = (f'{{"ticker":{json.dumps(event["ticker"])},"generation":{event["generation"]},'
+                f'"returns":{to_json(returns).decode()}}}')
+        messages.append((event, f'id: {event["id"]}\nevent: returns\ndata: {data}\n\n'))
+    return messages
+
+# subscribers of /subscribe, fed from the event log yfetch appends to
+EVENTS = EventHub(DB_DIR, _render_events, poll_secs=app_config.data.events_poll_secs() or 1.0)
+EVENTS_KEEPALIVE_SECS = app_config.data.events_keepalive_secs() or 15.0
+
+@app.get("/subscribe/{tickers}")
+async def subscribe(request: Request, tickers: str):
+    # server sent events, the new returns of the tickers as soon as yfetch
+    # has written them, a reconnecting client (last-event-id) gets what it
+    # missed
+    db_tickers = await _get_catalog()
+    tickers = np.array([ticker.upper() for ticker in tickers.split(',')])
+    missing = np.array([not ticker in db_tickers for ticker in tickers])
+    if np.any(missing):
+        raise HTTPException(status_code=404, detail=f"Tickers: {tickers[missing]} not found")
+    last_id = request.headers.get('last-event-id')
+    queue = await EVENTS.subscribe(tickers, last_id=int(last_id) if last_id and last_id.isdigit() else None)
+
+    async def messages():
+        try:
+            yield f'retry: {int(EVENTS.poll_secs * 1000)}\n\n'
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=EVENTS_KEEPALIVE_SECS)
+                except asyncio.TimeoutError:
+                    # a comment line keeps proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+        finally:
+            EVENTS.unsubscribe(queue)
+    return StreamingResponse(messages(), media_type='text/event-stream',
+                             headers={'cache-control': 'no-cache', 'x-accel-buffering': 'no'})
+
+@app.get("/metrics")
+async def get_metrics():
+    # prometheus text format, aggregated over all gunicorn workers
+    content, media_type = metrics.latest()
+    return Response(content, media_type=media_type)
 
 @click.command()
 @click.option('--host',
@@ -157,9 +670,34 @@ async def get_returns_by_date(params: Params2 = Depends()):
               required=False,
               show_default=True,
               help='port')
-def main(host, port):
+@click.option('--workers',
+              type=click.INT,
+              default=8,
+              required=False,
+              show_default=True,
+              help='number of worker processes')
+@click.option('--profile/--no-profile',
+              default=None,
+              required=False,
+              help='run the sampling profiler in every worker  [default: profile in app_config.yaml]')
+def main(host, port, workers, profile):
     """yfinance rest service"""
     logger.info(f"DB_DIR: {DB_DIR}")
+    logger.info(f"Metrics dir: {metrics.setup()}")
+    metrics.reset()
+
+    temp_store_dir = None
+    if app_config.data.preload_store():
+        global STORE, STORE_DIR
+        if STORE_DIR is None:
+            # no export, the store is saved to a dir of this server (memory
+            # backed when /dev/shm is there) for the workers to map
+            STORE_DIR = temp_store_dir = tempfile.mkdtemp(prefix='yserv_store_',
+                                                          dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        STORE = load_store()
+        # move everything allocated so far out of the gc generations, so the
+        # collector in the workers does not touch (and copy) the shared pages
+        gc.freeze()
 
     #import uvicorn
     #uvicorn.run(app, host=host, port=port)
@@ -180,9 +718,28 @@ def main(host, port):
         def load(self):
             return self.app
 
+    profile = app_config.data.profile() if profile is None else profile
+    profile_dir = app_config.data.profile_dir() or os.path.join(tempfile.gettempdir(), 'yserv_profile')
+
+    def post_worker_init(worker):
+        # threads do not survive the fork, the profiler starts in each worker
+        if profile:
+            Profiler(profile_dir).start()
+
+    def child_exit(server, worker):
+        metrics.worker_exit(worker.pid)
+
+    def on_exit(server):
+        # in the master only (an atexit handler would run in the workers too)
+        if temp_store_dir:
+            shutil.rmtree(temp_store_dir, ignore_errors=True)
+
     options = {'bind': f'{host}:{port}',
-               'workers': 8,
-               'worker_class': UvicornWorker}
+               'workers': workers,
+               'worker_class': UvicornWorker,
+               'post_worker_init': post_worker_init,
+               'child_exit': child_exit,
+               'on_exit': on_exit}
 
     Gunicorn(app, options).run()
 